@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import json
 import aiopg
 from aiopg.sa import create_engine
 import sqlalchemy as sa
@@ -9,39 +10,157 @@ from urllib import parse as urlparse
 from aiohttp import web
 from .app import (
     handle_list, handle_single, handle_create, handle_delete, handle_put,
-    handle_login, handle_token
+    handle_login, handle_token, handle_batch_create, handle_export,
+    handle_import, handle_logout, sticker_fields, login_token_fields,
+    access_token_fields, insert_stickers
 )
-from .db import connect
+from .db import (
+    connect, connect_lazily, StatementCache, PoolStats, ReplicaRouter)
+from .cache import AuthCache, ResponseCache
+from .admission import admission_middleware, create_budgets
+from .batching import WriteBatcher
+from .coalesce import SingleFlight
+from .live import WallBroadcaster, handle_wall_stream
+from .encoders import RowEncoder
+from .notify import WallListener, TOKEN_CHANNEL
+from .metrics import Metrics, metrics_middleware, handle_metrics
+from .passwords import PasswordHasher
+from .sweeper import TokenSweeper
+from .tokens import TokenSigner, RevocationList, parse_keys
 
 
 async def connect_postgresql_db(app):
-    dsn = app['config'].postgresql_dsn
-    connection = await connect(dsn, loop=app.loop)
+    config = app['config']
+    connection = await connect(
+        config.postgresql_dsn, loop=app.loop,
+        minsize=config.postgresql_pool_minsize,
+        maxsize=config.postgresql_pool_maxsize,
+        pool_recycle=config.postgresql_pool_max_lifetime)
     app.db = connection
+
+    app.db_replica = None
+    if config.postgresql_replica_dsn:
+        # a replica down at startup must not prevent it
+        app.db_replica = await connect_lazily(
+            config.postgresql_replica_dsn, loop=app.loop,
+            maxsize=config.postgresql_pool_maxsize,
+            pool_recycle=config.postgresql_pool_max_lifetime)
+        app['db_router'] = ReplicaRouter(
+            app.db_replica,
+            sticky_seconds=config.postgresql_replica_sticky_seconds,
+            retry_interval=config.postgresql_replica_retry_interval)
     return connection
 
 
 async def disconnect_postgresql_db(app):
     app.db.close()
+    if app.db_replica is not None:
+        app.db_replica.close()
+
+
+def start_wall_listener(app):
+    config = app['config']
+    listener = WallListener(
+        config.postgresql_dsn, app.loop,
+        keepalive_interval=config.wall_listener_keepalive_interval)
+    listener.subscribe(app['response_cache'].on_wall_change)
+    if app['single_flight'] is not None:
+        listener.subscribe(app['single_flight'].on_wall_change)
+    listener.subscribe(app['wall_broadcaster'].on_wall_change)
+    listener.subscribe(app['auth_cache'].on_token_change, TOKEN_CHANNEL)
+    listener.start()
+    app['wall_listener'] = listener
+
+
+async def stop_wall_listener(app):
+    if 'wall_listener' in app:
+        await app['wall_listener'].stop()
+
+
+def start_token_sweeper(app):
+    config = app['config']
+    sweeper = TokenSweeper(
+        app.db, app.loop, interval=config.token_sweep_interval,
+        batch_size=config.token_sweep_batch_size)
+    sweeper.start()
+    app['token_sweeper'] = sweeper
+
+
+async def stop_token_sweeper(app):
+    if 'token_sweeper' in app:
+        await app['token_sweeper'].stop()
+
+
+def start_write_batcher(app):
+    config = app['config']
+    app['write_batcher'] = WriteBatcher(
+        app.db, app.loop, insert_stickers,
+        window=config.wall_create_batch_window,
+        max_size=config.wall_create_batch_max_size,
+        acquire_timeout=config.postgresql_pool_acquire_timeout)
+
+
+async def stop_write_batcher(app):
+    if 'write_batcher' in app:
+        await app['write_batcher'].close()
+
+
+async def start_revocation_list(app):
+    revoked_tokens = RevocationList(
+        app.db, app.loop,
+        refresh_interval=app['config'].revoked_tokens_refresh_interval)
+    await revoked_tokens.load()
+    revoked_tokens.start()
+    app['revoked_tokens'] = revoked_tokens
+
+
+async def stop_revocation_list(app):
+    if 'revoked_tokens' in app:
+        await app['revoked_tokens'].stop()
 
 
 async def on_startup(app):
     await connect_postgresql_db(app)
+    if app['token_signer'] is not None:
+        await start_revocation_list(app)
+    if app['config'].response_cache_size > 0 or \
+            app['config'].wall_live_max_subscribers > 0 or \
+            app['config'].auth_cache_size > 0:
+        start_wall_listener(app)
+    if app['config'].token_sweep_interval > 0:
+        start_token_sweeper(app)
+    if app['config'].wall_create_batch_window > 0:
+        start_write_batcher(app)
 
 
 async def on_shutdown(app):
+    await stop_write_batcher(app)
+    await stop_token_sweeper(app)
+    await stop_revocation_list(app)
+    app['password_hasher'].close()
+    # ends the streams, their handlers return
+    app['wall_broadcaster'].close()
+    await stop_wall_listener(app)
     await disconnect_postgresql_db(app)
 
 
 def setup_routers(app):
     app.router.add_post('/login', handle_login)
     app.router.add_post('/token', handle_token)
+    app.router.add_post('/logout', handle_logout)
 
     app.router.add_get('/wall', handle_list)
     app.router.add_post('/wall', handle_create)
-    app.router.add_get('/wall/{id}', handle_single)
-    app.router.add_put('/wall/{id}', handle_put)
-    app.router.add_delete('/wall/{id}', handle_delete)
+    app.router.add_post('/wall/batch', handle_batch_create)
+    app.router.add_get('/wall/export', handle_export)
+    app.router.add_get('/wall/stream', handle_wall_stream)
+    app.router.add_post('/wall/import', handle_import)
+    app.router.add_get(r'/wall/{id:\d+}', handle_single)
+    app.router.add_put(r'/wall/{id:\d+}', handle_put)
+    app.router.add_delete(r'/wall/{id:\d+}', handle_delete)
+
+    if app['config'].metrics_enabled:
+        app.router.add_get('/metrics', handle_metrics)
 
 
 class Base(object):
@@ -51,6 +170,126 @@ class Base(object):
 
     postgresql_dsn = env.get('POSTGRESQL_URL', '')
 
+    postgresql_pool_minsize = int(env.get('POSTGRESQL_POOL_MINSIZE', 1))
+    postgresql_pool_maxsize = int(env.get('POSTGRESQL_POOL_MAXSIZE', 10))
+    # seconds to wait for a free connection before answering 503
+    postgresql_pool_acquire_timeout = float(
+        env.get('POSTGRESQL_POOL_ACQUIRE_TIMEOUT', 5))
+    # seconds after which a connection is recycled, -1 keeps it forever
+    postgresql_pool_max_lifetime = float(
+        env.get('POSTGRESQL_POOL_MAX_LIFETIME', -1))
+
+    # optional read replica for GET requests
+    postgresql_replica_dsn = env.get('POSTGRESQL_REPLICA_URL', '')
+    # seconds a client reads from the primary after it wrote
+    postgresql_replica_sticky_seconds = float(
+        env.get('POSTGRESQL_REPLICA_STICKY_SECONDS', 5))
+    # seconds before a replica that failed is tried again
+    postgresql_replica_retry_interval = float(
+        env.get('POSTGRESQL_REPLICA_RETRY_INTERVAL', 10))
+
+    wall_page_size = int(env.get('WALL_PAGE_SIZE', 100))
+    wall_max_page_size = int(env.get('WALL_MAX_PAGE_SIZE', 1000))
+    wall_stream_batch_size = int(env.get('WALL_STREAM_BATCH_SIZE', 500))
+    wall_batch_max_size = int(env.get('WALL_BATCH_MAX_SIZE', 500))
+    wall_export_batch_size = int(env.get('WALL_EXPORT_BATCH_SIZE', 1000))
+    wall_import_batch_size = int(env.get('WALL_IMPORT_BATCH_SIZE', 1000))
+    # rejected lines reported back in detail, the rest is only counted
+    wall_import_max_errors = int(env.get('WALL_IMPORT_MAX_ERRORS', 100))
+    # bytes; a longer line fails the import, it's never read into memory
+    wall_import_max_line_length = int(
+        env.get('WALL_IMPORT_MAX_LINE_LENGTH', 65536))
+    # GET /wall?q= ranks at most this many matches, the newest ones
+    wall_search_max_matches = int(env.get('WALL_SEARCH_MAX_MATCHES', 1000))
+    # characters; the last word of q is a prefix, the index is read for
+    # every word starting with it, so a shorter one is answered 400
+    wall_search_min_prefix_length = int(
+        env.get('WALL_SEARCH_MIN_PREFIX_LENGTH', 3))
+
+    auth_cache_size = int(env.get('AUTH_CACHE_SIZE', 10000))
+    # seconds; while a worker's LISTEN connection is down, revoked tokens
+    # may keep working in it this long
+    auth_cache_ttl = float(env.get('AUTH_CACHE_TTL', 30))
+
+    # seconds between deletes of the expired tokens, 0 disables
+    token_sweep_interval = float(env.get('TOKEN_SWEEP_INTERVAL', 300))
+    token_sweep_batch_size = int(env.get('TOKEN_SWEEP_BATCH_SIZE', 500))
+
+    # request counts and latencies, DB timings and the per-worker stats in
+    # the Prometheus format at /metrics
+    metrics_enabled = env.get('METRICS_ENABLED', '1') == '1'
+
+    # statements of each request, reported in the Server-Timing header
+    query_trace_enabled = env.get('QUERY_TRACE_ENABLED', '1') == '1'
+    # seconds; slower statements are logged, without their parameters
+    slow_query_threshold = float(env.get('SLOW_QUERY_THRESHOLD', 0.1))
+    # dev mode: log requests running more statements than the budget or the
+    # same statement again and again
+    query_trace_dev = env.get('QUERY_TRACE_DEV', '0') == '1'
+    query_budget = int(env.get('QUERY_BUDGET', 5))
+
+    # PBKDF2-SHA256 rounds, changing it rehashes passwords on login
+    password_hash_iterations = int(
+        env.get('PASSWORD_HASH_ITERATIONS', 100000))
+    # logins hashing at the same time, each holding a pool connection
+    password_hash_concurrency = int(env.get('PASSWORD_HASH_CONCURRENCY', 2))
+    # seconds a login waits for its turn before answering 503
+    password_hash_wait_timeout = float(
+        env.get('PASSWORD_HASH_WAIT_TIMEOUT', 5))
+
+    # "kid:secret,kid:secret" enables signed access tokens checked without
+    # a query; the first key signs, all of them verify
+    access_token_keys = env.get('ACCESS_TOKEN_KEYS', '')
+    access_token_ttl = int(env.get('ACCESS_TOKEN_TTL', 300))
+    # seconds before a logout in another worker is seen
+    revoked_tokens_refresh_interval = float(
+        env.get('REVOKED_TOKENS_REFRESH_INTERVAL', 5))
+
+    statement_cache_size = int(env.get('STATEMENT_CACHE_SIZE', 256))
+    postgresql_prepared_statements = env.get(
+        'POSTGRESQL_PREPARED_STATEMENTS', '0') == '1'
+
+    # responses of GET /wall and /wall/{id} kept per worker, 0 disables
+    response_cache_size = int(env.get('RESPONSE_CACHE_SIZE', 1000))
+    wall_listener_keepalive_interval = float(
+        env.get('WALL_LISTENER_KEEPALIVE_INTERVAL', 30))
+    # clients of GET /wall/stream per worker, 0 disables it
+    wall_live_max_subscribers = int(
+        env.get('WALL_LIVE_MAX_SUBSCRIBERS', 10000))
+    # events queued per client before it has to resync
+    wall_live_queue_size = int(env.get('WALL_LIVE_QUEUE_SIZE', 100))
+    # seconds a client may block a send before it's dropped
+    wall_live_send_timeout = float(env.get('WALL_LIVE_SEND_TIMEOUT', 10))
+    wall_live_keepalive_interval = float(
+        env.get('WALL_LIVE_KEEPALIVE_INTERVAL', 15))
+    # seconds a POST /wall waits for others to insert them together,
+    # 0 inserts each one right away
+    wall_create_batch_window = float(
+        env.get('WALL_CREATE_BATCH_WINDOW', 0))
+    wall_create_batch_max_size = int(
+        env.get('WALL_CREATE_BATCH_MAX_SIZE', 100))
+    # Requests per second and burst allowed per token, for GET/HEAD
+    # requests and for the others. The requests without a valid token
+    # share one per client address. Every worker counts its own, so a
+    # token gets up to the number of workers times as much. 0 disables.
+    read_rate_limit = float(env.get('READ_RATE_LIMIT', 0))
+    read_rate_burst = int(env.get('READ_RATE_BURST', 20))
+    write_rate_limit = float(env.get('WRITE_RATE_LIMIT', 0))
+    write_rate_burst = int(env.get('WRITE_RATE_BURST', 5))
+    # tokens and addresses whose rate is tracked per worker, the idlest
+    # are forgotten
+    rate_limited_tokens = int(env.get('RATE_LIMITED_TOKENS', 10000))
+    # requests handled at once per worker, the others are answered 503,
+    # 0 disables
+    max_concurrent_reads = int(env.get('MAX_CONCURRENT_READS', 0))
+    max_concurrent_writes = int(env.get('MAX_CONCURRENT_WRITES', 0))
+    # concurrent identical reads of the wall share one query per worker
+    wall_read_coalescing = env.get('WALL_READ_COALESCING', '1') == '1'
+
+    # encodes the strings of JSON responses, any json.dumps compatible
+    # function (e.g. ujson.dumps) can be dropped in by a subclass
+    json_dumps = staticmethod(json.dumps)
+
 
 class Main(Base):
     test = False
@@ -65,6 +304,37 @@ def create(loop, conf=None):
     app.on_shutdown.append(on_shutdown)
 
     conf.setup(app)
+    if conf.metrics_enabled:
+        app['metrics'] = Metrics()
+        app.middlewares.append(metrics_middleware)
+    if conf.read_rate_limit or conf.write_rate_limit or \
+            conf.max_concurrent_reads or conf.max_concurrent_writes:
+        app['admission_budgets'] = create_budgets(conf)
+        app.middlewares.append(admission_middleware)
+    app['auth_cache'] = AuthCache(conf.auth_cache_size, conf.auth_cache_ttl)
+    app['statement_cache'] = StatementCache(
+        conf.statement_cache_size, conf.postgresql_prepared_statements)
+    app['db_pool_stats'] = PoolStats()
+    app['response_cache'] = ResponseCache(conf.response_cache_size)
+    app['wall_broadcaster'] = WallBroadcaster(
+        loop, max_subscribers=conf.wall_live_max_subscribers,
+        queue_size=conf.wall_live_queue_size)
+    app['single_flight'] = None
+    if conf.wall_read_coalescing:
+        app['single_flight'] = SingleFlight(loop)
+    app['sticker_encoder'] = RowEncoder(sticker_fields, conf.json_dumps)
+    app['login_token_encoder'] = RowEncoder(
+        login_token_fields, conf.json_dumps)
+    app['access_token_encoder'] = RowEncoder(
+        access_token_fields, conf.json_dumps)
+    app['password_hasher'] = PasswordHasher(
+        loop, conf.password_hash_iterations,
+        concurrency=conf.password_hash_concurrency,
+        wait_timeout=conf.password_hash_wait_timeout)
+    app['token_signer'] = None
+    if conf.access_token_keys:
+        app['token_signer'] = TokenSigner(
+            parse_keys(conf.access_token_keys), conf.access_token_ttl)
     setup_routers(app)
 
     return app
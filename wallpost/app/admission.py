@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import math
+import time
+from aiohttp import web
+from .cache import TTLCache
+from .db import SAFE_METHODS
+
+
+class RateLimiter(object):
+    """Token buckets of ``rate`` requests per second, ``burst`` at most,
+    for the last ``maxsize`` keys seen."""
+
+    def __init__(self, rate, burst, maxsize=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.limited = 0
+        # An idle bucket is full again after burst / rate seconds, and
+        # forgetting a full one changes nothing.
+        self.buckets = TTLCache(maxsize, burst / rate, clock=clock)
+
+    def acquire(self, key):
+        """Take a request out of the bucket of ``key``. Return 0, or the
+        seconds before one is available if it's empty."""
+        now = self.clock()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens, updated = bucket
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+        if tokens < 1:
+            self.limited += 1
+            return (1 - tokens) / self.rate
+        self.buckets.set(key, (tokens - 1, now))
+        return 0
+
+
+class ConcurrencyLimit(object):
+    """Requests handled at once, ``limit`` at most, 0 for no limit."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.shed = 0
+
+    def enter(self):
+        if self.limit and self.in_flight >= self.limit:
+            self.shed += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def leave(self):
+        self.in_flight -= 1
+
+
+class Budget(object):
+    """What the reads, or the writes, of a worker may use."""
+
+    def __init__(self, rate, burst, max_concurrent, max_tokens=10000):
+        self.rate_limiter = None
+        if rate > 0:
+            self.rate_limiter = RateLimiter(rate, burst, max_tokens)
+        self.concurrency = ConcurrencyLimit(max_concurrent)
+
+    def stats(self):
+        return {
+            'in_flight': self.concurrency.in_flight,
+            'shed': self.concurrency.shed,
+            'rate_limited': (self.rate_limiter.limited
+                             if self.rate_limiter is not None else 0),
+        }
+
+
+def create_budgets(config):
+    """Separate read and write budgets, so bulk writes can't take all the
+    capacity from the reads."""
+    return {
+        'read': Budget(
+            config.read_rate_limit, config.read_rate_burst,
+            config.max_concurrent_reads, config.rate_limited_tokens),
+        'write': Budget(
+            config.write_rate_limit, config.write_rate_burst,
+            config.max_concurrent_writes, config.rate_limited_tokens),
+    }
+
+
+def unlimited_concurrency(f):
+    """Leave the requests of handler ``f`` out of the concurrency limits,
+    for streams lasting as long as their clients want."""
+    f.unlimited_concurrency = True
+    return f
+
+
+def rate_limited_per_token(f):
+    """Mark handler ``f`` as charging the bucket of its authenticated token
+    itself, see ``rate_limit``."""
+    f.rate_limited_per_token = True
+    return f
+
+
+def _retry_after(seconds):
+    return {'Retry-After': str(max(1, int(math.ceil(seconds))))}
+
+
+def rate_limit(request, key):
+    """Take the request out of the bucket of ``key`` in its budget. Return
+    a 429 response if it's empty, else None."""
+    if 'admission_budgets' not in request.app:
+        return None
+    rate_limiter = _budget(request).rate_limiter
+    if rate_limiter is None:
+        return None
+    wait = rate_limiter.acquire(key)
+    if wait:
+        return web.Response(status=429, headers=_retry_after(wait))
+    return None
+
+
+def rate_limit_peer(request):
+    """``rate_limit`` the request by its client's address."""
+    return rate_limit(request, ('peer', request.remote))
+
+
+def _budget(request):
+    return request.app['admission_budgets'][
+        'read' if request.method in SAFE_METHODS else 'write']
+
+
+@web.middleware
+async def admission_middleware(request, handler):
+    budget = _budget(request)
+
+    # Only a token that was found can have its own bucket, otherwise
+    # random ones would get around the limit and push the real clients'
+    # buckets out. The others share the one of their address.
+    handler_f = request.match_info.handler
+    if not getattr(handler_f, 'rate_limited_per_token', False):
+        limited = rate_limit_peer(request)
+        if limited is not None:
+            return limited
+
+    if getattr(handler_f, 'unlimited_concurrency', False):
+        return await handler(request)
+
+    # shed right away rather than queueing until the client gives up
+    if not budget.concurrency.enter():
+        return web.Response(status=503, headers=_retry_after(1))
+    try:
+        return await handler(request)
+    finally:
+        budget.concurrency.leave()
@@ -1,30 +1,192 @@
 # -*- coding: utf-8 -*-
+import csv
+import hashlib
 import json
 import random
+import re
 import string
 
 from aiohttp import web
 from datetime import datetime, timedelta
 from functools import wraps
-from jsonschema import validate, ValidationError
-from sqlalchemy import select, and_
-from .db import sticker, user, token, require_postgresql_conn
+from urllib.parse import urlencode
+from sqlalchemy import (
+    select, and_, bindparam, func, literal_column, Column, String, DateTime
+)
+from .admission import rate_limit, rate_limit_peer, rate_limited_per_token
+from .db import (
+    sticker, user, token, require_postgresql_conn,
+    require_lazy_postgresql_conn, RequestConnection, ServerSideCursor
+)
+from .notify import (
+    notify_wall_change, notify_wall_changes, notify_token_revoked
+)
+from .passwords import limit_password_hashing
 from .schemas import login_schema, refresh_token_schema, sticker_create_schema
+from .tokens import InvalidToken
+from .validation import get_validator
+
+
+# Statements executed by the handlers are built once, so that the compiled
+# SQL can be reused from the connection's statement cache.
+_select_auth_user = select([
+    user, token.c.id.label('token_id'), token.c.valid_until
+]).select_from(
+    user.join(token, token.c.user_id == user.c.id)
+).where(and_(
+    token.c.token == bindparam('token_value'),
+    token.c.valid_until >= bindparam('now')))
 
+_select_user = user.select().where(
+    user.c.username == bindparam('username'))
 
-def _dump_sticker(sticker):
-    return {
-        'id': sticker.id,
-        'title': sticker.title,
-        'description': sticker.description
-    }
+_update_user_password = user.update().where(
+    user.c.id == bindparam('user_id'))
 
+# the token of the user valid the longest
+_select_user_token = token.select().where(and_(
+    token.c.user_id == bindparam('user_id'),
+    token.c.valid_until > bindparam('now'))
+).order_by(token.c.valid_until.desc()).limit(1)
 
-def _dump_login_token(token):
-    return {
-        'token': token.token,
-        'valid_until': token.valid_until,
-    }
+_insert_token = token.insert().returning(*token.c)
+
+_update_token = token.update().where(
+    token.c.token == bindparam('token_value')).returning(*token.c)
+
+_delete_token = token.delete().where(
+    token.c.id == bindparam('token_id')).returning(token.c.token)
+
+_select_sticker_page = sticker.select().where(
+    sticker.c.id > bindparam('after')
+).order_by(sticker.c.id).limit(bindparam('limit'))
+
+_select_sticker = sticker.select().where(
+    sticker.c.id == bindparam('sticker_id'))
+
+# The same expression as the sticker_search_idx GIN index, or the index
+# can't be used. Constants are literals, not parameters, for that reason.
+_search_document = func.to_tsvector(
+    literal_column("'simple'"),
+    sticker.c.title + literal_column("' '") +
+    func.coalesce(sticker.c.description, literal_column("''")))
+_search_query = func.to_tsquery(
+    literal_column("'simple'"), bindparam('tsquery'))
+
+# Only the newest max_matches matches are ranked, so ranking common words
+# costs the same however big the wall grows. Their ids still all come out
+# of the index to be sorted, but that's cheaper than ranking them. Older
+# matches are left out rather than arbitrary ones, which would change from
+# one query to the next and break the paging by offset.
+_search_matches = select([sticker.c.id]).where(
+    _search_document.op('@@')(_search_query)
+).order_by(
+    sticker.c.id.desc()
+).limit(bindparam('max_matches')).alias('matches')
+
+_search_stickers = select([sticker]).select_from(
+    sticker.join(_search_matches, _search_matches.c.id == sticker.c.id)
+).order_by(
+    func.ts_rank(_search_document, _search_query).desc(), sticker.c.id
+).limit(bindparam('limit')).offset(bindparam('offset'))
+
+_insert_sticker = sticker.insert().returning(*sticker.c)
+
+_update_sticker = sticker.update().where(
+    sticker.c.id == bindparam('sticker_id')
+).values(version=func.nextval('sticker_version_seq')).returning(*sticker.c)
+
+_delete_sticker = sticker.delete().where(
+    sticker.c.id == bindparam('sticker_id'))
+
+
+# columns of the JSON objects sent back, see app.encoders.RowEncoder
+sticker_fields = (sticker.c.id, sticker.c.title, sticker.c.description)
+login_token_fields = (token.c.token, token.c.valid_until)
+access_token_fields = login_token_fields + (
+    Column('access_token', String, nullable=False),
+    Column('access_valid_until', DateTime, nullable=False),
+)
+
+
+def _sticker_etag(sticker):
+    return '"{}-{}"'.format(sticker.id, sticker.version)
+
+
+def _page_etag(rows, after, limit):
+    # Every write draws a new version, so this changes whenever the rows
+    # of the page do. The extra row counts too, for the next page link.
+    digest = hashlib.md5(','.join(
+        '{}:{}'.format(x.id, x.version) for x in rows).encode('ascii'))
+    return '"{}-{}-{}"'.format(after, limit, digest.hexdigest())
+
+
+def _etag_matches(request, etag):
+    """Weak comparison of ``etag`` against If-None-Match."""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+
+    tags = [x.strip() for x in header.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+def _encoded_json_response(body, status=200, headers=None):
+    return web.Response(
+        body=body.encode('utf-8'), status=status,
+        content_type='application/json', headers=headers)
+
+
+def _json_body_response(request, body, headers):
+    etag = headers.get('ETag')
+    if etag is not None and _etag_matches(request, etag):
+        return web.Response(status=304, headers={'ETag': etag})
+
+    return web.Response(
+        body=body, content_type='application/json', headers=headers)
+
+
+def _response_cache_ttl(request):
+    # A replica may not have replayed a change yet when its NOTIFY comes,
+    # so what was read from it is only kept as long as reads stick to
+    # the primary after a write.
+    if request.get('db_replica'):
+        return request.app['config'].postgresql_replica_sticky_seconds
+    return None
+
+
+def _apply_wall_change(request, event):
+    # the NOTIFY comes back to this worker too, but don't wait for it
+    request.app['response_cache'].on_wall_change(event)
+    if request.app['single_flight'] is not None:
+        request.app['single_flight'].on_wall_change(event)
+
+
+async def _publish_wall_change(request, conn, action, sticker_id=None):
+    event = {'action': action, 'id': sticker_id}
+    await notify_wall_change(conn, event)
+    _apply_wall_change(request, event)
+
+
+async def insert_stickers(conn, values):
+    """Insert the stickers of ``values`` with one statement and publish
+    their creation, return their rows in the same order."""
+    result = await conn.execute(
+        sticker.insert().values(values).returning(*sticker.c))
+    # ids are drawn in VALUES order
+    rows = sorted(await result.fetchall(), key=lambda x: x.id)
+    await notify_wall_changes(
+        conn, [{'action': 'create', 'id': x.id} for x in rows])
+    return rows
+
+
+async def _coalesced(request, conn, key, fn):
+    """``await fn()``, shared with the identical reads in flight."""
+    single_flight = request.app['single_flight']
+    if single_flight is None:
+        return await fn()
+    # what the replica returns may lag behind the primary
+    return await single_flight.do(key + (conn.replica,), fn)
 
 
 def json_response(data, *args, **kwargs):
@@ -49,29 +211,85 @@ def safe_unpack(data, wanted_count):
     return tuple(data[:wanted_count])
 
 
+def _unauthorized(request):
+    # a bad token costs the bucket of its client's address
+    limited = rate_limit_peer(request)
+    return limited if limited is not None else web.Response(status=401)
+
+
 def require_auth_token(f):
+    @rate_limited_per_token
     @wraps(f)
     async def fun(request, conn, *args, **kwargs):
         auth_header = request.headers.get('Authorization', '')
         method, data = safe_unpack(auth_header.split(' '), 2)
-        if method != 'Token':
-            return web.Response(status=401)
-
-        fnd_user = list(await conn.execute(
-            select([user]).select_from(
-                user.join(token, token.c.user_id == user.c.id)
-            ).where(and_(
-                token.c.token == data,
-                token.c.valid_until >= datetime.utcnow()))))
-        if len(fnd_user) == 0:
-            return web.Response(status=401)
+        if method != 'Token' or not data:
+            return _unauthorized(request)
 
-        return await f(request, conn, *args, **kwargs, user=fnd_user[0])
+        signer = request.app['token_signer']
+        if signer is not None and signer.is_signed(data):
+            try:
+                access = signer.verify(data)
+            except InvalidToken:
+                return _unauthorized(request)
+            if request.app['revoked_tokens'].is_revoked(access.token_id):
+                return _unauthorized(request)
+
+            limited = rate_limit(request, ('token', access.token_id))
+            if limited is not None:
+                return limited
+            return await f(request, conn, *args, **kwargs, user=access)
+
+        auth_cache = request.app['auth_cache']
+        fnd_user = auth_cache.get(data)
+        if fnd_user is None:
+            fnd_user = await conn.execute_fetchone(
+                _select_auth_user, token_value=data, now=datetime.utcnow())
+            if fnd_user is None and request.get('db_replica'):
+                # the token of a login may not have been replicated yet
+                primary = RequestConnection(request, primary=True)
+                try:
+                    fnd_user = await primary.execute_fetchone(
+                        _select_auth_user, token_value=data,
+                        now=datetime.utcnow())
+                finally:
+                    await primary.release()
+            if fnd_user is None:
+                return _unauthorized(request)
+
+            # never serve a token from the cache past its validity
+            auth_cache.set(data, fnd_user, ttl=(
+                fnd_user.valid_until - datetime.utcnow()).total_seconds())
+
+        # a signed access token shares the bucket of its DB token
+        limited = rate_limit(request, ('token', fnd_user.token_id))
+        if limited is not None:
+            return limited
+        return await f(request, conn, *args, **kwargs, user=fnd_user)
 
     return fun
 
 
+def _login_token_response(request, fnd_token):
+    """The DB token, and an access token signed for it if enabled."""
+    signer = request.app['token_signer']
+    if signer is None:
+        return _encoded_json_response(
+            request.app['login_token_encoder'].encode(fnd_token))
+
+    access_token, access_valid_until = signer.issue(
+        fnd_token.user_id, fnd_token.id, fnd_token.valid_until)
+    return _encoded_json_response(request.app['access_token_encoder'].encode({
+        'token': fnd_token.token,
+        'valid_until': fnd_token.valid_until,
+        'access_token': access_token,
+        'access_valid_until': access_valid_until,
+    }))
+
+
 def validate_post_schema(schema):
+    validator = get_validator(schema)
+
     def decorator(f):
         @wraps(f)
         async def fun(request, *args, **kwargs):
@@ -81,10 +299,9 @@ def validate_post_schema(schema):
             except json.JSONDecodeError:
                 return web.Response(status=400)
 
-            try:
-                validate(data, schema)
-            except ValidationError as e:
-                return json_response({'error': e.message}, status=400)
+            error = validator.error(data)
+            if error is not None:
+                return json_response({'error': error.message}, status=400)
 
             return await f(request, *args, **kwargs, data=data)
 
@@ -92,6 +309,7 @@ def validate_post_schema(schema):
     return decorator
 
 
+@limit_password_hashing
 @require_postgresql_conn
 @validate_post_schema(login_schema)
 async def handle_login(request, conn, data):
@@ -106,21 +324,27 @@ async def handle_login(request, conn, data):
             'token': _gen_token(),
             'valid_until': datetime.utcnow() + timedelta(minutes=60)
         }
-        new_token = await conn.execute_fetchone(token.insert().values(**data))
-        return await conn.execute_fetchone(
-            token.select().where(token.c.id == new_token.id))
+        return await conn.execute_fetchone(_insert_token, **data)
 
     async def _get_valid_token(user_id):
         return await conn.execute_fetchone(
-            token.select().where(token.c.user_id == user_id))
+            _select_user_token, user_id=user_id, now=datetime.utcnow())
 
     async def _find_user(username, password):
-        return await conn.execute_fetchone(
-            user.select().where(and_(
-                user.c.username == username,
-                user.c.password == password
-            )))
-
+        fnd_user = await conn.execute_fetchone(
+            _select_user, username=username)
+        if not fnd_user or not await hasher.verify(
+                password, fnd_user.password):
+            return None
+
+        # upgrade plaintext passwords and outdated hashes
+        if hasher.needs_rehash(fnd_user.password):
+            await conn.execute(
+                _update_user_password, user_id=fnd_user.id,
+                password=await hasher.hash(password))
+        return fnd_user
+
+    hasher = request.app['password_hasher']
     fnd_user = await _find_user(**data)
     if not fnd_user:
         return web.Response(status=404)
@@ -129,80 +353,487 @@ async def handle_login(request, conn, data):
     if not fnd_token:
         fnd_token = await _create_new_token(fnd_user.id)
 
-    return json_response(_dump_login_token(fnd_token))
+    return _login_token_response(request, fnd_token)
 
 
 @require_postgresql_conn
 @validate_post_schema(refresh_token_schema)
 async def handle_token(request, conn, data):
-    async def _get_valid_token(token_data):
+    async def _bump_token(token_data, valid_until):
         return await conn.execute_fetchone(
-            token.select().where(token.c.token == token_data))
+            _update_token, token_value=token_data, valid_until=valid_until)
 
-    async def _bump_token(fnd_token, valid_until):
-        await conn.execute(token.update().where(
-            token.c.id == fnd_token.id).values(valid_until=valid_until))
-
-    fnd_token = await _get_valid_token(data['token'])
-    await _bump_token(fnd_token, datetime.utcnow() + timedelta(minutes=60))
+    fnd_token = await _bump_token(
+        data['token'], datetime.utcnow() + timedelta(minutes=60))
+    request.app['auth_cache'].invalidate(data['token'])
+    if not fnd_token:
+        return web.Response(status=404)
 
-    fnd_token = await _get_valid_token(data['token'])
-    return json_response(_dump_login_token(fnd_token))
+    return _login_token_response(request, fnd_token)
 
 
 @require_postgresql_conn
 @require_auth_token
+async def handle_logout(request, conn, user):
+    deleted = await conn.execute_fetchone(
+        _delete_token, token_id=user.token_id)
+    if deleted is not None:
+        # the other workers may have the DB token cached, even when it
+        # logs out with an access token
+        await notify_token_revoked(conn, deleted.token)
+        # the NOTIFY comes back to this worker too, but don't wait for it
+        request.app['auth_cache'].invalidate(deleted.token)
+
+    signer = request.app['token_signer']
+    if signer is not None:
+        # access tokens issued for it live at most ttl more seconds
+        await request.app['revoked_tokens'].revoke(
+            conn, user.token_id,
+            datetime.utcnow() + timedelta(seconds=signer.ttl))
+
+    return web.Response(status=204)
+
+
+def _parse_page_args(request):
+    config = request.app['config']
+    try:
+        limit = int(request.query.get('limit', config.wall_page_size))
+        after = int(request.query.get('after', 0))
+    except ValueError:
+        raise ValueError('limit and after must be integers')
+
+    if not 0 < limit <= config.wall_max_page_size:
+        raise ValueError('limit must be between 1 and {}'.format(
+            config.wall_max_page_size))
+
+    return limit, after
+
+
+async def _stream_stickers(
+        request, conn, batch_size, content_type, encode_rows,
+        start=b'', separator=b'', end=b''
+):
+    resp = web.StreamResponse()
+    resp.content_type = content_type
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+
+    resp.write(start)
+    chunk_separator = b''
+    async with ServerSideCursor(
+            conn, sticker.select().order_by(sticker.c.id), 'wall_stream',
+            batch_size) as cursor:
+        async for rows in cursor:
+            resp.write(chunk_separator + encode_rows(rows).encode('utf-8'))
+            chunk_separator = separator
+            # don't fetch the next batch before a slow client caught up
+            await resp.drain()
+    resp.write(end)
+
+    await resp.write_eof()
+    return resp
+
+
+_SEARCH_WORD = re.compile(r'\w+')
+
+
+def _parse_search_args(request):
+    """Return the tsquery of ``q``, matching its last word as a prefix
+    for typeahead, with the limit and offset of the page."""
+    words = _SEARCH_WORD.findall(request.query['q'])
+    if not words:
+        raise ValueError('q must contain a word')
+    min_prefix = request.app['config'].wall_search_min_prefix_length
+    if len(words[-1]) < min_prefix:
+        raise ValueError(
+            'the last word of q must have at least {} characters'.format(
+                min_prefix))
+    query = ' & '.join(words) + ':*'
+
+    limit, _ = _parse_page_args(request)
+    try:
+        offset = int(request.query.get('offset', 0))
+    except ValueError:
+        raise ValueError('offset must be an integer')
+    max_matches = request.app['config'].wall_search_max_matches
+    if not 0 <= offset < max_matches:
+        raise ValueError('offset must be between 0 and {}'.format(
+            max_matches - 1))
+
+    return query, limit, offset
+
+
+async def _search(request, conn):
+    try:
+        query, limit, offset = _parse_search_args(request)
+    except ValueError as e:
+        return json_response({'error': str(e)}, status=400)
+
+    # one extra row tells whether there is a next page
+    result = await conn.execute(
+        _search_stickers, tsquery=query, limit=limit + 1, offset=offset,
+        max_matches=request.app['config'].wall_search_max_matches)
+    rows = await result.fetchall()
+
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        headers['Link'] = '<{}>; rel="next"'.format(
+            request.url.with_query(urlencode([
+                ('q', request.query['q']), ('offset', offset + limit),
+                ('limit', limit)])))
+
+    return _encoded_json_response(
+        request.app['sticker_encoder'].encode_list(rows), headers=headers)
+
+
+@require_lazy_postgresql_conn
+@require_auth_token
 async def handle_list(request, conn, user):
-    result = await conn.execute(sticker.select())
-    return json_response([_dump_sticker(x) for x in result])
+    if 'q' in request.query:
+        return await _search(request, conn)
+
+    stream = request.query.get('stream', '0')
+    if stream not in ('0', '1'):
+        return json_response({'error': 'stream must be 0 or 1'}, status=400)
+    if stream == '1':
+        return await _stream_stickers(
+            request, await conn.get(),
+            request.app['config'].wall_stream_batch_size,
+            'application/json', request.app['sticker_encoder'].encode_items,
+            start=b'[', separator=b',', end=b']')
+
+    try:
+        limit, after = _parse_page_args(request)
+    except ValueError as e:
+        return json_response({'error': str(e)}, status=400)
+
+    response_cache = request.app['response_cache']
+    cache_key = (request.host, after, limit)
+    cached = response_cache.get_list(cache_key)
+    if cached is not None:
+        return _json_body_response(request, *cached)
+    generation = response_cache.generation
+
+    async def query_page():
+        # one extra row tells whether there is a next page
+        result = await conn.execute(
+            _select_sticker_page, after=after, limit=limit + 1)
+        return await result.fetchall()
+
+    rows = await _coalesced(
+        request, conn, ('wall_page',) + cache_key, query_page)
+    etag = _page_etag(rows, after, limit)
+    if _etag_matches(request, etag):
+        return web.Response(status=304, headers={'ETag': etag})
+
+    headers = {'ETag': etag}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        headers['Link'] = '<{}>; rel="next"'.format(
+            request.url.with_query('after={}&limit={}'.format(
+                rows[-1].id, limit)))
+
+    body = request.app['sticker_encoder'].encode_list(rows).encode('utf-8')
+    response_cache.set_list(
+        cache_key, (body, headers), generation, _response_cache_ttl(request))
+    return _json_body_response(request, body, headers)
 
 
 @require_postgresql_conn
 @require_auth_token
-async def handle_single(request, conn, user):
-    id_ = request.match_info.get('id')
-    result = await conn.execute_fetchone(
-        sticker.select().where(sticker.c.id == id_))
-    if result:
-        return json_response(_dump_sticker(result))
+async def handle_export(request, conn, user):
+    encoder = request.app['sticker_encoder']
 
-    return web.Response(status=404)
+    def _encode_ndjson_lines(rows):
+        return encoder.encode_items(rows, '\n') + '\n'
 
+    return await _stream_stickers(
+        request, conn, request.app['config'].wall_export_batch_size,
+        'application/x-ndjson', _encode_ndjson_lines)
 
-@require_postgresql_conn
+
+@require_lazy_postgresql_conn
+@require_auth_token
+async def handle_single(request, conn, user):
+    id_ = int(request.match_info['id'])
+    response_cache = request.app['response_cache']
+    cached = response_cache.get_single(id_)
+    if cached is not None:
+        return _json_body_response(request, *cached)
+    generation = response_cache.generation
+
+    async def query_sticker():
+        result = await conn.execute_fetchone(_select_sticker, sticker_id=id_)
+        if not result:
+            return None
+
+        body = request.app['sticker_encoder'].encode(result).encode('utf-8')
+        headers = {'ETag': _sticker_etag(result)}
+        response_cache.set_single(
+            id_, (body, headers), generation, _response_cache_ttl(request))
+        return body, headers
+
+    found = await _coalesced(request, conn, ('sticker', id_), query_sticker)
+    if found is None:
+        return web.Response(status=404)
+    return _json_body_response(request, *found)
+
+
+@require_lazy_postgresql_conn
 @require_auth_token
 @validate_post_schema(sticker_create_schema)
 async def handle_create(request, conn, user, data):
-    new_sticker = await conn.execute_fetchone(
-        sticker.insert().values(**data))
+    values = {'title': data['title'], 'description': data['description']}
+    write_batcher = request.app.get('write_batcher')
+    if write_batcher is None:
+        new_sticker = await conn.execute_fetchone(_insert_sticker, **values)
+        await _publish_wall_change(request, conn, 'create', new_sticker.id)
+    else:
+        # the batch is written with a connection of its own
+        await conn.release()
+        new_sticker = await write_batcher.add(values)
+        _apply_wall_change(request, {'action': 'create', 'id': new_sticker.id})
+
+    return _encoded_json_response(
+        request.app['sticker_encoder'].encode(new_sticker), status=201,
+        headers={'ETag': _sticker_etag(new_sticker)})
 
-    new_sticker = await conn.execute_fetchone(
-        sticker.select().where(sticker.c.id == new_sticker.id))
 
-    return json_response(_dump_sticker(new_sticker), status=201)
+@require_postgresql_conn
+@require_auth_token
+async def handle_batch_create(request, conn, user):
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        return web.Response(status=400)
+
+    max_size = request.app['config'].wall_batch_max_size
+    if not isinstance(data, list) or not 0 < len(data) <= max_size:
+        return json_response({
+            'error': 'expected an array of 1 to {} stickers'.format(max_size)
+        }, status=400)
+
+    validator = get_validator(sticker_create_schema)
+    errors = []
+    for i, item in enumerate(data):
+        error = validator.error(item)
+        if error is not None:
+            errors.append({'index': i, 'error': error.message})
+    if errors:
+        return json_response({'errors': errors}, status=400)
+
+    result = await conn.execute(sticker.insert().values([{
+        'title': x['title'],
+        'description': x['description'],
+    } for x in data]).returning(*sticker.c))
+    # ids are drawn in VALUES order, so this is the order of the request
+    rows = sorted(await result.fetchall(), key=lambda x: x.id)
+    await _publish_wall_change(request, conn, 'bulk')
+
+    return _encoded_json_response(
+        request.app['sticker_encoder'].encode_list(rows), status=201)
+
+
+class _ImportReport(object):
+    def __init__(self, max_errors):
+        self.max_errors = max_errors
+        self.imported = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line_no, error):
+        self.rejected += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line_no, 'error': error})
+
+    def dump(self):
+        return {
+            'imported': self.imported,
+            'rejected': self.rejected,
+            'errors': self.errors,
+        }
+
+
+class _NDJSONParser(object):
+    def parse(self, line):
+        return json.loads(line)
+
+
+class _CSVParser(object):
+    """Parses one CSV record per line, the first line is the header."""
+
+    def __init__(self):
+        self.header = None
+
+    def parse(self, line):
+        values = next(csv.reader([line]))
+        if self.header is None:
+            self.header = values
+            return None
+
+        if len(values) != len(self.header):
+            raise ValueError('expected {} fields, got {}'.format(
+                len(self.header), len(values)))
+        return dict(zip(self.header, values))
+
+
+class _LineTooLong(Exception):
+    """Line ``line_no`` of the body is longer than allowed."""
+
+    def __init__(self, line_no):
+        super().__init__(line_no)
+        self.line_no = line_no
+
+
+class _LineReader(object):
+    """Reads a body line by line, holding at most about ``max_length``
+    bytes of a line in memory."""
+
+    def __init__(self, content, max_length):
+        self.content = content
+        self.max_length = max_length
+        self.line_no = 0
+        self._buffer = bytearray()
+
+    async def readline(self):
+        """Return the next line, b'' at the end of the body, or raise
+        :class:`_LineTooLong`."""
+        buffer = self._buffer
+        searched = 0
+        while True:
+            end = buffer.find(b'\n', searched) + 1
+            if end or len(buffer) > self.max_length:
+                break
+            searched = len(buffer)
+            chunk = await self.content.readany()
+            if not chunk:
+                break
+            buffer.extend(chunk)
+        if not end:
+            end = len(buffer)
+
+        line = bytes(buffer[:end])
+        del buffer[:end]
+        if line:
+            self.line_no += 1
+            if len(line.rstrip(b'\r\n')) > self.max_length:
+                raise _LineTooLong(self.line_no)
+        return line
+
+
+async def _import_records(request, conn, parser, report):
+    config = request.app['config']
+    validator = get_validator(sticker_create_schema)
+    lines = _LineReader(
+        request.content, config.wall_import_max_line_length)
+
+    async def _flush(batch):
+        if batch:
+            result = await conn.execute(sticker.insert().values(batch))
+            report.imported += result.rowcount
+
+    batch = []
+    while True:
+        line = await lines.readline()
+        if not line:
+            break
+        line_no = lines.line_no
+
+        try:
+            line = line.decode('utf-8').rstrip('\r\n')
+        except UnicodeDecodeError:
+            report.reject(line_no, 'line is not valid UTF-8')
+            continue
+        if not line:
+            continue
+
+        try:
+            record = parser.parse(line)
+        except (ValueError, csv.Error) as e:
+            report.reject(line_no, str(e))
+            continue
+        if record is None:
+            continue
+
+        error = validator.error(record)
+        if error is not None:
+            report.reject(line_no, error.message)
+            continue
+
+        batch.append({
+            'title': record['title'],
+            'description': record['description'],
+        })
+        if len(batch) >= config.wall_import_batch_size:
+            await _flush(batch)
+            batch = []
+
+    await _flush(batch)
+
+
+@require_postgresql_conn
+@require_auth_token
+async def handle_import(request, conn, user):
+    """Import stickers from an NDJSON or CSV (with a header line) body.
+
+    The body is read line by line and inserted in batches within a single
+    transaction, so memory use doesn't depend on the size of the upload.
+    Invalid lines are skipped and reported. A line longer than
+    ``WALL_IMPORT_MAX_LINE_LENGTH`` bytes fails the whole import with 413.
+    """
+    if request.content_type == 'text/csv':
+        parser = _CSVParser()
+    else:
+        parser = _NDJSONParser()
+
+    config = request.app['config']
+    report = _ImportReport(config.wall_import_max_errors)
+    await conn.begin()
+    try:
+        await _import_records(request, conn, parser, report)
+        if report.imported:
+            await _publish_wall_change(request, conn, 'bulk')
+    except _LineTooLong as e:
+        await conn.rollback()
+        return json_response({
+            'error': 'line {} is longer than {} bytes'.format(
+                e.line_no, config.wall_import_max_line_length),
+        }, status=413)
+    except Exception:
+        await conn.rollback()
+        raise
+    await conn.commit()
+
+    return json_response(report.dump())
 
 
 @require_postgresql_conn
 @require_auth_token
 @validate_post_schema(sticker_create_schema)
 async def handle_put(request, conn, user, data):
-    id_ = request.match_info.get('id')
-    new_sticker = await conn.execute_fetchone(
-        sticker.select().where(sticker.c.id == id_))
-    if not new_sticker:
+    id_ = int(request.match_info['id'])
+    result = await conn.execute(
+        _update_sticker, sticker_id=id_, title=data['title'],
+        description=data['description'])
+    if not result.rowcount:
         return web.Response(status=404)
 
-    await conn.execute(sticker.update().where(
-        sticker.c.id == new_sticker.id).values(**data))
+    new_sticker = await result.fetchone()
+    await _publish_wall_change(request, conn, 'update', new_sticker.id)
 
-    new_sticker = await conn.execute_fetchone(
-        sticker.select().where(sticker.c.id == id_))
-    return json_response(_dump_sticker(new_sticker), status=201)
+    return _encoded_json_response(
+        request.app['sticker_encoder'].encode(new_sticker), status=201,
+        headers={'ETag': _sticker_etag(new_sticker)})
 
 
 @require_postgresql_conn
 @require_auth_token
 async def handle_delete(request, conn, user):
-    id_ = request.match_info.get('id')
-    x = await conn.execute(sticker.delete().where(sticker.c.id == id_))
-    return web.Response(status=204 if x.rowcount else 404)
+    id_ = int(request.match_info['id'])
+    x = await conn.execute(_delete_sticker, sticker_id=id_)
+    if not x.rowcount:
+        return web.Response(status=404)
+
+    await _publish_wall_change(request, conn, 'delete', id_)
+    return web.Response(status=204)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import psycopg2
+from .db import PoolTimeout, _acquire
+from .metrics import Histogram, DB_BUCKETS
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class WriteBatcher(object):
+    """Writes the rows of concurrent requests with one statement.
+
+    A row waits at most ``window`` seconds for others to join its batch,
+    a batch is written as soon as it holds ``max_size`` rows. ``write`` is
+    a coroutine function taking a connection and a list of values and
+    returning their rows, in the same order. Each batch has its own
+    connection of ``engine``, so the requests waiting for it hold none.
+    """
+
+    def __init__(self, engine, loop, write, window=.002, max_size=100,
+                 acquire_timeout=5):
+        self.engine = engine
+        self.loop = loop
+        self.write = write
+        self.window = window
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.flushes = {}
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        # from the row being added to its batch being written
+        self.wait_time = Histogram(DB_BUCKETS)
+        self._pending = []
+        self._timer = None
+        self._writing = set()
+
+    async def add(self, values):
+        """Return the row written for ``values``."""
+        future = asyncio.Future(loop=self.loop)
+        self._pending.append((values, future, self.loop.time()))
+        if len(self._pending) >= self.max_size:
+            self._flush('full')
+        elif self._timer is None:
+            self._timer = self.loop.call_later(
+                self.window, self._flush, 'window')
+        return await future
+
+    def _flush(self, reason):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        self.flushes[reason] = self.flushes.get(reason, 0) + 1
+        self.batch_sizes.observe(len(batch))
+        task = asyncio.ensure_future(self._write(batch), loop=self.loop)
+        self._writing.add(task)
+        task.add_done_callback(self._writing.discard)
+
+    def _resolve(self, item, row=None, exception=None):
+        _, future, added = item
+        self.wait_time.observe(self.loop.time() - added)
+        # the request may have gone meanwhile
+        if future.done():
+            return
+        if exception is None:
+            future.set_result(row)
+        else:
+            future.set_exception(exception)
+
+    async def _write(self, batch):
+        try:
+            conn = await asyncio.wait_for(
+                _acquire(self.engine), self.acquire_timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            for item in batch:
+                self._resolve(item, exception=PoolTimeout())
+            return
+
+        try:
+            try:
+                rows = await self.write(conn, [x[0] for x in batch])
+            except (psycopg2.DataError, psycopg2.IntegrityError):
+                if len(batch) == 1:
+                    raise
+                # one invalid row fails the statement, not the others
+                await self._write_each(conn, batch)
+                return
+        except Exception as e:
+            for item in batch:
+                self._resolve(item, exception=e)
+            return
+        finally:
+            await self.engine.release(conn)
+
+        for item, row in zip(batch, rows):
+            self._resolve(item, row)
+
+    async def _write_each(self, conn, batch):
+        for item in batch:
+            try:
+                [row] = await self.write(conn, [item[0]])
+            except Exception as e:
+                self._resolve(item, exception=e)
+            else:
+                self._resolve(item, row)
+
+    async def close(self):
+        """Write the pending rows and wait for the batches being written."""
+        self._flush('close')
+        if self._writing:
+            await asyncio.wait(self._writing, loop=self.loop)
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'writing': len(self._writing),
+            'flushes': dict(self.flushes),
+        }
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """Per-worker LRU cache whose entries expire after ``ttl`` seconds.
+
+    Every entry may also carry its own, earlier expiry. A ``maxsize`` of
+    zero disables the cache.
+    """
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expires is not None and expires <= self.clock():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+
+        if ttl is None or (self.ttl is not None and ttl > self.ttl):
+            ttl = self.ttl
+        if ttl is not None and ttl <= 0:
+            return
+
+        self._data[key] = (
+            value, None if ttl is None else self.clock() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class AuthCache(TTLCache):
+    """The authenticated tokens of a worker.
+
+    The logouts of the other workers reach it as the token events of a
+    :class:`~app.notify.WallListener`. Those sent while the listener is
+    down are lost, so revoked tokens may then keep working until their
+    entry expires.
+    """
+
+    def on_token_change(self, event):
+        action = event['action']
+        if action == 'revoke':
+            self.invalidate(event['token'])
+        elif action in ('connected', 'disconnected'):
+            self.clear()
+
+
+class ResponseCache(object):
+    """Serialized ``GET /wall`` responses of a worker.
+
+    It's invalidated by the wall change events of a
+    :class:`~app.notify.WallListener` and stays disabled while the listener
+    isn't connected, as changes made meanwhile would go unnoticed.
+    """
+
+    def __init__(self, maxsize):
+        self.enabled = False
+        self.generation = 0
+        self.lists = TTLCache(maxsize, None)
+        self.singles = TTLCache(maxsize, None)
+
+    def get_list(self, key):
+        return self.lists.get(key) if self.enabled else None
+
+    def get_single(self, sticker_id):
+        return self.singles.get(str(sticker_id)) if self.enabled else None
+
+    def set_list(self, key, value, generation, ttl=None):
+        # a change may have been missed if it happened during the query
+        if self.enabled and generation == self.generation:
+            self.lists.set(key, value, ttl)
+
+    def set_single(self, sticker_id, value, generation, ttl=None):
+        if self.enabled and generation == self.generation:
+            self.singles.set(str(sticker_id), value, ttl)
+
+    def on_wall_change(self, event):
+        self.generation += 1
+        self.lists.clear()
+
+        sticker_id = event.get('id')
+        if sticker_id is None:
+            self.singles.clear()
+        else:
+            self.singles.invalidate(str(sticker_id))
+
+        action = event['action']
+        if action == 'connected':
+            self.enabled = True
+        elif action == 'disconnected':
+            self.enabled = False
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'lists': self.lists.stats(),
+            'singles': self.singles.stats(),
+        }
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+
+class _Abandoned(Exception):
+    """The caller running a flight was cancelled before it finished."""
+
+
+class SingleFlight(object):
+    """Shares the result of a call among the concurrent callers asking
+    for the same key, per worker.
+
+    The first caller runs it, the ones coming while it's in flight wait
+    for its result, or its exception, instead of running it again. Once
+    it's done the next caller runs it anew, nothing is cached.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = {}
+
+    async def do(self, key, fn):
+        """Return the result of ``await fn()``, or of the call in flight
+        for ``key``."""
+        while True:
+            flight = self._flights.get(key)
+            if flight is None:
+                break
+            try:
+                # a waiter going away must not cancel it for the others
+                result = await asyncio.shield(flight, loop=self.loop)
+            except _Abandoned:
+                # run it ourselves
+                continue
+            self.coalesced += 1
+            return result
+
+        flight = self._flights[key] = asyncio.Future(loop=self.loop)
+        self.calls += 1
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            self._fail(flight, _Abandoned())
+            raise
+        except Exception as e:
+            self._fail(flight, e)
+            raise
+        else:
+            flight.set_result(result)
+            return result
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    @staticmethod
+    def _fail(flight, exception):
+        flight.set_exception(exception)
+        # retrieved, so it's not logged when nobody waited for it
+        flight.exception()
+
+    def on_wall_change(self, event):
+        # reads starting after a change must not get a result read before
+        self._flights.clear()
+
+    def stats(self):
+        return {
+            'in_flight': len(self._flights),
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+        }
@@ -1,13 +1,31 @@
 # -*- coding: utf-8 -*-
 import aiopg
 import asyncio
+import logging
+import math
+import psycopg2
+import re
+import time
+import weakref
+from aiohttp import web
 from aiopg.sa import create_engine, connection
+from aiopg.sa.engine import Engine, _dialect
+from aiopg.sa.result import ResultProxy
 from os import environ as env
 from functools import wraps
 import sqlalchemy as sa
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql import ClauseElement
+from sqlalchemy.sql.ddl import DDLElement
+from sqlalchemy.sql.dml import UpdateBase
+from .cache import TTLCache
+from .migrations import migrate
 
 
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger(__name__ + '.slow')
+query_trace_logger = logging.getLogger(__name__ + '.trace')
+
 metadata = sa.MetaData()
 
 sticker = sa.Table(
@@ -15,6 +33,9 @@ sticker = sa.Table(
     sa.Column('id', sa.Integer, primary_key=True),
     sa.Column('title', sa.String(255), nullable=False),
     sa.Column('description', sa.Text),
+    # drawn from a shared sequence on every write, used for ETags
+    sa.Column('version', sa.BigInteger, nullable=False,
+              server_default=sa.text("nextval('sticker_version_seq')")),
 )
 
 user = sa.Table(
@@ -22,6 +43,7 @@ user = sa.Table(
     sa.Column('id', sa.Integer, primary_key=True),
     sa.Column('username', sa.String(255), nullable=False),
     sa.Column('password', sa.String(255), nullable=False),
+    sa.Index('user_username_key', 'username', unique=True),
 )
 
 token = sa.Table(
@@ -30,53 +52,335 @@ token = sa.Table(
     sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
     sa.Column('token', sa.String(255), nullable=False),
     sa.Column('valid_until', sa.DateTime, nullable=False),
+    sa.Index('token_token_key', 'token', unique=True),
+    sa.Index('token_user_id_valid_until_idx', 'user_id', 'valid_until'),
+    sa.Index('token_valid_until_idx', 'valid_until'),
     # relationship('user', back_populates='tokens')
 )
 
+# DB tokens whose signed access tokens are refused until valid_until
+revoked_token = sa.Table(
+    'revoked_token', metadata,
+    sa.Column('token_id', sa.Integer, primary_key=True),
+    sa.Column('valid_until', sa.DateTime, nullable=False),
+)
+
 
 async def create_table(engine):
+    """Drop everything and migrate from scratch, for the tests."""
     async with engine.acquire() as conn:
+        await conn.execute('DROP TABLE IF EXISTS "schema_migrations"')
+        await conn.execute('DROP TABLE IF EXISTS "revoked_token"')
         await conn.execute('DROP TABLE IF EXISTS "token"')
         await conn.execute('DROP TABLE IF EXISTS "user"')
         await conn.execute('DROP TABLE IF EXISTS "sticker"')
-        await conn.execute(
-            '''CREATE TABLE sticker(
-              id serial PRIMARY KEY,
-              title varchar(255) not null,
-              description text
-            )'''
-        )
-        await conn.execute(
-            '''CREATE TABLE "user"(
-              id serial PRIMARY KEY,
-              username varchar(255) not null,
-              password varchar(255) not null
-            )'''
-        )
-        await conn.execute(
-            '''CREATE TABLE "token"(
-              id serial PRIMARY KEY,
-              user_id serial not null,
-              token varchar(255) not null,
-              valid_until timestamp not null,
-              CONSTRAINT user_id_fk FOREIGN KEY(user_id) REFERENCES "user" (id)
-            )'''
-        )
-
-
-async def connect_create_table(dsn, loop):
+        await conn.execute('DROP SEQUENCE IF EXISTS "sticker_version_seq"')
+    await migrate(engine)
+
+
+async def connect_migrate(dsn, loop):
     engine = await connect(dsn, loop=loop)
-    await create_table(engine)
+    try:
+        return await migrate(engine)
+    finally:
+        engine.close()
+        await engine.wait_closed()
 
 
-async def connect(dsn, loop=None):
-    conn = await create_engine(dsn, loop=loop)
+async def connect(dsn, loop=None, **pool_kwargs):
+    conn = await create_engine(dsn, loop=loop, **pool_kwargs)
     return conn
 
 
+async def connect_lazily(dsn, loop=None, **pool_kwargs):
+    """Like :func:`connect`, without connecting before the first acquire,
+    so the server may be down meanwhile."""
+    # create_engine() checks out a connection right away
+    pool = await aiopg.create_pool(dsn, loop=loop, minsize=0, **pool_kwargs)
+    return Engine(_dialect, pool, dsn)
+
+
+class PoolStats(object):
+    """Counters of the connection pool acquires and of the statements run
+    on the acquired connections, per worker."""
+
+    def __init__(self):
+        self.waiting = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.queries = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def record_acquire(self, wait_time):
+        self.acquired += 1
+        self.wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def stats(self, engine):
+        return {
+            'size': engine.size,
+            'in_use': engine.size - engine.freesize,
+            'waiting': self.waiting,
+            'acquired': self.acquired,
+            'timeouts': self.timeouts,
+            'queries': self.queries,
+            'wait_time': self.wait_time,
+            'max_wait_time': self.max_wait_time,
+        }
+
+
+async def _acquire(engine):
+    return await engine.acquire()
+
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# epoch until which the client's reads go to the primary
+PRIMARY_COOKIE = 'wallpost_primary_until'
+
+
+class ReplicaRouter(object):
+    """Sends the reads to the ``replica`` pool.
+
+    A client's reads stick to the primary for ``sticky_seconds`` after each
+    of its writes, so it sees them despite the replication lag. This is
+    kept in a cookie, which any worker can read. A replica that failed is
+    left alone for ``retry_interval`` seconds.
+    """
+
+    def __init__(self, replica, sticky_seconds=5, retry_interval=10,
+                 clock=time.monotonic, wall_clock=time.time):
+        self.replica = replica
+        self.sticky_seconds = sticky_seconds
+        self.retry_interval = retry_interval
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.failures = 0
+        self._down_until = None
+
+    @property
+    def healthy(self):
+        return self._down_until is None or self.clock() >= self._down_until
+
+    def mark_down(self):
+        self.failures += 1
+        self._down_until = self.clock() + self.retry_interval
+
+    def use_replica(self, request):
+        if request.method not in SAFE_METHODS or not self.healthy:
+            return False
+        try:
+            until = float(request.cookies.get(PRIMARY_COOKIE, 0))
+        except ValueError:
+            until = 0
+        return until <= self.wall_clock()
+
+    def stick_to_primary(self, response):
+        response.set_cookie(
+            PRIMARY_COOKIE,
+            '{:.3f}'.format(self.wall_clock() + self.sticky_seconds),
+            max_age=int(math.ceil(self.sticky_seconds)), httponly=True)
+
+
+_PYFORMAT_PARAM = re.compile(r'%\(([^)]+)\)s')
+
+
+class CompiledStatement(object):
+    def __init__(self, name, query, compiled):
+        self.name = name
+        # keeps the statement alive, so its id() can't be reused meanwhile
+        self.query = query
+        self.compiled = compiled
+        self.sql = str(compiled)
+        self.processors = compiled._bind_processors
+        self.result_map = compiled._result_columns
+
+        bind_names = []
+        for name in _PYFORMAT_PARAM.findall(self.sql):
+            if name not in bind_names:
+                bind_names.append(name)
+        prepared_sql = _PYFORMAT_PARAM.sub(
+            lambda m: '${}'.format(bind_names.index(m.group(1)) + 1),
+            self.sql).replace('%%', '%')
+
+        self.prepare_sql = 'PREPARE {} AS {}'.format(self.name, prepared_sql)
+        self.execute_sql = 'EXECUTE {}'.format(self.name)
+        if bind_names:
+            self.execute_sql += '({})'.format(', '.join(
+                '%({})s'.format(x) for x in bind_names))
+
+    def process_params(self, params):
+        processors = self.processors
+        return {
+            k: processors[k](v) if k in processors else v
+            for k, v in self.compiled.construct_params(params).items()
+        }
+
+
+class StatementCache(object):
+    """Compiled SQL of SQLAlchemy statements, per worker.
+
+    Statements are keyed by identity and by the names of the parameters
+    they are executed with, so they pay off for statements defined once at
+    module level and executed with bind parameters. With ``prepare`` set,
+    every pooled connection also gets a server-side prepared statement the
+    first time it runs a cached statement.
+    """
+
+    def __init__(self, maxsize, prepare=False):
+        self.prepare = prepare
+        self.compile_time = 0.0
+        self._entries = TTLCache(maxsize, None)
+        self._prepared = weakref.WeakKeyDictionary()
+        self._counter = 0
+
+    def compile(self, query, keys, dialect):
+        key = (id(query), keys)
+        entry = self._entries.get(key)
+        if entry is None:
+            started = time.perf_counter()
+            compiled = _compile(query, keys, dialect)
+            self.compile_time += time.perf_counter() - started
+
+            self._counter += 1
+            entry = CompiledStatement(
+                'wallpost_{}'.format(self._counter), query, compiled)
+            self._entries.set(key, entry)
+        return entry
+
+    def prepared_on(self, raw_connection):
+        return self._prepared.setdefault(raw_connection, set())
+
+    def stats(self):
+        stats = self._entries.stats()
+        avg_compile_time = self.compile_time / max(stats['misses'], 1)
+        stats.update({
+            'compile_time': self.compile_time,
+            'compile_time_saved': avg_compile_time * stats['hits'],
+            'prepared': sum(len(x) for x in self._prepared.values()),
+        })
+        return stats
+
+
+class QueryTrace(object):
+    """The statements executed during one request.
+
+    Only the SQL, with its placeholders, is kept and logged; the bound
+    parameters never are.
+    """
+
+    def __init__(self, slow_threshold=None, budget=None, repeat_limit=3):
+        self.slow_threshold = slow_threshold
+        self.budget = budget
+        self.repeat_limit = repeat_limit
+        self.queries = []
+        self.total_time = 0.0
+
+    def record(self, sql, duration, rowcount):
+        sql = sql if isinstance(sql, str) else str(sql)
+        self.queries.append((sql, duration, rowcount))
+        self.total_time += duration
+        if self.slow_threshold is not None and \
+                duration >= self.slow_threshold:
+            slow_query_logger.warning(
+                'Slow query %.1fms, %s rows: %s', duration * 1000, rowcount,
+                sql)
+
+    def problems(self):
+        """Query patterns worth a look: more statements than the budget
+        and the same statement run over and over, usually a N+1."""
+        problems = []
+        if self.budget is not None and len(self.queries) > self.budget:
+            problems.append('{} queries, the budget is {}'.format(
+                len(self.queries), self.budget))
+
+        counts = {}
+        for sql, _, _ in self.queries:
+            counts[sql] = counts.get(sql, 0) + 1
+        for sql, count in sorted(counts.items()):
+            if count >= self.repeat_limit:
+                problems.append('{} times: {}'.format(count, sql))
+        return problems
+
+    def server_timing(self):
+        return 'db;dur={:.2f};desc="{} queries"'.format(
+            self.total_time * 1000, len(self.queries))
+
+
+def _compile(query, keys, dialect):
+    if isinstance(query, UpdateBase):
+        # only the given columns end up in VALUES/SET
+        return query.compile(dialect=dialect, column_keys=list(keys))
+    return query.compile(dialect=dialect)
+
+
 class ExtendedSAConnection(connection.SAConnection):
-    async def execute_fetchone(self, query):
-        result = await self.execute(query)
+    statement_cache = None
+    pool_stats = None
+    metrics = None
+    trace = None
+
+    async def execute(self, query, *multiparams, **params):
+        if self.pool_stats is not None:
+            self.pool_stats.queries += 1
+        if self.metrics is None and self.trace is None:
+            result, _ = await self._execute_statement(
+                query, *multiparams, **params)
+            return result
+
+        started = time.perf_counter()
+        try:
+            result, sql = await self._execute_statement(
+                query, *multiparams, **params)
+        finally:
+            duration = time.perf_counter() - started
+            if self.metrics is not None:
+                self.metrics.db_query_time.observe(duration)
+        if self.trace is not None:
+            self.trace.record(sql, duration, result.rowcount)
+        return result
+
+    async def _execute_statement(self, query, *multiparams, **params):
+        """Return the result of ``query`` and the SQL it was run as."""
+        if (not isinstance(query, ClauseElement) or
+                isinstance(query, DDLElement) or
+                multiparams and not (
+                    len(multiparams) == 1 and
+                    isinstance(multiparams[0], dict))):
+            result = await super().execute(query, *multiparams, **params)
+            return result, query
+
+        if multiparams:
+            params = dict(multiparams[0], **params)
+
+        keys = tuple(sorted(params))
+        cache = self.statement_cache
+        if isinstance(getattr(query, 'parameters', None), list):
+            # multi-row VALUES are built per call, caching them is a waste
+            cache = None
+        if cache is None:
+            entry = CompiledStatement(
+                None, query, _compile(query, keys, self._dialect))
+        else:
+            entry = cache.compile(query, keys, self._dialect)
+
+        cursor = await self._connection.cursor()
+        parameters = entry.process_params(params)
+        if cache is not None and cache.prepare:
+            prepared = cache.prepared_on(self._connection)
+            if entry.name not in prepared:
+                await cursor.execute(entry.prepare_sql)
+                prepared.add(entry.name)
+            await cursor.execute(entry.execute_sql, parameters)
+        else:
+            await cursor.execute(entry.sql, parameters)
+
+        return ResultProxy(
+            self, cursor, self._dialect, entry.result_map), entry.sql
+
+    async def execute_fetchone(self, query, *multiparams, **params):
+        result = await self.execute(query, *multiparams, **params)
         return await result.fetchone()
 
     async def begin(self):
@@ -89,17 +393,204 @@ class ExtendedSAConnection(connection.SAConnection):
         return await self.execute('ROLLBACK')
 
 
-def require_postgresql_conn(f):
+class ServerSideCursor(object):
+    """Iterate over the rows of ``query`` in batches of ``batch_size``.
+
+    psycopg2 doesn't support named cursors on asynchronous connections, so
+    the cursor is declared with plain SQL inside its own transaction and
+    drained with ``FETCH``. Only one batch is held in memory at a time.
+    """
+
+    def __init__(self, conn, query, name, batch_size):
+        self.conn = conn
+        self.query = query
+        self.name = name
+        self.batch_size = batch_size
+
+    async def __aenter__(self):
+        compiled = self.query.compile(dialect=self.conn._dialect)
+        await self.conn.begin()
+        try:
+            await self.conn.execute(
+                'DECLARE "{}" NO SCROLL CURSOR FOR {}'.format(
+                    self.name, compiled),
+                compiled.params)
+        except Exception:
+            await self.conn.rollback()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.conn.commit()
+        else:
+            await self.conn.rollback()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        result = await self.conn.execute('FETCH FORWARD {} FROM "{}"'.format(
+            self.batch_size, self.name))
+        rows = await result.fetchall()
+        if not rows:
+            raise StopAsyncIteration
+        return rows
+
+
+def _report_trace(request, response, trace):
+    # streamed responses have sent their headers already
+    if not response.prepared:
+        response.headers['Server-Timing'] = '{}, db-acquire;dur={:.2f}'.format(
+            trace.server_timing(),
+            request.get('db_acquire_time', 0.0) * 1000)
+
+    for problem in trace.problems():
+        query_trace_logger.warning(
+            '%s %s: %s', request.method, request.path, problem)
+
+
+async def _acquire_from(request, connection):
+    pool_stats = request.app['db_pool_stats']
+    started = time.perf_counter()
+    pool_stats.waiting += 1
+    try:
+        conn = await asyncio.wait_for(
+            _acquire(connection),
+            request.app['config'].postgresql_pool_acquire_timeout,
+            loop=request.app.loop)
+    finally:
+        pool_stats.waiting -= 1
+
+    wait_time = time.perf_counter() - started
+    pool_stats.record_acquire(wait_time)
+    request['db_acquire_time'] = wait_time
+    metrics = request.app.get('metrics')
+    if metrics is not None:
+        metrics.db_acquire_time.observe(wait_time)
+    return conn
+
+
+class PoolTimeout(Exception):
+    """No connection of the pool was free in time."""
+
+
+class RequestConnection(object):
+    """The connection of a request, acquired from the pool the first time
+    a statement is executed, so requests answered from memory don't wait
+    for one.
+
+    Reads go to the replica when the app's :class:`ReplicaRouter` allows
+    it, or to the primary if the replica fails to hand out a connection.
+    With ``primary`` they always go to the primary.
+    """
+
+    def __init__(self, request, primary=False):
+        self.request = request
+        self.router = request.app.get('db_router')
+        # where the statements go, or would
+        self.replica = not primary and self.router is not None and \
+            self.router.use_replica(request)
+        self.engine = None
+        self.conn = None
+
+    async def get(self):
+        if self.conn is None:
+            await self._acquire()
+        return self.conn
+
+    async def _acquire(self):
+        request = self.request
+        if self.replica:
+            engine = self.router.replica
+            try:
+                conn = await _acquire_from(request, engine)
+            except (asyncio.TimeoutError, psycopg2.Error, OSError):
+                logger.warning(
+                    'Read replica unavailable, reading from the primary',
+                    exc_info=True)
+                self.router.mark_down()
+                self.replica = False
+            request['db_replica'] = self.replica
+
+        if not self.replica:
+            engine = request.app.db
+            try:
+                conn = await _acquire_from(request, engine)
+            except asyncio.TimeoutError:
+                request.app['db_pool_stats'].timeouts += 1
+                raise PoolTimeout()
+
+        conn.__class__ = ExtendedSAConnection
+        conn.statement_cache = request.app['statement_cache']
+        conn.pool_stats = request.app['db_pool_stats']
+        conn.metrics = request.app.get('metrics')
+        conn.trace = request.get('query_trace')
+        self.engine = engine
+        self.conn = conn
+
+    async def execute(self, query, *multiparams, **params):
+        conn = await self.get()
+        return await conn.execute(query, *multiparams, **params)
+
+    async def execute_fetchone(self, query, *multiparams, **params):
+        conn = await self.get()
+        return await conn.execute_fetchone(query, *multiparams, **params)
+
+    async def release(self):
+        if self.conn is not None:
+            self.conn.trace = None
+            await self.engine.release(self.conn)
+            self.conn = None
+
+
+def _postgresql_conn(f, lazy):
     @wraps(f)
     async def fun(request, *args, **kwargs):
-        connection = request.app.db
-        async with connection.acquire() as conn:
-            conn.__class__ = ExtendedSAConnection
-            return await f(request, *args, **kwargs, conn=conn)
+        config = request.app['config']
+        if config.query_trace_enabled:
+            request['query_trace'] = QueryTrace(
+                config.slow_query_threshold,
+                config.query_budget if config.query_trace_dev else None)
+
+        pending = RequestConnection(request)
+        try:
+            conn = pending if lazy else await pending.get()
+            response = await f(request, *args, **kwargs, conn=conn)
+        except PoolTimeout:
+            # shed load rather than queueing until the client gives up
+            return web.Response(status=503, headers={'Retry-After': '1'})
+        except psycopg2.OperationalError:
+            if pending.replica:
+                pending.router.mark_down()
+            raise
+        finally:
+            await pending.release()
+
+        if 'query_trace' in request:
+            _report_trace(request, response, request['query_trace'])
+        if pending.router is not None and \
+                request.method not in SAFE_METHODS and \
+                response.status < 400 and not response.prepared:
+            pending.router.stick_to_primary(response)
+        return response
 
     return fun
 
 
-def create_db(loop):
+def require_postgresql_conn(f):
+    """Pass ``f`` a connection of the pool as ``conn``."""
+    return _postgresql_conn(f, lazy=False)
+
+
+def require_lazy_postgresql_conn(f):
+    """Pass ``f`` a :class:`RequestConnection` as ``conn``, for handlers
+    that may not need the database. Only its ``execute`` and
+    ``execute_fetchone`` are available until ``await conn.get()``
+    returned the connection itself."""
+    return _postgresql_conn(f, lazy=True)
+
+
+def migrate_db(loop):
     dsn = env.get('POSTGRESQL_URL')
-    loop.run_until_complete(connect_create_table(dsn, loop))
+    return loop.run_until_complete(connect_migrate(dsn, loop))
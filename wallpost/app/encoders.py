@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlalchemy as sa
+from json.encoder import encode_basestring_ascii
+
+
+def _encode_bool(value):
+    return 'true' if value else 'false'
+
+
+def _encode_datetime(value):
+    return '"' + value.isoformat() + '"'
+
+
+def _encode_row_source(fields):
+    """Python source of a function encoding one row as a JSON object.
+
+    ``fields`` are ``(key, nullable)`` pairs, the value encoder of every
+    field is expected as ``_e<index>`` in the namespace of the function.
+    """
+    args = ''.join(', _e{0}=_e{0}'.format(i) for i in range(len(fields)))
+    lines = ['def encode_row(row{}):'.format(args)]
+    parts = []
+    for i, (key, nullable) in enumerate(fields):
+        lines.append('    v{} = row[{!r}]'.format(i, key))
+        value = '_e{0}(v{0})'.format(i)
+        if nullable:
+            value = "('null' if v{0} is None else {1})".format(i, value)
+        prefix = ('{' if i == 0 else ',') + json.dumps(key) + ':'
+        parts += [repr(prefix), value]
+    parts.append(repr('}'))
+    lines.append('    return ' + ' + '.join(parts))
+    return '\n'.join(lines)
+
+
+class RowEncoder(object):
+    """Encodes result rows straight into JSON objects keyed by the names
+    of ``columns``.
+
+    A function encoding one row is generated once from the columns, so no
+    intermediate dict is built per row and the value encoder of every
+    column is picked up front. Strings and columns of other types go
+    through ``dumps``, which can be replaced by a faster, ``json.dumps``
+    compatible, backend.
+    """
+
+    def __init__(self, columns, dumps=json.dumps):
+        columns = list(columns)
+        self.dumps = dumps
+
+        namespace = {
+            '_e{}'.format(i): self._value_encoder(x.type)
+            for i, x in enumerate(columns)}
+        source = _encode_row_source([(x.name, x.nullable) for x in columns])
+        exec(compile(source, '<row encoder>', 'exec'), namespace)
+        self.encode = namespace['encode_row']
+
+    def _value_encoder(self, type_):
+        if isinstance(type_, sa.Boolean):
+            return _encode_bool
+        if isinstance(type_, sa.Integer):
+            return int.__repr__
+        if isinstance(type_, sa.DateTime):
+            return _encode_datetime
+        if isinstance(type_, sa.String) and self.dumps is json.dumps:
+            # what json.dumps ends up calling for a str, minus its overhead
+            return encode_basestring_ascii
+        return self.dumps
+
+    def encode_items(self, rows, separator=','):
+        """Encode ``rows`` one after another, joined with ``separator``."""
+        return separator.join(map(self.encode, rows))
+
+    def encode_list(self, rows):
+        return '[' + self.encode_items(rows) + ']'
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import json
+import logging
+from aiohttp import web
+from .admission import unlimited_concurrency
+from .app import require_auth_token
+from .db import require_lazy_postgresql_conn
+
+
+logger = logging.getLogger(__name__)
+
+# ``data`` is sent over WebSocket, ``sse`` is the same event framed for
+# Server-Sent Events; both are built once for all the subscribers.
+LiveEvent = collections.namedtuple('LiveEvent', ('data', 'sse'))
+
+
+def live_event(event):
+    data = json.dumps(event, separators=(',', ':'))
+    return LiveEvent(data, 'event: {}\ndata: {}\n\n'.format(
+        event['action'], data).encode('utf-8'))
+
+
+# Events were lost, the client has to fetch GET /wall again. Sent when a
+# client falls behind and when the LISTEN connection comes back.
+RESYNC = live_event({'action': 'resync'})
+
+_CLOSED = object()
+
+_KEEPALIVE = b':\n\n'
+
+
+class Subscriber(object):
+    """The events not sent to one client yet, ``queue_size`` at most.
+
+    When it's full the queued events are dropped for a single
+    :data:`RESYNC`, so a slow client costs a bounded amount of memory.
+    """
+
+    def __init__(self, loop, queue_size):
+        self.queue = asyncio.Queue(queue_size, loop=loop)
+        self.resyncs = 0
+
+    def _replace_queued(self, item):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(item)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.resyncs += 1
+            self._replace_queued(RESYNC)
+
+    def close(self):
+        self._replace_queued(_CLOSED)
+
+    async def get(self):
+        """The next :class:`LiveEvent`, ``None`` once closed."""
+        event = await self.queue.get()
+        if event is _CLOSED:
+            # for the next callers too
+            self.queue.put_nowait(event)
+            return None
+        return event
+
+
+class WallBroadcaster(object):
+    """Fans the events of the worker's :class:`~app.notify.WallListener`
+    out to the clients of ``GET /wall/stream``, at most
+    ``max_subscribers`` of them."""
+
+    def __init__(self, loop, max_subscribers=10000, queue_size=100):
+        self.loop = loop
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.published = 0
+        self.resyncs = 0
+        self.dropped = 0
+
+    def subscribe(self):
+        """A new :class:`Subscriber`, or ``None`` if there are too many."""
+        if len(self.subscribers) >= self.max_subscribers:
+            return None
+        subscriber = Subscriber(self.loop, self.queue_size)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        self.resyncs += subscriber.resyncs
+
+    def on_wall_change(self, event):
+        action = event['action']
+        if action == 'disconnected':
+            # followed by a connected event, which resyncs everybody
+            return
+        live = RESYNC if action == 'connected' else live_event(event)
+
+        self.published += 1
+        for subscriber in self.subscribers:
+            subscriber.put(live)
+
+    def close(self):
+        for subscriber in self.subscribers:
+            subscriber.close()
+
+    def stats(self):
+        return {
+            'subscribers': len(self.subscribers),
+            'published': self.published,
+            'resyncs': self.resyncs + sum(
+                x.resyncs for x in self.subscribers),
+            'dropped': self.dropped,
+        }
+
+
+class _EventSourceChannel(object):
+    def __init__(self, request):
+        self.request = request
+        self.response = web.StreamResponse(headers={
+            'Cache-Control': 'no-cache',
+            # or nginx would buffer the events
+            'X-Accel-Buffering': 'no',
+        })
+
+    async def prepare(self, subscriber):
+        self.response.content_type = 'text/event-stream'
+        self.response.enable_chunked_encoding()
+        await self.response.prepare(self.request)
+        # the headers are only sent along with the first chunk, the client
+        # would wait for them until the first event otherwise
+        await self.send(None)
+        return self.response
+
+    async def send(self, event):
+        # comments keep proxies from closing an idle stream
+        self.response.write(_KEEPALIVE if event is None else event.sse)
+        await self.response.drain()
+
+    async def close(self):
+        pass
+
+
+class _WebSocketChannel(object):
+    def __init__(self, request):
+        self.request = request
+        self.response = web.WebSocketResponse()
+        self._receiving = None
+
+    async def prepare(self, subscriber):
+        await self.response.prepare(self.request)
+        self._receiving = asyncio.ensure_future(
+            self._receive(subscriber), loop=self.request.app.loop)
+        return self.response
+
+    async def _receive(self, subscriber):
+        # clients send nothing but the close frame has to be read
+        async for _ in self.response:  # noqa
+            pass
+        subscriber.close()
+
+    async def send(self, event):
+        if event is None:
+            self.response.ping()
+        else:
+            await self.response.send_str(event.data)
+
+    async def close(self):
+        if self._receiving is not None:
+            self._receiving.cancel()
+        await self.response.close()
+
+
+def _is_websocket(request):
+    return request.headers.get('Upgrade', '').lower() == 'websocket'
+
+
+async def _send_events(request, subscriber, channel):
+    config = request.app['config']
+    while True:
+        try:
+            event = await asyncio.wait_for(
+                subscriber.get(), config.wall_live_keepalive_interval,
+                loop=request.app.loop)
+        except asyncio.TimeoutError:
+            event = None
+        else:
+            if event is None:
+                return
+
+        try:
+            await asyncio.wait_for(
+                channel.send(event), config.wall_live_send_timeout,
+                loop=request.app.loop)
+        except asyncio.TimeoutError:
+            # its socket buffers are full, don't wait for it any longer
+            request.app['wall_broadcaster'].dropped += 1
+            logger.info('Dropped a wall stream client not reading')
+            return
+
+
+@unlimited_concurrency
+@require_lazy_postgresql_conn
+@require_auth_token
+async def handle_wall_stream(request, conn, user):
+    """Push the wall changes to the client, as Server-Sent Events or over
+    a WebSocket if it asks to upgrade.
+
+    Events are ``{"action": ..., "id": ...}``. ``bulk`` ones, with no
+    ``id``, call for fetching GET /wall again like ``resync`` does.
+    """
+    # the stream may last hours, don't hold a connection of the pool
+    await conn.release()
+
+    broadcaster = request.app['wall_broadcaster']
+    subscriber = broadcaster.subscribe()
+    if subscriber is None:
+        return web.Response(status=503, headers={'Retry-After': '10'})
+
+    channel = (_WebSocketChannel if _is_websocket(request)
+               else _EventSourceChannel)(request)
+    try:
+        response = await channel.prepare(subscriber)
+        await _send_events(request, subscriber, channel)
+        await channel.close()
+    finally:
+        broadcaster.unsubscribe(subscriber)
+    return response
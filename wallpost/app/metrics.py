@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+import time
+from aiohttp import web
+from bisect import bisect_left
+from .admission import unlimited_concurrency
+
+
+REQUEST_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+DB_BUCKETS = (
+    .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last count is for the values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """``(le, count)`` pairs as exposed by Prometheus."""
+        total = 0
+        for le, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield le, total
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v))
+                          for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsWriter(object):
+    """Builds the Prometheus text exposition format."""
+
+    def __init__(self, prefix='wallpost_'):
+        self.prefix = prefix
+        self.lines = []
+
+    def _header(self, name, kind, help_):
+        self.lines.append('# HELP {}{} {}'.format(self.prefix, name, help_))
+        self.lines.append('# TYPE {}{} {}'.format(self.prefix, name, kind))
+
+    def samples(self, name, kind, help_, samples):
+        """``samples`` are ``(labels, value)`` pairs, labels being
+        ``(name, value)`` pairs."""
+        self._header(name, kind, help_)
+        for labels, value in samples:
+            self.lines.append('{}{}{} {}'.format(
+                self.prefix, name, _labels(labels), _format_value(value)))
+
+    def histograms(self, name, help_, histograms):
+        """``histograms`` are ``(labels, Histogram)`` pairs."""
+        self._header(name, 'histogram', help_)
+        for labels, histogram in histograms:
+            for le, count in histogram.cumulative():
+                self.lines.append('{}{}_bucket{} {}'.format(
+                    self.prefix, name,
+                    _labels(labels + (('le', _format_value(le)),)), count))
+            self.lines.append('{}{}_sum{} {}'.format(
+                self.prefix, name, _labels(labels),
+                _format_value(histogram.sum)))
+            self.lines.append('{}{}_count{} {}'.format(
+                self.prefix, name, _labels(labels), histogram.count))
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+class Metrics(object):
+    """Request and DB timings of one worker.
+
+    Only touched from the event loop, so plain dicts and counters do
+    without locks. Each worker exposes its own values.
+    """
+
+    def __init__(self):
+        self.requests = {}
+        self.request_time = {}
+        self.db_acquire_time = Histogram(DB_BUCKETS)
+        self.db_query_time = Histogram(DB_BUCKETS)
+
+    def record_request(self, route, method, status, duration):
+        key = (route, method, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+        histogram = self.request_time.get((route, method))
+        if histogram is None:
+            histogram = self.request_time[(route, method)] = Histogram(
+                REQUEST_BUCKETS)
+        histogram.observe(duration)
+
+    def write(self, writer):
+        writer.samples(
+            'http_requests_total', 'counter',
+            'Requests handled, per route, method and status.',
+            [((('route', route), ('method', method), ('status', status)), x)
+             for (route, method, status), x in sorted(self.requests.items())])
+        writer.histograms(
+            'http_request_duration_seconds',
+            'Time spent handling requests, per route and method.',
+            [((('route', route), ('method', method)), x)
+             for (route, method), x in sorted(self.request_time.items())])
+        writer.histograms(
+            'db_pool_acquire_seconds',
+            'Time waited for a connection of the pool.',
+            [((), self.db_acquire_time)])
+        writer.histograms(
+            'db_query_seconds', 'Time spent executing statements.',
+            [((), self.db_query_time)])
+
+
+def route_name(request):
+    """The path template of the route matched by ``request``."""
+    route = request.match_info.route
+    resource = getattr(route, 'resource', None)
+    if resource is None:
+        # nothing matched, don't create a series per requested path
+        return 'unmatched'
+    info = resource.get_info()
+    return info.get('formatter') or info.get('path') or 'unknown'
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        request.app['metrics'].record_request(
+            route_name(request), request.method, status,
+            time.perf_counter() - started)
+
+
+def _write_app_stats(writer, app):
+    pool = app['db_pool_stats'].stats(app.db)
+    writer.samples(
+        'db_pool_connections', 'gauge', 'Connections of the pool.', [
+            ((('state', 'open'),), pool['size']),
+            ((('state', 'in_use'),), pool['in_use'])])
+    writer.samples(
+        'db_pool_waiting', 'gauge', 'Requests waiting for a connection.',
+        [((), pool['waiting'])])
+    writer.samples(
+        'db_pool_acquire_timeouts_total', 'counter',
+        'Requests answered 503 for lack of a connection.',
+        [((), pool['timeouts'])])
+    writer.samples(
+        'db_queries_total', 'counter', 'Statements executed by requests.',
+        [((), pool['queries'])])
+
+    caches = [
+        ('auth', app['auth_cache'].stats()),
+        ('statement', app['statement_cache'].stats()),
+        ('response_list', app['response_cache'].stats()['lists']),
+        ('response_single', app['response_cache'].stats()['singles']),
+    ]
+    for name, help_ in (('hits', 'Cache hits.'), ('misses', 'Cache misses.')):
+        writer.samples(
+            'cache_{}_total'.format(name), 'counter', help_,
+            [((('cache', cache),), stats[name]) for cache, stats in caches])
+    writer.samples(
+        'cache_entries', 'gauge', 'Entries held by the cache.',
+        [((('cache', cache),), stats['size']) for cache, stats in caches])
+
+    if app['single_flight'] is not None:
+        writer.samples(
+            'coalesced_reads_total', 'counter',
+            'Reads answered with the result of an identical one in flight.',
+            [((), app['single_flight'].stats()['coalesced'])])
+
+    live = app['wall_broadcaster'].stats()
+    writer.samples(
+        'wall_stream_clients', 'gauge', 'Clients of GET /wall/stream.',
+        [((), live['subscribers'])])
+    writer.samples(
+        'wall_stream_resyncs_total', 'counter',
+        'Events dropped for a resync, the client falling behind.',
+        [((), live['resyncs'])])
+    writer.samples(
+        'wall_stream_dropped_total', 'counter',
+        'Wall stream clients disconnected for not reading.',
+        [((), live['dropped'])])
+
+    if 'write_batcher' in app:
+        batcher = app['write_batcher']
+        writer.histograms(
+            'create_batch_size', 'Stickers inserted per batch.',
+            [((), batcher.batch_sizes)])
+        writer.histograms(
+            'create_batch_wait_seconds',
+            'Time a create waited for its batch to be written.',
+            [((), batcher.wait_time)])
+        writer.samples(
+            'create_batch_flushes_total', 'counter',
+            'Batches written, per reason: full, window or close.',
+            [((('reason', reason),), count)
+             for reason, count in sorted(batcher.flushes.items())])
+
+    if 'admission_budgets' in app:
+        budgets = sorted(
+            (name, x.stats()) for name, x in app['admission_budgets'].items())
+        writer.samples(
+            'requests_in_flight', 'gauge',
+            'Requests being handled, per budget.',
+            [((('budget', name),), stats['in_flight'])
+             for name, stats in budgets])
+        writer.samples(
+            'requests_rejected_total', 'counter',
+            'Requests answered 429 for their token\'s rate limit or 503 '
+            'for the concurrency limit, per budget.',
+            [((('budget', name), ('reason', reason)), stats[key])
+             for name, stats in budgets
+             for reason, key in (('rate_limit', 'rate_limited'),
+                                 ('overload', 'shed'))])
+
+    if 'token_sweeper' in app:
+        writer.samples(
+            'tokens_reclaimed_total', 'counter',
+            'Expired tokens deleted by the sweeper.',
+            [((), app['token_sweeper'].stats()['reclaimed'])])
+    writer.samples(
+        'password_hash_timeouts_total', 'counter',
+        'Logins answered 503 waiting for password hashing.',
+        [((), app['password_hasher'].timeouts)])
+
+
+@unlimited_concurrency
+async def handle_metrics(request):
+    writer = MetricsWriter()
+    request.app['metrics'].write(writer)
+    _write_app_stats(writer, request.app)
+    return web.Response(
+        body=writer.render().encode('utf-8'),
+        headers={'Content-Type': CONTENT_TYPE})
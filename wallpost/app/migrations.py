@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock key, so concurrent deploys don't migrate at the same time
+MIGRATIONS_LOCK_ID = 58250001
+
+# Forward only: never edit an applied migration, append a new one instead.
+MIGRATIONS = [
+    # The schema create_table used to make. Databases created by it are
+    # taken over as they are.
+    (1, 'initial schema', [
+        'CREATE SEQUENCE IF NOT EXISTS sticker_version_seq',
+        '''CREATE TABLE IF NOT EXISTS sticker(
+          id serial PRIMARY KEY,
+          title varchar(255) not null,
+          description text,
+          version bigint not null default nextval('sticker_version_seq')
+        )''',
+        # 9.5 has no ADD COLUMN IF NOT EXISTS; existing rows each get
+        # their own version
+        '''DO $$
+        BEGIN
+          IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema()
+              AND table_name = 'sticker' AND column_name = 'version'
+          ) THEN
+            ALTER TABLE sticker ADD COLUMN
+              version bigint not null default nextval('sticker_version_seq');
+          END IF;
+        END
+        $$''',
+        'ALTER SEQUENCE sticker_version_seq OWNED BY sticker.version',
+        '''CREATE TABLE IF NOT EXISTS "user"(
+          id serial PRIMARY KEY,
+          username varchar(255) not null,
+          password varchar(255) not null
+        )''',
+        '''CREATE TABLE IF NOT EXISTS "token"(
+          id serial PRIMARY KEY,
+          user_id integer not null,
+          token varchar(255) not null,
+          valid_until timestamp not null,
+          CONSTRAINT user_id_fk FOREIGN KEY(user_id) REFERENCES "user" (id)
+        )''',
+    ]),
+    # require_auth_token looks tokens up by value, handle_login users by
+    # username and their tokens by user_id and valid_until.
+    (2, 'lookup indexes', [
+        'CREATE UNIQUE INDEX token_token_key ON "token" (token)',
+        'CREATE UNIQUE INDEX user_username_key ON "user" (username)',
+        '''CREATE INDEX token_user_id_valid_until_idx
+          ON "token" (user_id, valid_until)''',
+    ]),
+    # TokenSweeper deletes by valid_until alone
+    (3, 'token expiry index', [
+        'CREATE INDEX token_valid_until_idx ON "token" (valid_until)',
+    ]),
+    # revocations of signed access tokens, see app.tokens.RevocationList
+    (4, 'revoked tokens', [
+        '''CREATE TABLE revoked_token(
+          token_id integer PRIMARY KEY,
+          valid_until timestamp not null
+        )''',
+    ]),
+    # GET /wall?q=, the expression has to stay the one of _search_document
+    # in app.app (9.5 has no generated columns)
+    (5, 'sticker search index', [
+        '''CREATE INDEX sticker_search_idx ON sticker USING gin (
+          to_tsvector('simple', title || ' ' || coalesce(description, ''))
+        )''',
+    ]),
+]
+
+
+class MigrationError(Exception):
+    pass
+
+
+async def applied_versions(conn):
+    result = await conn.execute(
+        'SELECT version FROM schema_migrations ORDER BY version')
+    rows = await result.fetchall()
+    return [x.version for x in rows]
+
+
+async def _apply(conn, version, name, statements):
+    await conn.execute('BEGIN')
+    try:
+        for statement in statements:
+            await conn.execute(statement)
+        await conn.execute(
+            'INSERT INTO schema_migrations (version, name) '
+            'VALUES (%(version)s, %(name)s)',
+            {'version': version, 'name': name})
+    except Exception:
+        await conn.execute('ROLLBACK')
+        raise
+    await conn.execute('COMMIT')
+
+
+async def migrate(engine, migrations=MIGRATIONS):
+    """Apply the ``migrations`` not applied yet, each in its own
+    transaction, and return their versions."""
+    applied = []
+    async with engine.acquire() as conn:
+        await conn.execute(
+            'SELECT pg_advisory_lock(%(id)s)', {'id': MIGRATIONS_LOCK_ID})
+        try:
+            await conn.execute(
+                '''CREATE TABLE IF NOT EXISTS schema_migrations(
+                  version integer PRIMARY KEY,
+                  name varchar(255) not null,
+                  applied_at timestamp not null default now()
+                )''')
+            done = set(await applied_versions(conn))
+            unknown = done - {x[0] for x in migrations}
+            if unknown:
+                raise MigrationError(
+                    'Database has migrations this code does not know: '
+                    '{}'.format(sorted(unknown)))
+
+            for version, name, statements in migrations:
+                if version in done:
+                    continue
+                logger.info('Applying migration %s: %s', version, name)
+                await _apply(conn, version, name, statements)
+                applied.append(version)
+        finally:
+            await conn.execute(
+                'SELECT pg_advisory_unlock(%(id)s)',
+                {'id': MIGRATIONS_LOCK_ID})
+    return applied
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import aiopg
+import asyncio
+import json
+import logging
+from sqlalchemy import select, func, bindparam, column
+
+
+logger = logging.getLogger(__name__)
+
+WALL_CHANNEL = 'wall_changes'
+TOKEN_CHANNEL = 'token_changes'
+
+_notify = select([func.pg_notify(bindparam('channel'), bindparam('payload'))])
+
+_notify_many = select([
+    func.pg_notify(bindparam('channel'), column('payload'))
+]).select_from(func.unnest(bindparam('payloads')).alias('payload'))
+
+
+async def notify_wall_change(conn, event):
+    """Publish ``event`` to every worker's :class:`WallListener`.
+
+    Inside a transaction the notification is only delivered on commit.
+    """
+    await conn.execute(
+        _notify, channel=WALL_CHANNEL, payload=json.dumps(event))
+
+
+async def notify_wall_changes(conn, events):
+    """:func:`notify_wall_change` of all ``events`` with one statement."""
+    await conn.execute(
+        _notify_many, channel=WALL_CHANNEL,
+        payloads=[json.dumps(x) for x in events])
+
+
+async def notify_token_revoked(conn, token_value):
+    """Have every worker's auth cache forget the DB token ``token_value``."""
+    await conn.execute(_notify, channel=TOKEN_CHANNEL, payload=json.dumps(
+        {'action': 'revoke', 'token': token_value}))
+
+
+class WallListener(object):
+    """Holds one LISTEN connection per worker and hands the wall change
+    events, and those of the tokens, to the callbacks subscribed to their
+    channel.
+
+    Notifications sent while the connection is down are lost, so the
+    subscribers get a ``disconnected`` event when it drops and a
+    ``connected`` one once it's listening again.
+    """
+
+    def __init__(self, dsn, loop, keepalive_interval=30, retry_interval=1):
+        self.dsn = dsn
+        self.loop = loop
+        self.keepalive_interval = keepalive_interval
+        self.retry_interval = retry_interval
+        self.connected = False
+        self._callbacks = {WALL_CHANNEL: [], TOKEN_CHANNEL: []}
+        self._task = None
+        self._stopping = False
+
+    def subscribe(self, callback, channel=WALL_CHANNEL):
+        self._callbacks[channel].append(callback)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run(), loop=self.loop)
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping = True
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _dispatch(self, event, channel=None):
+        """Hand ``event`` to the subscribers of ``channel``, or of all the
+        channels."""
+        for name, callbacks in self._callbacks.items():
+            if channel is not None and name != channel:
+                continue
+            for callback in callbacks:
+                try:
+                    callback(event)
+                except Exception:
+                    logger.exception('%s callback failed', name)
+
+    def _set_connected(self, connected):
+        if connected != self.connected:
+            self.connected = connected
+            self._dispatch({
+                'action': 'connected' if connected else 'disconnected'})
+
+    async def _listen(self, conn):
+        cur = await conn.cursor()
+        for channel in self._callbacks:
+            await cur.execute('LISTEN {}'.format(channel))
+        self._set_connected(True)
+
+        while True:
+            try:
+                msg = await asyncio.wait_for(
+                    conn.notifies.get(), self.keepalive_interval,
+                    loop=self.loop)
+            except asyncio.TimeoutError:
+                # a dead connection wouldn't deliver anything, so check it
+                await cur.execute('SELECT 1')
+                continue
+
+            try:
+                event = json.loads(msg.payload)
+            except ValueError:
+                logger.warning(
+                    'Invalid %s payload %r', msg.channel, msg.payload)
+                continue
+            self._dispatch(event, msg.channel)
+
+    async def _run(self):
+        while True:
+            try:
+                conn = await aiopg.connect(self.dsn, loop=self.loop)
+                try:
+                    await self._listen(conn)
+                finally:
+                    self._set_connected(False)
+                    conn.close()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if self._stopping:
+                    # cancelled while connecting, aiopg raises psycopg2's
+                    # error about it instead
+                    return
+                logger.exception('Wall LISTEN connection failed, retrying')
+                await asyncio.sleep(self.retry_interval, loop=self.loop)
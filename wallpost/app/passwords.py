@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+
+ALGORITHM = 'pbkdf2_sha256'
+
+
+def hash_password(password, iterations, salt=None):
+    """Return ``algorithm$iterations$salt$hash`` of ``password``."""
+    if salt is None:
+        salt = base64.b64encode(os.urandom(12)).decode('ascii')
+    digest = hashlib.pbkdf2_hmac(
+        'sha256', password.encode('utf-8'), salt.encode('ascii'), iterations)
+    return '{}${}${}${}'.format(
+        ALGORITHM, iterations, salt,
+        base64.b64encode(digest).decode('ascii'))
+
+
+def _split(encoded):
+    parts = encoded.split('$')
+    if len(parts) != 4 or parts[0] != ALGORITHM:
+        # stored before passwords were hashed
+        return None
+    return int(parts[1]), parts[2]
+
+
+def verify_password(password, encoded):
+    split = _split(encoded)
+    if split is None:
+        return hmac.compare_digest(
+            password.encode('utf-8'), encoded.encode('utf-8'))
+
+    iterations, salt = split
+    return hmac.compare_digest(
+        hash_password(password, iterations, salt).encode('ascii'),
+        encoded.encode('ascii'))
+
+
+def needs_rehash(encoded, iterations):
+    split = _split(encoded)
+    return split is None or split[0] != iterations
+
+
+class PasswordHasher(object):
+    """Hashes and verifies passwords in a thread pool, off the event loop.
+
+    pbkdf2_hmac releases the GIL, so the loop keeps serving other requests
+    meanwhile. At most ``concurrency`` logins hash at a time, see
+    :meth:`limit`.
+    """
+
+    def __init__(self, loop, iterations, concurrency=2, wait_timeout=5):
+        self.loop = loop
+        self.iterations = iterations
+        self.wait_timeout = wait_timeout
+        self.semaphore = asyncio.Semaphore(concurrency, loop=loop)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.timeouts = 0
+
+    async def hash(self, password):
+        return await self.loop.run_in_executor(
+            self.executor, hash_password, password, self.iterations)
+
+    async def verify(self, password, encoded):
+        return await self.loop.run_in_executor(
+            self.executor, verify_password, password, encoded)
+
+    def needs_rehash(self, encoded):
+        return needs_rehash(encoded, self.iterations)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def limit_password_hashing(f):
+    """Wait for a free slot of the app's :class:`PasswordHasher` before
+    calling ``f``, or answer 503 after ``wait_timeout`` seconds.
+
+    Meant to be put above require_postgresql_conn, so a login storm holds
+    at most ``concurrency`` pool connections and doesn't starve the other
+    endpoints.
+    """
+    @wraps(f)
+    async def fun(request, *args, **kwargs):
+        hasher = request.app['password_hasher']
+        try:
+            await asyncio.wait_for(
+                hasher.semaphore.acquire(), hasher.wait_timeout,
+                loop=request.app.loop)
+        except asyncio.TimeoutError:
+            hasher.timeouts += 1
+            return web.Response(status=503, headers={'Retry-After': '1'})
+
+        try:
+            return await f(request, *args, **kwargs)
+        finally:
+            hasher.semaphore.release()
+
+    return fun
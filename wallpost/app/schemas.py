@@ -24,7 +24,8 @@ refresh_token_schema = {
 sticker_create_schema = {
     'type': 'object',
     'properties': {
-        'title': {'type': 'string'},
+        # the length of the column
+        'title': {'type': 'string', 'maxLength': 255},
         'description': {'type': 'string'},
     },
     'required': ['title', 'description'],
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+from datetime import datetime
+from sqlalchemy import select, bindparam
+from .db import token, revoked_token
+
+
+logger = logging.getLogger(__name__)
+
+# SKIP LOCKED lets the sweepers of all the workers run at the same time,
+# each deleting rows the others haven't picked.
+_delete_expired_tokens = token.delete().where(token.c.id.in_(
+    select([token.c.id]).where(
+        token.c.valid_until < bindparam('now')
+    ).limit(bindparam('batch_size')).with_for_update(skip_locked=True)))
+
+# only holds revocations until the access tokens expire, so it stays small
+_delete_expired_revocations = revoked_token.delete().where(
+    revoked_token.c.valid_until < bindparam('now'))
+
+
+class TokenSweeper(object):
+    """Deletes the expired tokens every ``interval`` seconds, at most
+    ``batch_size`` rows per statement so locks are held briefly."""
+
+    def __init__(self, engine, loop, interval=60, batch_size=500):
+        self.engine = engine
+        self.loop = loop
+        self.interval = interval
+        self.batch_size = batch_size
+        self.runs = 0
+        self.reclaimed = 0
+        self.last_reclaimed = 0
+        self.errors = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run(), loop=self.loop)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def sweep(self):
+        """Delete the tokens expired by now, return how many were."""
+        now = datetime.utcnow()
+        deleted = 0
+        async with self.engine.acquire() as conn:
+            while True:
+                result = await conn.execute(
+                    _delete_expired_tokens, now=now,
+                    batch_size=self.batch_size)
+                deleted += result.rowcount
+                # rows locked by another worker are left to it
+                if result.rowcount < self.batch_size:
+                    break
+            await conn.execute(_delete_expired_revocations, now=now)
+
+        self.runs += 1
+        self.reclaimed += deleted
+        self.last_reclaimed = deleted
+        if deleted:
+            logger.info('Deleted %s expired tokens', deleted)
+        return deleted
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval, loop=self.loop)
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                logger.exception('Expired token sweep failed')
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'reclaimed': self.reclaimed,
+            'last_reclaimed': self.last_reclaimed,
+            'errors': self.errors,
+        }
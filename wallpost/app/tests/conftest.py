@@ -35,11 +35,18 @@ def event_loop(loop):
     loop.close = loop._close
 
 
+async def wait_for_listener(app):
+    while not app['wall_listener'].connected:
+        await asyncio.sleep(0.01)
+
+
 @pytest.fixture
 def test_client_auth(
         loop, test_client, app, fixt_auth_header, fixt_db_user, fixt_db_token
 ):
     client_task = loop.run_until_complete(test_client(app))
+    # the caches are cleared once the LISTEN connection is up
+    loop.run_until_complete(wait_for_listener(app))
 
     def auth_method(obj, method_name):
         """ Monkey-patch original method """
@@ -65,6 +72,7 @@ def test_client_auth(
 @pytest.fixture
 def test_client_no_auth(loop, test_client, app):
     client_task = loop.run_until_complete(test_client(app))
+    loop.run_until_complete(wait_for_listener(app))
     yield client_task
 
 
@@ -166,6 +174,19 @@ def fixt_db_wall_item(loop, fixt_wall_item, db_connection):
     return loop.run_until_complete(add())
 
 
+class FakeClock(object):
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
 class Any(object):
     def __eq__(self, x):
         return True
@@ -185,7 +206,9 @@ class AlmostSimilarDateTime(object):
     def __eq__(self, x):
         y = self.expected
         if isinstance(x, str):
-            x = datetime.strptime(x, '%Y-%m-%dT%H:%M:%S.%f')
+            # isoformat() leaves the microseconds out when there are none
+            x = datetime.strptime(
+                x, '%Y-%m-%dT%H:%M:%S.%f' if '.' in x else '%Y-%m-%dT%H:%M:%S')
 
         if y < x:
             x, y = y, x
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import pytest
+from app.admission import RateLimiter, ConcurrencyLimit
+
+
+def test_rate_limit_burst(clock):
+    limiter = RateLimiter(2, 3, clock=clock)
+
+    assert [limiter.acquire('a') for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire('a') == .5
+    # other tokens have their own bucket
+    assert limiter.acquire('b') == 0
+    assert limiter.limited == 1
+
+
+def test_rate_limit_refill(clock):
+    limiter = RateLimiter(2, 3, clock=clock)
+    for _ in range(3):
+        limiter.acquire('a')
+
+    clock.now = .75
+    assert limiter.acquire('a') == 0
+    assert limiter.acquire('a') == pytest.approx(.25)
+
+    # refilled up to the burst only
+    clock.now = 100
+    assert [limiter.acquire('a') for _ in range(4)] == [0, 0, 0, .5]
+
+
+def test_rate_limit_forgets_buckets(clock):
+    limiter = RateLimiter(2, 3, maxsize=2, clock=clock)
+    for key in 'abc':
+        limiter.acquire(key)
+    # the least recently used
+    assert limiter.buckets.get('a') is None
+
+    # full again by then
+    clock.now = 1.5
+    assert limiter.buckets.get('b') is None
+
+
+def test_concurrency_limit():
+    limit = ConcurrencyLimit(2)
+
+    assert limit.enter() and limit.enter()
+    assert not limit.enter()
+    limit.leave()
+    assert limit.enter()
+    assert (limit.in_flight, limit.shed) == (2, 1)
+
+    unlimited = ConcurrencyLimit(0)
+    assert all(unlimited.enter() for _ in range(100))
@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import logging
 import pytest
 import json
 from datetime import datetime, timedelta
-from app.db import sticker, user, token
-from app.app import safe_unpack
-from app.tests.conftest import Any, AlmostSimilarDateTime
+from os import environ as env
+from app import create, Main
+from app.db import (
+    connect, create_table, sticker, user, token, PRIMARY_COOKIE
+)
+from app.app import safe_unpack, _LineReader, _LineTooLong
+from app.notify import notify_wall_change, WallListener
+from app.sweeper import TokenSweeper
+from app.tests.conftest import Any, AlmostSimilarDateTime, wait_for_listener
 
 
 @pytest.mark.parametrize('data,count,expected', (
@@ -75,6 +83,52 @@ async def test_login_not_existing(test_client_no_auth):
     assert resp.status == 404
 
 
+async def test_login_wrong_password(test_client_no_auth, fixt_db_user):
+    resp = await test_client_no_auth.post('/login', data=json.dumps({
+        'username': 'TestUserName',
+        'password': 'b',
+    }))
+
+    assert resp.status == 404
+
+
+async def test_login_rehashes_legacy_password(
+        app, test_client_no_auth, fixt_db_user, db_connection
+):
+    for _ in range(2):
+        resp = await test_client_no_auth.post('/login', data=json.dumps({
+            'username': 'TestUserName',
+            'password': 'a',
+        }))
+        assert resp.status == 200
+
+        result = list(await db_connection.execute(user.select()))
+        assert result[0].password.startswith('pbkdf2_sha256${}$'.format(
+            app['config'].password_hash_iterations))
+
+
+async def test_login_waits_for_password_hashing(
+        app, test_client_auth, fixt_db_user
+):
+    hasher = app['password_hasher']
+    hasher.wait_timeout = 0.05
+    # every slot taken by a login storm
+    while not hasher.semaphore.locked():
+        await hasher.semaphore.acquire()
+
+    resp = await test_client_auth.original_post('/login', data=json.dumps({
+        'username': 'TestUserName',
+        'password': 'a',
+    }))
+    assert resp.status == 503
+    assert resp.headers['Retry-After'] == '1'
+    assert hasher.timeouts == 1
+
+    # reads don't wait for it
+    resp = await test_client_auth.get('/wall')
+    assert resp.status == 200
+
+
 async def test_login_returns_valid_token(
         test_client_no_auth, fixt_db_user, fixt_db_token
 ):
@@ -116,6 +170,27 @@ async def test_login_creates_new_token(
     assert result[0].valid_until == expected_datetime
 
 
+async def test_login_skips_expired_token(
+        test_client_no_auth, fixt_db_user, db_connection
+):
+    await db_connection.execute(token.insert().values(
+        token='Expired', user_id=fixt_db_user.id,
+        valid_until=datetime.utcnow() - timedelta(seconds=1)))
+    await db_connection.commit()
+
+    resp = await test_client_no_auth.post('/login', data=json.dumps({
+        'username': 'TestUserName',
+        'password': 'a',
+    }))
+
+    assert resp.status == 200
+
+    data = await resp.json()
+    assert data['token'] != 'Expired'
+    assert data['valid_until'] == AlmostSimilarDateTime(
+        datetime.utcnow() + timedelta(minutes=60))
+
+
 async def test_token_required_fields(test_client_no_auth):
     resp = await test_client_no_auth.post('/token', data=json.dumps({}))
 
@@ -139,6 +214,57 @@ async def test_token_bumps_token(test_client_no_auth, fixt_db_token):
     }
 
 
+async def test_token_not_existing(test_client_no_auth):
+    resp = await test_client_no_auth.post(
+        '/token', data=json.dumps({'token': 'NotExisting'}))
+
+    assert resp.status == 404
+
+
+async def test_token_invalidates_auth_cache(
+        app, test_client_auth, fixt_db_token
+):
+    resp = await test_client_auth.get('/wall')
+    assert resp.status == 200
+    assert app['auth_cache'].get(fixt_db_token.token) is not None
+
+    resp = await test_client_auth.post(
+        '/token', data=json.dumps({'token': fixt_db_token.token}))
+    assert resp.status == 200
+    assert app['auth_cache'].get(fixt_db_token.token) is None
+
+
+async def test_auth_token_cached(app, test_client_auth, db_connection):
+    resp = await test_client_auth.get('/wall')
+    assert resp.status == 200
+
+    await db_connection.execute(token.delete())
+    await db_connection.commit()
+
+    resp = await test_client_auth.get('/wall')
+    assert resp.status == 200
+    assert app['auth_cache'].stats()['hits'] == 1
+
+
+async def test_token_sweeper_deletes_expired(
+        app, loop, test_client_auth, fixt_db_user, db_connection
+):
+    for i in range(2):
+        await db_connection.execute(token.insert().values(
+            token='Expired{}'.format(i), user_id=fixt_db_user.id,
+            valid_until=datetime.utcnow() - timedelta(seconds=1)))
+    await db_connection.commit()
+
+    sweeper = TokenSweeper(app.db, loop, batch_size=1)
+    assert await sweeper.sweep() == 2
+    assert await sweeper.sweep() == 0
+
+    result = list(await db_connection.execute(token.select()))
+    assert [x.token for x in result] == ['TestToken']
+    assert sweeper.stats() == {
+        'runs': 2, 'reclaimed': 2, 'last_reclaimed': 0, 'errors': 0}
+
+
 async def test_list_wall_empty(test_client_auth):
     resp = await test_client_auth.get('/wall')
 
@@ -168,6 +294,200 @@ async def test_list_wall(test_client_auth, db_connection, fixt_wall_item):
     ]
 
 
+async def test_list_wall_paginated(
+        test_client_auth, db_connection, fixt_wall_item
+):
+    ids = []
+    for _ in range(3):
+        new_sticker = await db_connection.execute_fetchone(
+            sticker.insert().values(**fixt_wall_item))
+        ids.append(new_sticker.id)
+    await db_connection.commit()
+
+    resp = await test_client_auth.get('/wall?limit=2')
+
+    assert resp.status == 200
+    assert resp.headers['Link'].endswith(
+        '?after={}&limit=2>; rel="next"'.format(ids[1]))
+
+    data = await resp.json()
+    assert [x['id'] for x in data] == ids[:2]
+
+    resp = await test_client_auth.get('/wall?limit=2&after={}'.format(ids[1]))
+
+    assert resp.status == 200
+    assert 'Link' not in resp.headers
+
+    data = await resp.json()
+    assert [x['id'] for x in data] == ids[2:]
+
+
+@pytest.mark.parametrize('query', (
+    'limit=0',
+    'limit=abc',
+    'after=abc',
+    'limit=100000',
+))
+async def test_list_wall_invalid_page(test_client_auth, query):
+    resp = await test_client_auth.get('/wall?{}'.format(query))
+
+    assert resp.status == 400
+
+
+async def _add_stickers(db_connection, stickers):
+    result = await db_connection.execute(sticker.insert().values([
+        {'title': title, 'description': description}
+        for title, description in stickers]).returning(sticker.c.id))
+    rows = await result.fetchall()
+    await db_connection.commit()
+    return sorted(x.id for x in rows)
+
+
+async def test_search_wall_ranked(test_client_auth, db_connection):
+    ids = await _add_stickers(db_connection, (
+        ('Groceries', 'milk and bread'),
+        ('Milk', 'buy milk, the oat milk'),
+        ('Call mum', None),
+        ('Bread', 'Milk'),
+    ))
+
+    resp = await test_client_auth.get('/wall?q=milk')
+
+    assert resp.status == 200
+    data = await resp.json()
+    assert [x['id'] for x in data] == [ids[1], ids[0], ids[3]]
+
+
+async def test_search_wall_prefix(test_client_auth, db_connection):
+    ids = await _add_stickers(db_connection, (
+        ('Groceries', 'milk and bread'),
+        ('Call mum', None),
+    ))
+
+    resp = await test_client_auth.get('/wall?q=Milk%20BRE')
+
+    data = await resp.json()
+    assert [x['id'] for x in data] == [ids[0]]
+
+
+async def test_search_wall_paginated(test_client_auth, db_connection):
+    ids = await _add_stickers(db_connection, [('Sticker', None)] * 3)
+
+    resp = await test_client_auth.get('/wall?q=stick&limit=2')
+    data = await resp.json()
+    assert [x['id'] for x in data] == ids[:2]
+
+    assert resp.headers['Link'].endswith(
+        '?q=stick&offset=2&limit=2>; rel="next"')
+
+    resp = await test_client_auth.get('/wall?q=stick&offset=2&limit=2')
+    data = await resp.json()
+    assert [x['id'] for x in data] == ids[2:]
+    assert 'Link' not in resp.headers
+
+
+class FewSearchMatchesConfig(Main):
+    wall_search_max_matches = 2
+
+
+async def test_search_wall_newest_matches(
+        loop, test_client, fixt_db_token, db_connection
+):
+    ids = await _add_stickers(db_connection, [('Sticker', None)] * 3)
+    client = await test_client(create(loop, FewSearchMatchesConfig))
+
+    resp = await client.get(
+        '/wall?q=stick', headers={'Authorization': 'Token TestToken'})
+    data = await resp.json()
+    assert [x['id'] for x in data] == ids[1:]
+
+
+@pytest.mark.parametrize('query', (
+    'q=',
+    'q=%21%3A%26',
+    'q=ab',
+    'q=milk%20ab',
+    'q=abc&offset=abc',
+    'q=abc&offset=-1',
+    'q=abc&offset=1000',
+))
+async def test_search_wall_invalid(test_client_auth, query):
+    resp = await test_client_auth.get('/wall?{}'.format(query))
+
+    assert resp.status == 400
+
+
+async def test_search_wall_short_prefix(test_client_auth, db_connection):
+    await _add_stickers(db_connection, (('Milk', None),))
+
+    resp = await test_client_auth.get('/wall?q=mi')
+
+    assert resp.status == 400
+    assert await resp.json() == {
+        'error': 'the last word of q must have at least 3 characters'}
+
+
+async def test_list_wall_stream(
+        test_client_auth, db_connection, fixt_wall_item
+):
+    for _ in range(3):
+        await db_connection.execute(sticker.insert().values(**fixt_wall_item))
+    await db_connection.commit()
+
+    resp = await test_client_auth.get('/wall?stream=1')
+
+    assert resp.status == 200
+
+    data = await resp.json()
+    assert data == [{'id': Any(), **fixt_wall_item}] * 3
+
+
+async def test_list_wall_stream_empty(test_client_auth):
+    resp = await test_client_auth.get('/wall?stream=1')
+
+    assert resp.status == 200
+
+    data = await resp.json()
+    assert data == []
+
+
+async def test_list_wall_stream_off(test_client_auth):
+    resp = await test_client_auth.get('/wall?stream=0')
+
+    assert resp.status == 200
+    assert 'ETag' in resp.headers
+
+
+@pytest.mark.parametrize('query', ('stream=', 'stream=true', 'stream=2'))
+async def test_list_wall_stream_invalid(test_client_auth, query):
+    resp = await test_client_auth.get('/wall?{}'.format(query))
+
+    assert resp.status == 400
+
+
+async def test_export_wall(test_client_auth, db_connection, fixt_wall_item):
+    for _ in range(3):
+        await db_connection.execute(sticker.insert().values(**fixt_wall_item))
+    await db_connection.commit()
+
+    resp = await test_client_auth.get('/wall/export')
+
+    assert resp.status == 200
+    assert resp.content_type == 'application/x-ndjson'
+
+    lines = (await resp.text()).split('\n')
+    assert lines[-1] == ''
+    assert [json.loads(x) for x in lines[:-1]] == [
+        {'id': Any(), **fixt_wall_item}] * 3
+
+
+async def test_export_wall_empty(test_client_auth):
+    resp = await test_client_auth.get('/wall/export')
+
+    assert resp.status == 200
+    assert await resp.text() == ''
+
+
 async def test_single_wall_not_found(test_client_auth, db_connection):
     resp = await test_client_auth.get('/wall/123')
 
@@ -188,6 +508,225 @@ async def test_single_wall(test_client_auth, db_connection, fixt_wall_item):
     assert data == {'id': new_sticker.id, **fixt_wall_item}
 
 
+async def test_single_wall_etag(
+        test_client_auth, db_connection, fixt_wall_item
+):
+    new_sticker = await db_connection.execute_fetchone(
+        sticker.insert().values(**fixt_wall_item).returning(*sticker.c))
+    await db_connection.commit()
+
+    url = '/wall/{}'.format(new_sticker.id)
+    resp = await test_client_auth.get(url)
+
+    assert resp.status == 200
+    etag = resp.headers['ETag']
+    assert etag == '"{}-{}"'.format(new_sticker.id, new_sticker.version)
+
+    resp = await test_client_auth.original_get(url, headers={
+        'Authorization': 'Token TestToken', 'If-None-Match': etag})
+
+    assert resp.status == 304
+    assert resp.headers['ETag'] == etag
+
+    resp = await test_client_auth.put(url, data=json.dumps(fixt_wall_item))
+
+    assert resp.status == 201
+    assert resp.headers['ETag'] != etag
+
+    resp = await test_client_auth.original_get(url, headers={
+        'Authorization': 'Token TestToken', 'If-None-Match': etag})
+
+    assert resp.status == 200
+
+
+async def test_list_wall_etag(test_client_auth, fixt_wall_item):
+    resp = await test_client_auth.get('/wall')
+
+    assert resp.status == 200
+    etag = resp.headers['ETag']
+
+    headers = {'Authorization': 'Token TestToken', 'If-None-Match': etag}
+    resp = await test_client_auth.original_get('/wall', headers=headers)
+
+    assert resp.status == 304
+
+    resp = await test_client_auth.original_get(
+        '/wall?limit=1', headers=headers)
+
+    assert resp.status == 200
+
+    resp = await test_client_auth.post(
+        '/wall', data=json.dumps(fixt_wall_item))
+    assert resp.status == 201
+
+    resp = await test_client_auth.original_get('/wall', headers=headers)
+
+    assert resp.status == 200
+    assert resp.headers['ETag'] != etag
+
+
+async def test_list_wall_etag_of_page(test_client_auth, fixt_wall_item):
+    for _ in range(3):
+        resp = await test_client_auth.post(
+            '/wall', data=json.dumps(fixt_wall_item))
+    resp = await test_client_auth.get('/wall?limit=1')
+    etag = resp.headers['ETag']
+
+    # past the page and the row telling there is a next one
+    resp = await test_client_auth.put('/wall/3', data=json.dumps({
+        'title': 'New', 'description': 'Desc'}))
+    assert resp.status == 201
+    resp = await test_client_auth.get('/wall?limit=1')
+    assert resp.headers['ETag'] == etag
+
+    resp = await test_client_auth.put('/wall/1', data=json.dumps({
+        'title': 'New', 'description': 'Desc'}))
+    resp = await test_client_auth.get('/wall?limit=1')
+    assert resp.headers['ETag'] != etag
+
+
+async def test_wall_listener_stopped_while_connecting(loop):
+    listener = WallListener(Main.postgresql_dsn, loop)
+    listener.start()
+    # into aiopg.connect(), the connection isn't up yet
+    await asyncio.sleep(0, loop=loop)
+
+    await asyncio.wait_for(listener.stop(), 5, loop=loop)
+
+
+async def test_list_wall_response_cache(
+        app, test_client_auth, fixt_wall_item
+):
+    await wait_for_listener(app)
+
+    resp = await test_client_auth.get('/wall')
+    assert await resp.json() == []
+
+    acquired = app['db_pool_stats'].acquired
+    resp = await test_client_auth.get('/wall')
+    assert await resp.json() == []
+    assert app['response_cache'].stats()['lists']['hits'] == 1
+    # answered without a connection
+    assert app['db_pool_stats'].acquired == acquired
+
+    resp = await test_client_auth.post(
+        '/wall', data=json.dumps(fixt_wall_item))
+    assert resp.status == 201
+
+    resp = await test_client_auth.get('/wall')
+    assert await resp.json() == [{'id': Any(), **fixt_wall_item}]
+
+
+async def _read_event(resp):
+    lines = []
+    while not lines or lines[-1]:
+        lines.append((await resp.content.readline()).decode('utf-8').strip())
+    if lines == [':', '']:
+        # a keepalive
+        return await _read_event(resp)
+    return lines[:-1]
+
+
+async def test_wall_stream_events(app, test_client_auth, fixt_wall_item):
+    await wait_for_listener(app)
+    resp = await test_client_auth.get('/wall/stream')
+    assert resp.status == 200
+    assert resp.headers['Content-Type'] == 'text/event-stream'
+
+    created = await test_client_auth.post(
+        '/wall', data=json.dumps(fixt_wall_item))
+    id_ = (await created.json())['id']
+    await test_client_auth.delete('/wall/{}'.format(id_))
+
+    assert await _read_event(resp) == [
+        'event: create',
+        'data: {"action":"create","id":%d}' % id_]
+    assert await _read_event(resp) == [
+        'event: delete',
+        'data: {"action":"delete","id":%d}' % id_]
+    resp.close()
+
+
+async def test_wall_stream_websocket(
+        app, test_client_auth, fixt_auth_header, fixt_wall_item
+):
+    await wait_for_listener(app)
+    # ws_connect adds the upgrade headers to the dict it's given
+    ws = await test_client_auth.ws_connect(
+        '/wall/stream', headers=dict(fixt_auth_header['headers']))
+
+    created = await test_client_auth.post(
+        '/wall', data=json.dumps(fixt_wall_item))
+    msg = await ws.receive()
+    assert json.loads(msg.data) == {
+        'action': 'create', 'id': (await created.json())['id']}
+
+    await ws.close()
+    while app['wall_broadcaster'].subscribers:
+        await asyncio.sleep(0.01)
+
+
+async def test_wall_stream_requires_auth(test_client_no_auth):
+    resp = await test_client_no_auth.get('/wall/stream')
+    assert resp.status == 401
+
+
+async def test_single_wall_invalidated_by_notify(
+        app, test_client_auth, db_connection, fixt_db_wall_item
+):
+    await wait_for_listener(app)
+    url = '/wall/{}'.format(fixt_db_wall_item.id)
+
+    resp = await test_client_auth.get(url)
+    assert (await resp.json())['title'] == 'Hi'
+
+    # a write made by another worker
+    generation = app['response_cache'].generation
+    await db_connection.execute(sticker.update().where(
+        sticker.c.id == fixt_db_wall_item.id).values(title='Changed'))
+    await notify_wall_change(
+        db_connection, {'action': 'update', 'id': fixt_db_wall_item.id})
+    await db_connection.commit()
+    while app['response_cache'].generation == generation:
+        await asyncio.sleep(0.01)
+
+    resp = await test_client_auth.get(url)
+    assert (await resp.json())['title'] == 'Changed'
+
+
+class NoResponseCacheConfig(Main):
+    response_cache_size = 0
+
+
+async def test_single_wall_coalesced(
+        loop, test_client, fixt_db_token, fixt_db_wall_item
+):
+    app = create(loop, NoResponseCacheConfig)
+    client = await test_client(app)
+    headers = {'Authorization': 'Token TestToken'}
+    url = '/wall/{}'.format(fixt_db_wall_item.id)
+    # cache the token, so the reads only differ by when they come
+    await wait_for_listener(app)
+    await client.get(url, headers=headers)
+    queries = app['db_pool_stats'].queries
+    stats = app['single_flight'].stats()
+
+    responses = await asyncio.gather(*[
+        client.get(url, headers=headers) for _ in range(10)], loop=loop)
+
+    assert [x.status for x in responses] == [200] * 10
+    bodies = set()
+    for x in responses:
+        bodies.add(await x.text())
+    assert len(bodies) == 1
+    new_stats = app['single_flight'].stats()
+    calls = new_stats['calls'] - stats['calls']
+    coalesced = new_stats['coalesced'] - stats['coalesced']
+    assert calls + coalesced == 10
+    assert app['db_pool_stats'].queries - queries == calls
+    assert new_stats['in_flight'] == 0
+
+
 async def test_create_wall(test_client_auth, db_connection, fixt_wall_item):
     resp = await test_client_auth.post(
         '/wall', data=json.dumps(fixt_wall_item))
@@ -222,6 +761,201 @@ async def test_create_wall_invalid_data(
     assert len(result) == 0
 
 
+class BatchedCreatesConfig(Main):
+    wall_create_batch_window = 0.05
+
+
+async def test_create_wall_batched(
+        loop, test_client, fixt_db_token, db_connection
+):
+    app = create(loop, BatchedCreatesConfig)
+    client = await test_client(app)
+    headers = {'Authorization': 'Token TestToken'}
+
+    responses = await asyncio.gather(*[
+        client.post('/wall', headers=headers, data=json.dumps({
+            'title': title, 'description': 'Desc'}))
+        for title in ('a', 'b' * 300, 'c')], loop=loop)
+
+    # the invalid one is rejected before joining the batch
+    assert [x.status for x in responses] == [201, 400, 201]
+    created = []
+    for x in (responses[0], responses[2]):
+        created.append(await x.json())
+    assert [x['title'] for x in created] == ['a', 'c']
+
+    result = await db_connection.execute(
+        sticker.select().order_by(sticker.c.id))
+    rows = await result.fetchall()
+    # the requests may reach the batch in any order
+    assert [(x.id, x.title) for x in rows] == sorted(
+        (x['id'], x['title']) for x in created)
+    assert app['write_batcher'].flushes == {'window': 1}
+
+
+async def test_batch_create_wall(test_client_auth, db_connection):
+    items = [{'title': str(i), 'description': 'Desc'} for i in range(3)]
+    resp = await test_client_auth.post('/wall/batch', data=json.dumps(items))
+
+    assert resp.status == 201
+
+    data = await resp.json()
+    assert data == [{'id': Any(), **x} for x in items]
+
+    result = list(await db_connection.execute(
+        sticker.select().order_by(sticker.c.id)))
+    assert [x.title for x in result] == ['0', '1', '2']
+
+
+async def test_batch_create_wall_invalid_items(
+        test_client_auth, db_connection, fixt_wall_item
+):
+    resp = await test_client_auth.post('/wall/batch', data=json.dumps([
+        fixt_wall_item, {'title': 'Test'}, fixt_wall_item, {},
+        {'title': 'a' * 256, 'description': 'Desc'},
+    ]))
+
+    assert resp.status == 400
+
+    data = await resp.json()
+    assert data == {'errors': [
+        {'index': 1, 'error': "'description' is a required property"},
+        {'index': 3, 'error': "'title' is a required property"},
+        {'index': 4, 'error': "'{}' is too long".format('a' * 256)},
+    ]}
+
+    result = list(await db_connection.execute(sticker.select()))
+    assert len(result) == 0
+
+
+@pytest.mark.parametrize('data', (
+    [],
+    {'title': 'Hi', 'description': 'Desc'},
+    [{'title': 'Hi', 'description': 'Desc'}] * 501,
+))
+async def test_batch_create_wall_invalid_size(test_client_auth, data):
+    resp = await test_client_auth.post('/wall/batch', data=json.dumps(data))
+
+    assert resp.status == 400
+
+    data = await resp.json()
+    assert data == {'error': 'expected an array of 1 to 500 stickers'}
+
+
+async def test_import_wall_ndjson(test_client_auth, db_connection):
+    body = '\n'.join([
+        json.dumps({'title': 'a', 'description': 'b'}),
+        '',
+        json.dumps({'title': 'c'}),
+        '{broken',
+        json.dumps({'title': 'd', 'description': 'e'}),
+        json.dumps({'title': 'f' * 256, 'description': 'g'}),
+    ])
+    resp = await test_client_auth.original_post(
+        '/wall/import', data=body, headers={
+            'Authorization': 'Token TestToken',
+            'Content-Type': 'application/x-ndjson',
+        })
+
+    assert resp.status == 200
+
+    data = await resp.json()
+    assert data == {
+        'imported': 2,
+        'rejected': 3,
+        'errors': [
+            {'line': 3, 'error': "'description' is a required property"},
+            {'line': 4, 'error': Any()},
+            {'line': 6, 'error': "'{}' is too long".format('f' * 256)},
+        ],
+    }
+
+    result = list(await db_connection.execute(
+        sticker.select().order_by(sticker.c.id)))
+    assert [(x.title, x.description) for x in result] == [
+        ('a', 'b'), ('d', 'e')]
+
+
+class _ChunkedContent(object):
+    def __init__(self, data, size):
+        self.chunks = [data[i:i + size] for i in range(0, len(data), size)]
+
+    async def readany(self):
+        return self.chunks.pop(0) if self.chunks else b''
+
+
+async def test_line_reader_chunks():
+    lines = _LineReader(_ChunkedContent(b'abc\r\nde\n\nfghi', 2), 4)
+
+    read = []
+    for _ in range(5):
+        read.append(await lines.readline())
+    assert read == [b'abc\r\n', b'de\n', b'\n', b'fghi', b'']
+    assert lines.line_no == 4
+
+    content = _ChunkedContent(b'ab\nabcdefgh\n', 2)
+    lines = _LineReader(content, 4)
+    assert await lines.readline() == b'ab\n'
+    with pytest.raises(_LineTooLong):
+        await lines.readline()
+    # stopped reading past the limit
+    assert content.chunks
+
+
+class ShortImportLinesConfig(Main):
+    wall_import_max_line_length = 64
+
+
+def _import_line(length):
+    line = json.dumps({'title': '', 'description': 'b'})
+    return json.dumps({
+        'title': 'a' * (length - len(line)), 'description': 'b'})
+
+
+async def test_import_wall_line_too_long(
+        loop, test_client, fixt_db_token, db_connection
+):
+    client = await test_client(create(loop, ShortImportLinesConfig))
+    headers = {'Authorization': 'Token TestToken'}
+
+    resp = await client.post(
+        '/wall/import', data=_import_line(64) + '\n', headers=headers)
+    assert resp.status == 200
+    assert (await resp.json())['imported'] == 1
+
+    body = '\n'.join([_import_line(10), _import_line(65), _import_line(10)])
+    resp = await client.post('/wall/import', data=body, headers=headers)
+    assert resp.status == 413
+    assert await resp.json() == {'error': 'line 2 is longer than 64 bytes'}
+
+    # nothing of it was imported
+    result = await db_connection.execute(sticker.count())
+    assert await result.scalar() == 1
+
+
+async def test_import_wall_csv(test_client_auth, db_connection):
+    body = 'description,title\r\nb,a\r\n"d, e",c\r\nf\r\n'
+    resp = await test_client_auth.original_post(
+        '/wall/import', data=body, headers={
+            'Authorization': 'Token TestToken',
+            'Content-Type': 'text/csv',
+        })
+
+    assert resp.status == 200
+
+    data = await resp.json()
+    assert data == {
+        'imported': 2,
+        'rejected': 1,
+        'errors': [{'line': 4, 'error': 'expected 2 fields, got 1'}],
+    }
+
+    result = list(await db_connection.execute(
+        sticker.select().order_by(sticker.c.id)))
+    assert [(x.title, x.description) for x in result] == [
+        ('a', 'b'), ('c', 'd, e')]
+
+
 async def test_update_wall(
         test_client_auth, db_connection, fixt_wall_item, fixt_db_user
 ):
@@ -287,3 +1021,403 @@ async def test_delete_wall_not_existing(test_client_auth, db_connection):
     resp = await test_client_auth.delete('/wall/123')
 
     assert resp.status == 404
+
+
+async def test_pool_stats_recorded(app, test_client_auth):
+    resp = await test_client_auth.get('/wall')
+
+    assert resp.status == 200
+    assert app['db_pool_stats'].stats(app.db) == {
+        'size': Any(),
+        'in_use': 0,
+        'waiting': 0,
+        'acquired': 1,
+        'timeouts': 0,
+        'queries': 2,  # token and page
+        'wait_time': Any(),
+        'max_wait_time': Any(),
+    }
+
+
+class SingleConnectionConfig(Main):
+    postgresql_pool_minsize = 1
+    postgresql_pool_maxsize = 1
+    postgresql_pool_acquire_timeout = 0.05
+
+
+async def test_pool_acquire_timeout(loop, test_client, fixt_db_token):
+    app = create(loop, SingleConnectionConfig)
+    client = await test_client(app)
+
+    # the token has to be checked with the DB
+    async with app.db.acquire():
+        resp = await client.get(
+            '/wall', headers={'Authorization': 'Token TestToken'})
+
+    assert resp.status == 503
+    assert resp.headers['Retry-After'] == '1'
+    assert app['db_pool_stats'].timeouts == 1
+
+
+class RateLimitedConfig(Main):
+    write_rate_limit = 0.1
+    write_rate_burst = 1
+
+
+async def test_write_rate_limit(
+        loop, test_client, fixt_db_token, fixt_wall_item
+):
+    client = await test_client(create(loop, RateLimitedConfig))
+    headers = {'Authorization': 'Token TestToken'}
+
+    resp = await client.post(
+        '/wall', headers=headers, data=json.dumps(fixt_wall_item))
+    assert resp.status == 201
+    resp = await client.post(
+        '/wall', headers=headers, data=json.dumps(fixt_wall_item))
+    assert resp.status == 429
+    assert resp.headers['Retry-After'] == '10'
+
+    # the reads have their own budget
+    resp = await client.get('/wall', headers=headers)
+    assert resp.status == 200
+
+
+async def test_rate_limit_per_token(
+        loop, test_client, fixt_db_token, fixt_token, fixt_wall_item,
+        db_connection
+):
+    await db_connection.execute(token.insert().values(
+        fixt_token, token='OtherToken'))
+    await db_connection.commit()
+    client = await test_client(create(loop, RateLimitedConfig))
+    # an unauthenticated request, charged to the address
+    resp = await client.post('/login', data=json.dumps({
+        'username': 'TestUserName',
+        'password': 'a',
+    }))
+    assert resp.status == 200
+
+    for value in ('OtherToken', 'TestToken'):
+        resp = await client.post(
+            '/wall', headers={'Authorization': 'Token ' + value},
+            data=json.dumps(fixt_wall_item))
+        assert resp.status == 201
+    resp = await client.post(
+        '/wall', headers={'Authorization': 'Token TestToken'},
+        data=json.dumps(fixt_wall_item))
+    assert resp.status == 429
+
+
+async def test_rate_limit_invalid_tokens(
+        loop, test_client, fixt_db_token, fixt_wall_item
+):
+    app = create(loop, RateLimitedConfig)
+    client = await test_client(app)
+
+    resp = await client.post(
+        '/wall', headers={'Authorization': 'Token Unknown1'},
+        data=json.dumps(fixt_wall_item))
+    assert resp.status == 401
+    # another made up token shares the bucket of the address
+    resp = await client.post(
+        '/wall', headers={'Authorization': 'Token Unknown2'},
+        data=json.dumps(fixt_wall_item))
+    assert resp.status == 429
+    assert len(app['admission_budgets']['write'].rate_limiter.buckets) == 1
+
+    # while the real tokens keep theirs
+    resp = await client.post(
+        '/wall', headers={'Authorization': 'Token TestToken'},
+        data=json.dumps(fixt_wall_item))
+    assert resp.status == 201
+
+
+class ConcurrencyLimitedConfig(Main):
+    max_concurrent_reads = 1
+
+
+async def test_concurrency_limit_sheds(
+        loop, test_client, fixt_db_token, fixt_wall_item
+):
+    app = create(loop, ConcurrencyLimitedConfig)
+    client = await test_client(app)
+    headers = {'Authorization': 'Token TestToken'}
+    # a read being handled
+    app['admission_budgets']['read'].concurrency.in_flight = 1
+
+    resp = await client.get('/wall', headers=headers)
+    assert resp.status == 503
+    assert resp.headers['Retry-After'] == '1'
+
+    resp = await client.post(
+        '/wall', headers=headers, data=json.dumps(fixt_wall_item))
+    assert resp.status == 201
+    resp = await client.get('/metrics')
+    assert resp.status == 200
+    lines = (await resp.text()).split('\n')
+    assert 'wallpost_requests_rejected_total'\
+        '{budget="read",reason="overload"} 1' in lines
+
+
+class SignedTokensConfig(Main):
+    access_token_keys = 'k1:secret'
+
+
+async def _signed_login(client):
+    resp = await client.post('/login', data=json.dumps({
+        'username': 'TestUserName',
+        'password': 'a',
+    }))
+    assert resp.status == 200
+    return await resp.json()
+
+
+async def test_login_signed_access_token(
+        loop, test_client, fixt_db_token, db_connection
+):
+    client = await test_client(create(loop, SignedTokensConfig))
+
+    data = await _signed_login(client)
+    assert data == {
+        'token': fixt_db_token.token,
+        'valid_until': Any(),
+        'access_token': Any(),
+        'access_valid_until': AlmostSimilarDateTime(
+            datetime.utcnow() + timedelta(minutes=5)),
+    }
+
+    # verified without looking up the token
+    await db_connection.execute(token.delete())
+    await db_connection.commit()
+
+    resp = await client.get('/wall', headers={
+        'Authorization': 'Token ' + data['access_token']})
+    assert resp.status == 200
+
+    resp = await client.get('/wall', headers={
+        'Authorization': 'Token ' + data['access_token'][:-1]})
+    assert resp.status == 401
+
+
+@pytest.mark.parametrize('header', ('Token', 'Token '))
+async def test_signed_tokens_empty_token(loop, test_client, header):
+    client = await test_client(create(loop, SignedTokensConfig))
+
+    resp = await client.get('/wall', headers={'Authorization': header})
+    assert resp.status == 401
+
+
+async def test_logout_revokes_access_token(
+        loop, test_client, fixt_db_token, db_connection
+):
+    app = create(loop, SignedTokensConfig)
+    client = await test_client(app)
+    data = await _signed_login(client)
+    headers = {'Authorization': 'Token ' + data['access_token']}
+
+    resp = await client.post('/logout', headers=headers)
+    assert resp.status == 204
+    assert app['revoked_tokens'].is_revoked(fixt_db_token.id)
+
+    resp = await client.get('/wall', headers=headers)
+    assert resp.status == 401
+
+    result = list(await db_connection.execute(token.select()))
+    assert result == []
+
+
+async def test_logout_db_token(test_client_auth):
+    resp = await test_client_auth.post('/logout')
+    assert resp.status == 204
+
+    resp = await test_client_auth.get('/wall')
+    assert resp.status == 401
+
+
+async def test_logout_other_workers(loop, test_client, fixt_db_token):
+    apps = [create(loop, Main) for _ in range(2)]
+    clients = []
+    for app in apps:
+        clients.append(await test_client(app))
+        await wait_for_listener(app)
+    headers = {'Authorization': 'Token TestToken'}
+
+    resp = await clients[1].get('/wall', headers=headers)
+    assert resp.status == 200
+    assert apps[1]['auth_cache'].get(fixt_db_token.token) is not None
+
+    resp = await clients[0].post('/logout', headers=headers)
+    assert resp.status == 204
+
+    while apps[1]['auth_cache'].get(fixt_db_token.token) is not None:
+        await asyncio.sleep(0.01, loop=loop)
+    resp = await clients[1].get('/wall', headers=headers)
+    assert resp.status == 401
+
+
+async def test_metrics(test_client_auth, fixt_db_wall_item):
+    resp = await test_client_auth.get('/wall/{}'.format(fixt_db_wall_item.id))
+    assert resp.status == 200
+    resp = await test_client_auth.get('/wall/0')
+    assert resp.status == 404
+
+    resp = await test_client_auth.get('/metrics')
+    assert resp.status == 200
+    assert resp.headers['Content-Type'] == 'text/plain; version=0.0.4'
+
+    lines = (await resp.text()).split('\n')
+    assert 'wallpost_http_requests_total'\
+        '{route="/wall/{id}",method="GET",status="200"} 1' in lines
+    assert 'wallpost_http_requests_total'\
+        '{route="/wall/{id}",method="GET",status="404"} 1' in lines
+    assert 'wallpost_db_pool_acquire_seconds_count 2' in lines
+    assert 'wallpost_db_queries_total 3' in lines  # token, sticker, sticker
+    assert 'wallpost_db_query_seconds_count 3' in lines
+    assert 'wallpost_coalesced_reads_total 0' in lines
+
+
+async def test_server_timing(test_client_auth, fixt_db_wall_item):
+    resp = await test_client_auth.get('/wall/{}'.format(fixt_db_wall_item.id))
+
+    assert resp.status == 200
+    db, acquire = resp.headers['Server-Timing'].split(', ')
+    assert db.startswith('db;dur=')
+    assert db.endswith(';desc="2 queries"')  # token and sticker
+    assert acquire.startswith('db-acquire;dur=')
+
+
+class QueryBudgetConfig(Main):
+    query_trace_dev = True
+    query_budget = 2
+
+
+@pytest.mark.parametrize('method,path,data,queries', (
+    ('get', '/wall', None, 2),
+    ('post', '/wall', {'title': 'Hi', 'description': 'Desc'}, 3),
+    ('put', '/wall/1', {'title': 'Hi', 'description': 'Desc'}, 3),
+    ('delete', '/wall/1', None, 3),
+))
+async def test_query_budget(
+        loop, test_client, caplog, fixt_db_token, fixt_db_wall_item,
+        method, path, data, queries
+):
+    client = await test_client(create(loop, QueryBudgetConfig))
+
+    with caplog.at_level(logging.WARNING, logger='app.db.trace'):
+        resp = await getattr(client, method)(
+            path, data=data and json.dumps(data),
+            headers={'Authorization': 'Token TestToken'})
+
+    assert resp.status < 300
+    expected = []
+    if queries > 2:
+        expected.append('{} {}: {} queries, the budget is 2'.format(
+            method.upper(), path, queries))
+    assert [x.getMessage() for x in caplog.records] == expected
+
+
+# not POSTGRESQL_REPLICA_URL, which every other test app would read from
+class ReplicaConfig(Main):
+    postgresql_replica_dsn = env.get('TEST_POSTGRESQL_REPLICA_URL', '')
+    # the responses of both servers are compared
+    response_cache_size = 0
+
+
+@pytest.fixture
+def replica_wall_item(loop, fixt_user, fixt_token, fixt_wall_item):
+    """The same user and token as on the primary, a different sticker."""
+    dsn = ReplicaConfig.postgresql_replica_dsn
+    if not dsn:
+        pytest.skip('TEST_POSTGRESQL_REPLICA_URL is not set')
+
+    async def add():
+        engine = await connect(dsn, loop=loop)
+        try:
+            await create_table(engine)
+            async with engine.acquire() as conn:
+                await conn.execute(user.insert().values(**fixt_user))
+                await conn.execute(token.insert().values(**fixt_token))
+                await conn.execute(sticker.insert().values(
+                    title='Replica', description='Desc'))
+        finally:
+            engine.close()
+            await engine.wait_closed()
+
+    loop.run_until_complete(add())
+
+
+async def test_replica_reads(
+        loop, test_client, fixt_db_token, fixt_db_wall_item,
+        replica_wall_item
+):
+    app = create(loop, ReplicaConfig)
+    client = await test_client(app)
+    headers = {'Authorization': 'Token TestToken'}
+
+    resp = await client.get('/wall/1', headers=headers)
+    assert resp.status == 200
+    assert (await resp.json())['title'] == 'Replica'
+
+    resp = await client.put('/wall/1', headers=headers, data=json.dumps({
+        'title': 'Primary', 'description': 'Desc'}))
+    assert resp.status == 201
+    cookie = resp.cookies[PRIMARY_COOKIE]
+    client.session.cookie_jar.clear()
+
+    # the client's reads go to the primary right after its write
+    resp = await client.get('/wall/1', headers=dict(
+        headers, Cookie='{}={}'.format(PRIMARY_COOKIE, cookie.value)))
+    assert (await resp.json())['title'] == 'Primary'
+
+    # and everybody else's to the replica
+    resp = await client.get('/wall/1', headers=headers)
+    assert (await resp.json())['title'] == 'Replica'
+    assert app['db_router'].failures == 0
+
+
+async def test_replica_token_not_replicated(
+        loop, test_client, fixt_db_token, fixt_db_wall_item,
+        replica_wall_item
+):
+    app = create(loop, ReplicaConfig)
+    client = await test_client(app)
+
+    # only on the primary
+    resp = await client.post('/login', data=json.dumps({
+        'username': 'TestUserName',
+        'password': 'a',
+    }))
+    assert resp.status == 200
+    headers = {
+        'Authorization': 'Token {}'.format((await resp.json())['token'])}
+    # not sticking to the primary after the login
+    client.session.cookie_jar.clear()
+
+    resp = await client.get('/wall/1', headers=headers)
+    assert resp.status == 200
+    assert (await resp.json())['title'] == 'Replica'
+    # the replica's and the primary's
+    assert app['db_pool_stats'].acquired == 2
+
+
+class ReplicaDownConfig(Main):
+    # nothing listens there
+    postgresql_replica_dsn = 'postgresql://postgres@127.0.0.1:1/postgres'
+    response_cache_size = 0
+
+
+async def test_replica_down_reads_primary(
+        loop, test_client, fixt_db_token, fixt_db_wall_item
+):
+    app = create(loop, ReplicaDownConfig)
+    client = await test_client(app)
+
+    for _ in range(2):
+        resp = await client.get(
+            '/wall/1', headers={'Authorization': 'Token TestToken'})
+        assert resp.status == 200
+        assert (await resp.json())['title'] == 'Hi'
+
+    # not tried again before the retry interval
+    assert app['db_router'].failures == 1
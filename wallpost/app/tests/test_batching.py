@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import psycopg2
+import pytest
+from app.batching import WriteBatcher
+
+
+class FakeEngine(object):
+    def __init__(self):
+        self.acquired = 0
+        self.released = 0
+
+    async def acquire(self):
+        self.acquired += 1
+        return 'conn'
+
+    async def release(self, conn):
+        self.released += 1
+
+
+class FakeWrite(object):
+    """Writes rows made of the values, refusing the ``invalid`` ones."""
+
+    def __init__(self):
+        self.batches = []
+
+    async def __call__(self, conn, values):
+        self.batches.append(values)
+        if 'invalid' in values:
+            raise psycopg2.DataError('invalid value')
+        return ['row ' + x for x in values]
+
+
+@pytest.fixture
+def write():
+    return FakeWrite()
+
+
+async def test_concurrent_adds_batched(loop, write):
+    engine = FakeEngine()
+    batcher = WriteBatcher(engine, loop, write, window=.01)
+
+    rows = await asyncio.gather(
+        *[batcher.add(x) for x in 'abc'], loop=loop)
+
+    assert rows == ['row a', 'row b', 'row c']
+    # gather() may start them in any order
+    assert [sorted(x) for x in write.batches] == [['a', 'b', 'c']]
+    assert batcher.flushes == {'window': 1}
+    assert batcher.batch_sizes.counts[2] == 1  # 2 < size <= 5
+    assert batcher.wait_time.count == 3
+    assert engine.acquired == engine.released == 1
+
+
+async def test_full_batch_written_at_once(loop, write):
+    batcher = WriteBatcher(FakeEngine(), loop, write, window=10, max_size=2)
+
+    rows = await asyncio.gather(
+        *[batcher.add(x) for x in 'ab'], loop=loop)
+
+    assert rows == ['row a', 'row b']
+    assert batcher.flushes == {'full': 1}
+
+
+async def test_invalid_value_fails_alone(loop, write):
+    batcher = WriteBatcher(FakeEngine(), loop, write, window=.01)
+
+    rows = await asyncio.gather(
+        *[batcher.add(x) for x in ('a', 'invalid', 'b')],
+        loop=loop, return_exceptions=True)
+
+    assert rows[0] == 'row a'
+    assert isinstance(rows[1], psycopg2.DataError)
+    assert rows[2] == 'row b'
+    assert sorted(write.batches[0]) == ['a', 'b', 'invalid']
+    assert sorted(write.batches[1:]) == [['a'], ['b'], ['invalid']]
+
+
+async def test_close_writes_pending(loop, write):
+    batcher = WriteBatcher(FakeEngine(), loop, write, window=10)
+    add = asyncio.ensure_future(batcher.add('a'), loop=loop)
+    await asyncio.sleep(0, loop=loop)
+
+    await batcher.close()
+
+    assert await add == 'row a'
+    assert batcher.flushes == {'close': 1}
+    assert batcher.stats() == {
+        'pending': 0, 'writing': 0, 'flushes': {'close': 1}}
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import pytest
+from app.cache import TTLCache, AuthCache, ResponseCache
+
+
+def test_cache_hit_and_miss(clock):
+    cache = TTLCache(10, 5, clock=clock)
+    cache.set('a', 1)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.stats() == {'size': 1, 'maxsize': 10, 'hits': 1, 'misses': 1}
+
+
+def test_cache_expires(clock):
+    cache = TTLCache(10, 5, clock=clock)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=1)
+
+    clock.now = 1
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+
+    clock.now = 5
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_cache_entry_ttl_bounded_by_cache_ttl(clock):
+    cache = TTLCache(10, 5, clock=clock)
+    cache.set('a', 1, ttl=3600)
+
+    clock.now = 5
+    assert cache.get('a') is None
+
+
+def test_cache_skips_already_expired(clock):
+    cache = TTLCache(10, 5, clock=clock)
+    cache.set('a', 1, ttl=-1)
+
+    assert len(cache) == 0
+
+
+def test_cache_evicts_least_recently_used(clock):
+    cache = TTLCache(2, 5, clock=clock)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_cache_invalidate(clock):
+    cache = TTLCache(10, 5, clock=clock)
+    cache.set('a', 1)
+    cache.invalidate('a')
+    cache.invalidate('missing')
+
+    assert cache.get('a') is None
+
+
+def test_cache_disabled(clock):
+    cache = TTLCache(0, 5, clock=clock)
+    cache.set('a', 1)
+
+    assert cache.get('a') is None
+
+
+def test_auth_cache_revoked_token(clock):
+    cache = AuthCache(10, 5, clock=clock)
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    cache.on_token_change({'action': 'revoke', 'token': 'a'})
+
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+
+
+@pytest.mark.parametrize('action', ('connected', 'disconnected'))
+def test_auth_cache_cleared_on_reconnect(clock, action):
+    cache = AuthCache(10, 5, clock=clock)
+    cache.set('a', 1)
+
+    # revocations may have been missed
+    cache.on_token_change({'action': action})
+
+    assert cache.get('a') is None
+
+
+@pytest.fixture
+def response_cache():
+    cache = ResponseCache(10)
+    cache.on_wall_change({'action': 'connected'})
+    return cache
+
+
+def test_response_cache_disabled_until_connected():
+    cache = ResponseCache(10)
+    cache.set_list('a', 1, cache.generation)
+
+    assert cache.get_list('a') is None
+
+
+def test_response_cache_disabled_when_disconnected(response_cache):
+    response_cache.set_single(1, 'a', response_cache.generation)
+    response_cache.on_wall_change({'action': 'disconnected'})
+
+    assert response_cache.get_single(1) is None
+
+    response_cache.set_single(1, 'a', response_cache.generation)
+
+    assert response_cache.get_single(1) is None
+
+
+def test_response_cache_invalidates_changed_sticker(response_cache):
+    response_cache.set_list('a', 1, response_cache.generation)
+    response_cache.set_single(1, 'a', response_cache.generation)
+    response_cache.set_single(2, 'b', response_cache.generation)
+
+    response_cache.on_wall_change({'action': 'update', 'id': 1})
+
+    assert response_cache.get_list('a') is None
+    assert response_cache.get_single('1') is None
+    assert response_cache.get_single('2') == 'b'
+
+
+def test_response_cache_bulk_change_clears_all(response_cache):
+    response_cache.set_single(1, 'a', response_cache.generation)
+
+    response_cache.on_wall_change({'action': 'bulk', 'id': None})
+
+    assert response_cache.get_single(1) is None
+
+
+def test_response_cache_skips_stale_generation(response_cache):
+    generation = response_cache.generation
+    response_cache.on_wall_change({'action': 'create', 'id': 1})
+    response_cache.set_list('a', 1, generation)
+
+    assert response_cache.get_list('a') is None
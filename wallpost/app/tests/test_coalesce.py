@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import pytest
+from app.coalesce import SingleFlight
+
+
+class Query(object):
+    """Stands for a query, done when ``release`` is called."""
+
+    def __init__(self, loop, result=None):
+        self.loop = loop
+        self.result = result
+        self.calls = 0
+        self.released = asyncio.Event(loop=loop)
+
+    def release(self):
+        self.released.set()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.released.wait()
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+async def _start(loop, single_flight, key, fn, count):
+    tasks = [asyncio.ensure_future(single_flight.do(key, fn), loop=loop)
+             for _ in range(count)]
+    # let them all reach the flight
+    await asyncio.sleep(0, loop=loop)
+    return tasks
+
+
+async def test_concurrent_calls_share_result(loop):
+    single_flight = SingleFlight(loop)
+    query = Query(loop, 'row')
+    tasks = await _start(loop, single_flight, 'a', query, 3)
+    assert single_flight.stats()['in_flight'] == 1
+
+    query.release()
+    assert await asyncio.gather(*tasks, loop=loop) == ['row'] * 3
+    assert query.calls == 1
+    assert single_flight.stats() == {
+        'in_flight': 0, 'calls': 1, 'coalesced': 2}
+
+
+async def test_keys_not_shared(loop):
+    single_flight = SingleFlight(loop)
+    query = Query(loop)
+    tasks = await _start(loop, single_flight, 'a', query, 1)
+    tasks += await _start(loop, single_flight, 'b', query, 1)
+
+    query.release()
+    await asyncio.gather(*tasks, loop=loop)
+    assert query.calls == 2
+
+
+async def test_done_flight_not_reused(loop):
+    single_flight = SingleFlight(loop)
+    query = Query(loop, 'row')
+    query.release()
+
+    assert await single_flight.do('a', query) == 'row'
+    assert await single_flight.do('a', query) == 'row'
+    assert query.calls == 2
+    assert single_flight.stats()['coalesced'] == 0
+
+
+async def test_exception_shared(loop):
+    single_flight = SingleFlight(loop)
+    query = Query(loop, ValueError('failed'))
+    tasks = await _start(loop, single_flight, 'a', query, 2)
+
+    query.release()
+    for task in tasks:
+        with pytest.raises(ValueError):
+            await task
+    assert query.calls == 1
+
+
+async def test_cancelled_caller_taken_over(loop):
+    single_flight = SingleFlight(loop)
+    query = Query(loop, 'row')
+    leader, waiter = await _start(loop, single_flight, 'a', query, 2)
+
+    leader.cancel()
+    await asyncio.sleep(0, loop=loop)
+    query.release()
+
+    assert await waiter == 'row'
+    assert query.calls == 2
+    assert single_flight.stats()['coalesced'] == 0
+
+
+async def test_wall_change_starts_new_flight(loop):
+    single_flight = SingleFlight(loop)
+    query = Query(loop, 'row')
+    tasks = await _start(loop, single_flight, 'a', query, 1)
+
+    single_flight.on_wall_change({'action': 'update', 'id': 1})
+    tasks += await _start(loop, single_flight, 'a', query, 1)
+
+    query.release()
+    await asyncio.gather(*tasks, loop=loop)
+    assert query.calls == 2
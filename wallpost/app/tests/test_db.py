@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import logging
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from sqlalchemy import bindparam
+from sqlalchemy.dialects.postgresql.psycopg2 import PGDialect_psycopg2
+from app.db import (
+    StatementCache, QueryTrace, ReplicaRouter, PRIMARY_COOKIE, sticker
+)
+from app.tests.conftest import FakeClock
+
+
+@pytest.fixture
+def dialect():
+    # configured like the dialect of aiopg's engine
+    dialect = PGDialect_psycopg2()
+    dialect.implicit_returning = True
+    return dialect
+
+
+def test_statement_cache_reuses_compiled(dialect):
+    cache = StatementCache(10)
+    query = sticker.select().where(sticker.c.id == bindparam('sticker_id'))
+
+    first = cache.compile(query, ('sticker_id',), dialect)
+    second = cache.compile(query, ('sticker_id',), dialect)
+
+    assert first is second
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_statement_cache_keyed_by_params(dialect):
+    cache = StatementCache(10)
+    query = sticker.insert()
+
+    title = cache.compile(query, ('title',), dialect)
+    both = cache.compile(query, ('description', 'title'), dialect)
+
+    assert title.sql == (
+        'INSERT INTO sticker (title) VALUES (%(title)s) '
+        'RETURNING sticker.id')
+    assert both.sql == (
+        'INSERT INTO sticker (title, description) '
+        'VALUES (%(title)s, %(description)s) RETURNING sticker.id')
+
+
+def test_statement_prepared_sql(dialect):
+    cache = StatementCache(10, prepare=True)
+    query = sticker.select().where(
+        (sticker.c.id > bindparam('after')) |
+        (sticker.c.id == bindparam('after')) |
+        sticker.c.title.like('%a'))
+
+    entry = cache.compile(query, ('after',), dialect)
+
+    assert entry.prepare_sql.startswith('PREPARE {} AS SELECT'.format(
+        entry.name))
+    assert entry.prepare_sql.endswith(
+        'WHERE sticker.id > $1 OR sticker.id = $1 OR sticker.title LIKE $2')
+    assert entry.execute_sql == 'EXECUTE {}(%(after)s, %(title_1)s)'.format(
+        entry.name)
+    assert entry.process_params({'after': 1}) == {
+        'after': 1, 'title_1': '%a'}
+
+
+def test_query_trace_server_timing():
+    trace = QueryTrace()
+    trace.record('SELECT 1', .001, 1)
+    trace.record(sticker.select(), .0025, 0)
+
+    assert trace.queries[1][0].startswith('SELECT sticker.id')
+    assert trace.server_timing() == 'db;dur=3.50;desc="2 queries"'
+
+
+def test_query_trace_slow_query_log(caplog):
+    trace = QueryTrace(slow_threshold=.1)
+    with caplog.at_level(logging.WARNING, logger='app.db.slow'):
+        trace.record('SELECT %(title)s', .05, 1)
+        trace.record('SELECT %(title)s', .2, 3)
+
+    assert [x.getMessage() for x in caplog.records] == [
+        'Slow query 200.0ms, 3 rows: SELECT %(title)s']
+
+
+def test_query_trace_problems():
+    trace = QueryTrace(budget=3)
+    for sql in ('a', 'b', 'b', 'b'):
+        trace.record(sql, 0, 1)
+
+    assert trace.problems() == ['4 queries, the budget is 3', '3 times: b']
+    assert QueryTrace().problems() == []
+
+
+def _request(method='GET', primary_until=None):
+    headers = {}
+    if primary_until is not None:
+        headers['Cookie'] = '{}={}'.format(PRIMARY_COOKIE, primary_until)
+    return make_mocked_request(method, '/wall', headers=headers)
+
+
+def test_replica_router_reads_only():
+    router = ReplicaRouter(None, clock=FakeClock(), wall_clock=FakeClock())
+
+    assert router.use_replica(_request('GET'))
+    assert router.use_replica(_request('HEAD'))
+    for method in ('POST', 'PUT', 'DELETE'):
+        assert not router.use_replica(_request(method))
+
+
+def test_replica_router_sticks_to_primary_after_write():
+    wall_clock = FakeClock(1000.0)
+    router = ReplicaRouter(
+        None, sticky_seconds=2.5, clock=FakeClock(), wall_clock=wall_clock)
+    response = web.Response()
+    router.stick_to_primary(response)
+
+    cookie = response.cookies[PRIMARY_COOKIE]
+    assert cookie.value == '1002.500'
+    assert str(cookie['max-age']) == '3'
+    assert not router.use_replica(_request(primary_until=cookie.value))
+
+    wall_clock.now = 1002.5
+    assert router.use_replica(_request(primary_until=cookie.value))
+    assert router.use_replica(_request(primary_until='invalid'))
+
+
+def test_replica_router_retries_after_failure():
+    clock = FakeClock()
+    router = ReplicaRouter(
+        None, retry_interval=10, clock=clock, wall_clock=FakeClock())
+    router.mark_down()
+
+    assert not router.healthy
+    assert not router.use_replica(_request())
+    assert router.failures == 1
+
+    clock.now += 10
+    assert router.healthy
+    assert router.use_replica(_request())
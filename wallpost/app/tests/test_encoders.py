@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlalchemy as sa
+from datetime import datetime
+from app.app import sticker_fields, login_token_fields
+from app.encoders import RowEncoder
+
+
+flags = sa.Table(
+    'flags', sa.MetaData(),
+    sa.Column('id', sa.BigInteger),
+    sa.Column('active', sa.Boolean),
+    sa.Column('score', sa.Float),
+)
+
+
+def test_encode_row():
+    encoder = RowEncoder(sticker_fields)
+    row = {'id': 1, 'title': 'Zażółć "gęślą"', 'description': None}
+
+    assert encoder.encode(row) == (
+        '{"id":1,"title":"Za\\u017c\\u00f3\\u0142\\u0107 '
+        '\\"g\\u0119\\u015bl\\u0105\\"","description":null}')
+    assert json.loads(encoder.encode(row)) == row
+
+
+def test_encode_datetime():
+    encoder = RowEncoder(login_token_fields)
+    valid_until = datetime(2017, 1, 2, 3, 4, 5, 6)
+
+    assert json.loads(encoder.encode({
+        'token': 'abc', 'valid_until': valid_until})) == {
+        'token': 'abc', 'valid_until': '2017-01-02T03:04:05.000006'}
+
+
+def test_encode_other_types():
+    encoder = RowEncoder(flags.c)
+
+    assert encoder.encode({'id': 2, 'active': False, 'score': 0.5}) == (
+        '{"id":2,"active":false,"score":0.5}')
+
+
+def test_encode_list():
+    encoder = RowEncoder(sticker_fields)
+    rows = [
+        {'id': i, 'title': str(i), 'description': 'd'} for i in range(3)]
+
+    assert json.loads(encoder.encode_list(rows)) == rows
+    assert encoder.encode_list([]) == '[]'
+    assert encoder.encode_items(rows, '\n').split('\n') == [
+        encoder.encode(x) for x in rows]
+
+
+def test_encode_pluggable_dumps():
+    encoder = RowEncoder(sticker_fields, dumps=lambda x: json.dumps(
+        x, ensure_ascii=False))
+
+    assert encoder.encode({'id': 1, 'title': 'ż', 'description': 'ó'}) == (
+        '{"id":1,"title":"ż","description":"ó"}')
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import json
+from app.live import WallBroadcaster, RESYNC, live_event
+
+
+def _drain(subscriber):
+    events = []
+    while not subscriber.queue.empty():
+        events.append(subscriber.queue.get_nowait())
+    return events
+
+
+def test_live_event():
+    event = live_event({'action': 'create', 'id': 1})
+
+    assert json.loads(event.data) == {'action': 'create', 'id': 1}
+    assert event.sse == \
+        b'event: create\ndata: ' + event.data.encode('utf-8') + b'\n\n'
+
+
+def test_broadcast_to_subscribers(loop):
+    broadcaster = WallBroadcaster(loop)
+    subscribers = [broadcaster.subscribe() for _ in range(3)]
+
+    broadcaster.on_wall_change({'action': 'delete', 'id': 2})
+
+    for subscriber in subscribers:
+        [event] = _drain(subscriber)
+        assert json.loads(event.data) == {'action': 'delete', 'id': 2}
+    assert broadcaster.stats() == {
+        'subscribers': 3, 'published': 1, 'resyncs': 0, 'dropped': 0}
+
+
+def test_slow_subscriber_resynced(loop):
+    broadcaster = WallBroadcaster(loop, queue_size=2)
+    subscriber = broadcaster.subscribe()
+
+    for id_ in range(3):
+        broadcaster.on_wall_change({'action': 'update', 'id': id_})
+    assert _drain(subscriber) == [RESYNC]
+
+    broadcaster.on_wall_change({'action': 'update', 'id': 4})
+    broadcaster.unsubscribe(subscriber)
+    assert broadcaster.stats()['resyncs'] == 1
+
+
+def test_reconnected_listener_resyncs(loop):
+    broadcaster = WallBroadcaster(loop)
+    subscriber = broadcaster.subscribe()
+
+    broadcaster.on_wall_change({'action': 'disconnected'})
+    broadcaster.on_wall_change({'action': 'connected'})
+
+    assert _drain(subscriber) == [RESYNC]
+
+
+def test_max_subscribers(loop):
+    broadcaster = WallBroadcaster(loop, max_subscribers=1)
+    subscriber = broadcaster.subscribe()
+
+    assert broadcaster.subscribe() is None
+    broadcaster.unsubscribe(subscriber)
+    assert broadcaster.subscribe() is not None
+
+
+async def test_closed_subscriber(loop):
+    broadcaster = WallBroadcaster(loop)
+    subscriber = broadcaster.subscribe()
+    broadcaster.on_wall_change({'action': 'create', 'id': 1})
+
+    broadcaster.close()
+    assert await subscriber.get() is None
+    assert await subscriber.get() is None
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from app.metrics import Histogram, Metrics, MetricsWriter
+
+
+def test_histogram_cumulative():
+    histogram = Histogram((.1, 1))
+    for value in (.05, .1, .5, 2):
+        histogram.observe(value)
+
+    assert list(histogram.cumulative()) == [
+        (.1, 2), (1, 3), (float('inf'), 4)]
+    assert histogram.sum == 2.65
+    assert histogram.count == 4
+
+
+def test_writer_samples():
+    writer = MetricsWriter()
+    writer.samples('things_total', 'counter', 'Things.', [
+        ((('name', 'a"b\\c\nd'),), 1),
+        ((), 2.5),
+    ])
+
+    assert writer.render() == (
+        '# HELP wallpost_things_total Things.\n'
+        '# TYPE wallpost_things_total counter\n'
+        'wallpost_things_total{name="a\\"b\\\\c\\nd"} 1\n'
+        'wallpost_things_total 2.5\n')
+
+
+def test_metrics_requests():
+    metrics = Metrics()
+    metrics.record_request('/wall', 'GET', 200, .02)
+    metrics.record_request('/wall', 'GET', 200, .2)
+    metrics.record_request('/wall', 'GET', 401, .001)
+    writer = MetricsWriter()
+    metrics.write(writer)
+    lines = writer.render().split('\n')
+
+    assert 'wallpost_http_requests_total'\
+        '{route="/wall",method="GET",status="200"} 2' in lines
+    assert 'wallpost_http_requests_total'\
+        '{route="/wall",method="GET",status="401"} 1' in lines
+    assert 'wallpost_http_request_duration_seconds_bucket'\
+        '{route="/wall",method="GET",le="0.025"} 2' in lines
+    assert 'wallpost_http_request_duration_seconds_bucket'\
+        '{route="/wall",method="GET",le="+Inf"} 3' in lines
+    assert 'wallpost_http_request_duration_seconds_count'\
+        '{route="/wall",method="GET"} 3' in lines
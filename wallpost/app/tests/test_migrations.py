@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import pytest
+from datetime import datetime
+from os import environ as env
+from app.app import (
+    _select_auth_user, _select_user, _select_user_token, _update_token,
+    _search_stickers
+)
+from app.db import connect, sticker
+from app.migrations import (
+    MIGRATIONS, MigrationError, migrate, applied_versions
+)
+
+
+@pytest.fixture
+def engine(loop, db_connection):
+    # db_connection migrated an empty database
+    engine = loop.run_until_complete(
+        connect(env.get('POSTGRESQL_URL'), loop=loop))
+    yield engine
+
+    engine.close()
+    loop.run_until_complete(engine.wait_closed())
+
+
+async def test_migrate_applied_all(engine):
+    async with engine.acquire() as conn:
+        versions = await applied_versions(conn)
+
+    assert versions == [x[0] for x in MIGRATIONS]
+
+
+async def test_migrate_keeps_data(engine):
+    async with engine.acquire() as conn:
+        await conn.execute(sticker.insert().values(title='a'))
+
+    assert await migrate(engine) == []
+
+    async with engine.acquire() as conn:
+        result = await conn.execute(sticker.select())
+        rows = await result.fetchall()
+        assert [x.title for x in rows] == ['a']
+
+
+# what create_table made before there were migrations
+_BASELINE_SCHEMA = [
+    '''CREATE TABLE sticker(
+      id serial PRIMARY KEY,
+      title varchar(255) not null,
+      description text
+    )''',
+    '''CREATE TABLE "user"(
+      id serial PRIMARY KEY,
+      username varchar(255) not null,
+      password varchar(255) not null
+    )''',
+    '''CREATE TABLE "token"(
+      id serial PRIMARY KEY,
+      user_id serial not null,
+      token varchar(255) not null,
+      valid_until timestamp not null,
+      CONSTRAINT user_id_fk FOREIGN KEY(user_id) REFERENCES "user" (id)
+    )''',
+]
+
+
+async def test_migrate_baseline_database(engine):
+    async with engine.acquire() as conn:
+        for table in ('schema_migrations', 'revoked_token', 'token', 'user',
+                      'sticker'):
+            # sticker_version_seq goes along with its column
+            await conn.execute('DROP TABLE IF EXISTS "{}"'.format(table))
+        for statement in _BASELINE_SCHEMA:
+            await conn.execute(statement)
+        await conn.execute(
+            "INSERT INTO sticker (title) VALUES ('a'), ('b')")
+
+    assert await migrate(engine) == [x[0] for x in MIGRATIONS]
+
+    async with engine.acquire() as conn:
+        result = await conn.execute(sticker.select().order_by(sticker.c.id))
+        rows = await result.fetchall()
+        assert [x.title for x in rows] == ['a', 'b']
+        assert len({x.version for x in rows}) == 2
+
+        await conn.execute(sticker.insert().values(title='c'))
+        result = await conn.execute(sticker.select().order_by(sticker.c.id))
+        rows = await result.fetchall()
+        assert rows[2].version > max(x.version for x in rows[:2])
+
+
+async def test_migrate_unknown_version(engine):
+    with pytest.raises(MigrationError):
+        await migrate(engine, MIGRATIONS[:1])
+
+
+async def _explain(conn, query, **params):
+    compiled = query.compile(dialect=conn._dialect, column_keys=list(params))
+    values = dict(compiled.params, **params)
+    result = await conn.execute('EXPLAIN ' + str(compiled), values)
+    rows = await result.fetchall()
+    return '\n'.join(x[0] for x in rows)
+
+
+@pytest.mark.parametrize('query,params,index', (
+    (_select_auth_user, {'token_value': 'a', 'now': datetime.utcnow()},
+     'token_token_key'),
+    (_select_user, {'username': 'a'}, 'user_username_key'),
+    (_select_user_token, {'user_id': 1, 'now': datetime.utcnow()},
+     'token_user_id_valid_until_idx'),
+    (_update_token, {'token_value': 'a', 'valid_until': datetime.utcnow()},
+     'token_token_key'),
+    (_search_stickers, {'tsquery': 'a:*', 'max_matches': 10, 'limit': 10,
+                        'offset': 0}, 'sticker_search_idx'),
+))
+async def test_hot_query_uses_index(db_connection, query, params, index):
+    # the tables are tiny, so only tell whether an index could be used
+    await db_connection.execute('SET LOCAL enable_seqscan = off')
+
+    plan = await _explain(db_connection, query, **params)
+
+    assert index in plan
+    assert 'Seq Scan' not in plan
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import pytest
+from app.passwords import hash_password, verify_password, needs_rehash
+
+
+def test_hash_and_verify():
+    encoded = hash_password('sęcret', 1000)
+
+    assert encoded.startswith('pbkdf2_sha256$1000$')
+    assert verify_password('sęcret', encoded)
+    assert not verify_password('secret', encoded)
+
+
+def test_hash_salted():
+    assert hash_password('a', 1000) != hash_password('a', 1000)
+    assert hash_password('a', 1000, 'salt') == hash_password('a', 1000, 'salt')
+
+
+def test_verify_legacy_plaintext():
+    assert verify_password('a', 'a')
+    assert not verify_password('a', 'b')
+
+
+@pytest.mark.parametrize('encoded,expected', (
+    ('plaintext', True),
+    (hash_password('a', 1000), False),
+    (hash_password('a', 999), True),
+))
+def test_needs_rehash(encoded, expected):
+    assert needs_rehash(encoded, 1000) == expected
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import pytest
+from datetime import datetime
+from app.tokens import TokenSigner, InvalidToken, parse_keys
+
+
+VALID_UNTIL = datetime(2020, 1, 1)
+
+
+def test_issue_and_verify(clock):
+    signer = TokenSigner([('k1', b'secret')], 60, clock=clock)
+    value, valid_until = signer.issue(1, 2, VALID_UNTIL)
+
+    assert signer.is_signed(value)
+    assert valid_until == datetime.utcfromtimestamp(clock.now + 60)
+
+    access = signer.verify(value)
+    assert access.id == 1
+    assert access.token_id == 2
+    assert access.valid_until == valid_until
+
+
+def test_issue_bounded_by_db_token(clock):
+    signer = TokenSigner([('k1', b'secret')], 60, clock=clock)
+    valid_until = datetime.utcfromtimestamp(clock.now + 10)
+
+    assert signer.issue(1, 2, valid_until)[1] == valid_until
+
+
+def test_verify_expired(clock):
+    signer = TokenSigner([('k1', b'secret')], 60, clock=clock)
+    value, _ = signer.issue(1, 2, VALID_UNTIL)
+
+    clock.now += 60
+    with pytest.raises(InvalidToken):
+        signer.verify(value)
+
+
+@pytest.mark.parametrize('tamper', (
+    lambda x: x[:-1] + ('A' if x[-1] != 'A' else 'B'),
+    lambda x: x.replace('k1.', 'k2.'),
+    lambda x: x.split('.')[0] + '.e30.' + x.split('.')[2],
+    lambda x: x + '.',
+    lambda x: 'abc',
+))
+def test_verify_tampered(clock, tamper):
+    signer = TokenSigner([('k1', b'secret'), ('k2', b'other')], 60,
+                         clock=clock)
+    value, _ = signer.issue(1, 2, VALID_UNTIL)
+
+    with pytest.raises(InvalidToken):
+        signer.verify(tamper(value))
+
+
+def test_key_rotation(clock):
+    old = TokenSigner([('k1', b'secret')], 60, clock=clock)
+    value, _ = old.issue(1, 2, VALID_UNTIL)
+
+    rotated = TokenSigner([('k2', b'new'), ('k1', b'secret')], 60,
+                          clock=clock)
+    assert rotated.verify(value).id == 1
+    assert rotated.issue(1, 2, VALID_UNTIL)[0].startswith('k2.')
+
+    retired = TokenSigner([('k2', b'new')], 60, clock=clock)
+    with pytest.raises(InvalidToken):
+        retired.verify(value)
+
+
+def test_db_token_not_signed():
+    assert not TokenSigner.is_signed('a' * 30)
+
+
+def test_parse_keys():
+    assert parse_keys('k2:new, k1:sec:ret') == [
+        ('k2', b'new'), ('k1', b'sec:ret')]
+
+
+@pytest.mark.parametrize('value', ('', 'k1', 'k1:', ':secret', 'k.1:secret'))
+def test_parse_keys_invalid(value):
+    with pytest.raises(ValueError):
+        parse_keys(value)
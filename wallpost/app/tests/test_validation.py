@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import pytest
+from jsonschema import validate, ValidationError
+from app.schemas import (
+    login_schema, refresh_token_schema, sticker_create_schema)
+from app.validation import SchemaValidator, compile_fast_check, get_validator
+
+
+def _jsonschema_error(data, schema):
+    try:
+        validate(data, schema)
+    except ValidationError as e:
+        return e.message
+
+
+@pytest.mark.parametrize('schema', (
+    login_schema, refresh_token_schema, sticker_create_schema,
+))
+@pytest.mark.parametrize('data', (
+    {},
+    [],
+    None,
+    'token',
+    {'username': 'a'},
+    {'username': 'a', 'password': 'b'},
+    {'username': 1, 'password': 'b'},
+    {'username': 'a', 'password': None},
+    {'token': 'a'},
+    {'token': True, 'extra': 1},
+    {'title': 'a'},
+    {'title': 'a', 'description': 'b'},
+    {'title': 'a', 'description': 1.5},
+    {'title': ['a'], 'description': 'b', 'extra': {}},
+    {'title': 'a' * 255, 'description': 'b'},
+    {'title': 'a' * 256, 'description': 'b'},
+))
+def test_validator_same_errors_as_jsonschema(schema, data):
+    error = SchemaValidator(schema).error(data)
+
+    assert (error and error.message) == _jsonschema_error(data, schema)
+
+
+@pytest.mark.parametrize('schema', (
+    login_schema, refresh_token_schema, sticker_create_schema,
+))
+def test_fast_check_compiled(schema):
+    assert SchemaValidator(schema).fast_check is not None
+
+
+def test_fast_check_checks_types():
+    check = compile_fast_check({
+        'type': 'object',
+        'properties': {
+            'a': {'type': 'integer'},
+            'b': {'type': 'null'},
+        },
+        'required': ['a'],
+    })
+
+    assert check({'a': 1})
+    assert check({'a': 1, 'b': None})
+    assert not check({'a': True})
+    assert not check({'a': 1, 'b': 0})
+    assert not check({'b': None})
+
+
+def test_fast_check_checks_max_length():
+    check = compile_fast_check({
+        'type': 'object',
+        'properties': {'a': {'type': 'string', 'maxLength': 2}},
+    })
+
+    assert check({'a': 'ab'})
+    assert not check({'a': 'abc'})
+
+
+@pytest.mark.parametrize('schema', (
+    {'type': 'array'},
+    {'type': 'object', 'additionalProperties': False},
+    {'type': 'object',
+     'properties': {'a': {'type': 'string', 'minLength': 1}}},
+    {'type': 'object', 'properties': {'a': {'type': ['string', 'null']}}},
+))
+def test_fast_check_unsupported_schema(schema):
+    assert compile_fast_check(schema) is None
+
+
+def test_get_validator_shared():
+    assert get_validator(login_schema) is get_validator(login_schema)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import base64
+import calendar
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import time
+from datetime import datetime
+from sqlalchemy import select, bindparam, func
+from sqlalchemy.dialects.postgresql import insert
+from .db import revoked_token
+
+
+logger = logging.getLogger(__name__)
+
+# Fields named like the ones of the rows require_auth_token passes as
+# ``user``; ``id`` is the user's id, ``token_id`` the one of the DB token
+# the access token was issued for.
+AccessToken = collections.namedtuple(
+    'AccessToken', ('id', 'token_id', 'valid_until'))
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def parse_keys(value):
+    """Parse ``kid:secret,kid:secret`` into ``(kid, secret)`` pairs."""
+    keys = []
+    for item in value.split(','):
+        kid, sep, secret = item.strip().partition(':')
+        if not sep or not kid or not secret or '.' in kid:
+            raise ValueError('Invalid signing key {!r}'.format(kid))
+        keys.append((kid, secret.encode('utf-8')))
+    return keys
+
+
+class TokenSigner(object):
+    """Issues and verifies HMAC-SHA256 signed access tokens.
+
+    A token is ``kid.payload.signature``. New tokens are signed with the
+    first of ``keys``; all of them are accepted, so a key is rotated by
+    putting the new one first and dropping the old one once the tokens it
+    signed expired.
+    """
+
+    def __init__(self, keys, ttl, clock=time.time):
+        if not keys:
+            raise ValueError('At least one signing key is needed')
+        self.active_kid = keys[0][0]
+        self.keys = dict(keys)
+        self.ttl = ttl
+        self.clock = clock
+
+    @staticmethod
+    def is_signed(value):
+        # DB tokens are alphanumeric
+        return value.count('.') == 2
+
+    def _signature(self, key, signed):
+        return _b64encode(hmac.new(
+            key, signed.encode('ascii'), hashlib.sha256).digest())
+
+    def issue(self, user_id, token_id, valid_until):
+        """Return an access token for the DB token ``token_id`` and its
+        expiry, never later than ``valid_until`` of the DB token."""
+        expires = min(
+            int(self.clock() + self.ttl),
+            calendar.timegm(valid_until.utctimetuple()))
+        payload = _b64encode(json.dumps(
+            {'uid': user_id, 'tid': token_id, 'exp': expires},
+            separators=(',', ':')).encode('utf-8'))
+        signed = '{}.{}'.format(self.active_kid, payload)
+        value = '{}.{}'.format(
+            signed, self._signature(self.keys[self.active_kid], signed))
+        return value, datetime.utcfromtimestamp(expires)
+
+    def verify(self, value):
+        """Return the :class:`AccessToken` of ``value``, raise
+        :class:`InvalidToken` if it's not signed by a known key or expired.
+        """
+        try:
+            kid, payload, signature = value.split('.')
+        except ValueError:
+            raise InvalidToken('Malformed token')
+
+        key = self.keys.get(kid)
+        if key is None:
+            raise InvalidToken('Unknown key')
+        expected = self._signature(key, '{}.{}'.format(kid, payload))
+        if not hmac.compare_digest(expected, signature):
+            raise InvalidToken('Invalid signature')
+
+        try:
+            claims = json.loads(_b64decode(payload).decode('utf-8'))
+            user_id, token_id, expires = (
+                claims['uid'], claims['tid'], claims['exp'])
+        except (ValueError, TypeError, KeyError):
+            raise InvalidToken('Malformed payload')
+        if expires <= self.clock():
+            raise InvalidToken('Expired')
+
+        return AccessToken(
+            user_id, token_id, datetime.utcfromtimestamp(expires))
+
+
+_select_revoked = select([revoked_token.c.token_id]).where(
+    revoked_token.c.valid_until > bindparam('now'))
+
+_insert_revoked = insert(revoked_token)
+_insert_revoked = _insert_revoked.on_conflict_do_update(
+    index_elements=[revoked_token.c.token_id],
+    set_={'valid_until': func.greatest(
+        revoked_token.c.valid_until, _insert_revoked.excluded.valid_until)})
+
+
+class RevocationList(object):
+    """The DB tokens whose access tokens must be refused, until those
+    expire.
+
+    Revocations live in the ``revoked_token`` table. Every worker keeps a
+    copy reloaded each ``refresh_interval`` seconds, so checking a token
+    costs no query, and a revocation made by another worker is picked up
+    within that delay.
+    """
+
+    def __init__(self, engine, loop, refresh_interval=5):
+        self.engine = engine
+        self.loop = loop
+        self.refresh_interval = refresh_interval
+        self.revoked = frozenset()
+        self._task = None
+
+    def is_revoked(self, token_id):
+        return token_id in self.revoked
+
+    async def load(self):
+        async with self.engine.acquire() as conn:
+            result = await conn.execute(_select_revoked, now=datetime.utcnow())
+            rows = await result.fetchall()
+        self.revoked = frozenset(x.token_id for x in rows)
+
+    async def revoke(self, conn, token_id, valid_until):
+        await conn.execute(
+            _insert_revoked, token_id=token_id, valid_until=valid_until)
+        self.revoked = self.revoked | {token_id}
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run(), loop=self.loop)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval, loop=self.loop)
+            try:
+                await self.load()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Reloading the revoked tokens failed')
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+
+
+_TYPE_CHECKS = {
+    'string': 'isinstance({0}, str)',
+    'integer': 'isinstance({0}, int) and not isinstance({0}, bool)',
+    'number': (
+        'isinstance({0}, (int, float)) and not isinstance({0}, bool)'),
+    'boolean': 'isinstance({0}, bool)',
+    'object': 'isinstance({0}, dict)',
+    'array': 'isinstance({0}, list)',
+    'null': '{0} is None',
+}
+
+
+def _fast_check_source(schema):
+    """Python source of a function telling whether data is valid against a
+    flat object ``schema``, or None if the schema uses anything else.
+
+    The function may reject valid data, but never accepts invalid data.
+    """
+    if set(schema) - {'type', 'properties', 'required'}:
+        return None
+    if schema.get('type') != 'object':
+        return None
+
+    lines = [
+        'def check(data):',
+        '    if not isinstance(data, dict):',
+        '        return False',
+    ]
+    for name in schema.get('required', []):
+        lines += [
+            '    if {!r} not in data:'.format(name),
+            '        return False',
+        ]
+    for name, prop in sorted(schema.get('properties', {}).items()):
+        if set(prop) - {'type', 'maxLength'} or \
+                not isinstance(prop.get('type'), str) or \
+                prop['type'] not in _TYPE_CHECKS:
+            return None
+        check = _TYPE_CHECKS[prop['type']].format('value')
+        if 'maxLength' in prop:
+            if prop['type'] != 'string':
+                return None
+            check += ' and len(value) <= {:d}'.format(prop['maxLength'])
+        lines += [
+            '    value = data.get({!r}, _missing)'.format(name),
+            '    if value is not _missing and not ({}):'.format(check),
+            '        return False',
+        ]
+    lines.append('    return True')
+    return '\n'.join(lines)
+
+
+def compile_fast_check(schema):
+    source = _fast_check_source(schema)
+    if source is None:
+        return None
+
+    namespace = {'_missing': object()}
+    exec(compile(source, '<schema check>', 'exec'), namespace)
+    return namespace['check']
+
+
+class SchemaValidator(object):
+    """A JSON schema checked and compiled once.
+
+    Valid data usually only goes through the generated fast check. Invalid
+    data is handed to jsonschema, so error messages are the same as the
+    ones of ``jsonschema.validate``.
+    """
+
+    def __init__(self, schema):
+        cls = validator_for(schema)
+        cls.check_schema(schema)
+        self.schema = schema
+        self.validator = cls(schema)
+        self.fast_check = compile_fast_check(schema)
+
+    def error(self, data):
+        """Return the validation error of ``data``, or None if it's valid."""
+        if self.fast_check is not None and self.fast_check(data):
+            return None
+        return best_match(self.validator.iter_errors(data))
+
+
+_validators = {}
+
+
+def get_validator(schema):
+    """Return the shared :class:`SchemaValidator` of ``schema``."""
+    try:
+        return _validators[id(schema)]
+    except KeyError:
+        validator = _validators[id(schema)] = SchemaValidator(schema)
+        return validator
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Cost of encoding a page of stickers.
+
+Compares the dicts handed to ``json.dumps``, which the handlers used to
+build from every row, with app.encoders.RowEncoder.
+
+    python benchmarks/bench_encoders.py
+"""
+
+import json
+import os
+import sys
+import timeit
+
+SRC_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(SRC_ROOT)
+
+from app.app import sticker_fields  # noqa
+from app.encoders import RowEncoder  # noqa
+
+
+def _dump_sticker(row):
+    return {
+        'id': row['id'],
+        'title': row['title'],
+        'description': row['description'],
+    }
+
+
+def main(number=200):
+    encoder = RowEncoder(sticker_fields)
+    print('{:<8} {:>12} {:>12} {:>8}'.format(
+        'rows', 'dicts us', 'encoder us', 'speedup'))
+    for size in (1, 100, 1000):
+        rows = [{
+            'id': i, 'title': 'Sticker {}'.format(i),
+            'description': 'Some description' if i % 2 else None,
+        } for i in range(size)]
+        before = min(timeit.repeat(
+            lambda: json.dumps([_dump_sticker(x) for x in rows]),
+            number=number, repeat=3))
+        after = min(timeit.repeat(
+            lambda: encoder.encode_list(rows), number=number, repeat=3))
+        print('{:<8} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(
+            size, before / number * 1e6, after / number * 1e6,
+            before / after))
+
+
+if __name__ == '__main__':
+    main()
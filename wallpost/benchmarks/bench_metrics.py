@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Per-request overhead of the metrics middleware.
+
+Calls a handler doing nothing directly and through metrics_middleware, and
+times rendering /metrics once many routes have been recorded.
+
+    python benchmarks/bench_metrics.py
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+SRC_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(SRC_ROOT)
+
+from aiohttp import web  # noqa
+from app.metrics import Metrics, MetricsWriter, metrics_middleware  # noqa
+
+
+class FakeResource(object):
+    def get_info(self):
+        return {'formatter': '/wall/{id}'}
+
+
+class FakeRoute(object):
+    resource = FakeResource()
+
+
+class FakeMatchInfo(object):
+    route = FakeRoute()
+
+
+class FakeRequest(object):
+    method = 'GET'
+    match_info = FakeMatchInfo()
+
+
+RESPONSE = web.Response()
+
+
+async def handler(request):
+    return RESPONSE
+
+
+async def _time(handler, number):
+    request = FakeRequest()
+    started = time.perf_counter()
+    for _ in range(number):
+        await handler(request)
+    return time.perf_counter() - started
+
+
+def main(number=100000):
+    loop = asyncio.get_event_loop()
+    metrics = Metrics()
+    wrapped = loop.run_until_complete(
+        metrics_middleware({'metrics': metrics}, handler))
+
+    before = min(loop.run_until_complete(_time(handler, number))
+                 for _ in range(3))
+    after = min(loop.run_until_complete(_time(wrapped, number))
+                for _ in range(3))
+    print('handler alone      {:8.2f} us'.format(before / number * 1e6))
+    print('with metrics       {:8.2f} us'.format(after / number * 1e6))
+    print('overhead           {:8.2f} us per request'.format(
+        (after - before) / number * 1e6))
+
+    for i in range(50):
+        for status in (200, 201, 304, 400, 401, 404):
+            metrics.record_request('/route{}'.format(i), 'GET', status, .01)
+    started = time.perf_counter()
+    for _ in range(100):
+        writer = MetricsWriter()
+        metrics.write(writer)
+        writer.render()
+    print('render 50 routes   {:8.2f} ms'.format(
+        (time.perf_counter() - started) / 100 * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Per-request cost of validating POST bodies.
+
+Compares ``jsonschema.validate``, which validate_post_schema used to call
+on every request, with the precompiled validators of app.validation.
+
+    python benchmarks/bench_validation.py
+"""
+
+import os
+import sys
+import timeit
+
+SRC_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(SRC_ROOT)
+
+from jsonschema import validate, ValidationError  # noqa
+from app.schemas import (  # noqa
+    login_schema, refresh_token_schema, sticker_create_schema
+)
+from app.validation import SchemaValidator  # noqa
+
+
+CASES = (
+    ('login', login_schema, {'username': 'user', 'password': 'secret'}),
+    ('token', refresh_token_schema, {'token': 'a' * 30}),
+    ('sticker', sticker_create_schema, {'title': 'Hi', 'description': 'x'}),
+    ('sticker invalid', sticker_create_schema, {'title': 'Hi'}),
+)
+
+
+def _validate(data, schema):
+    try:
+        validate(data, schema)
+    except ValidationError:
+        pass
+
+
+def main(number=2000):
+    print('{:<16} {:>14} {:>14} {:>8}'.format(
+        'case', 'validate us', 'compiled us', 'speedup'))
+    for name, schema, data in CASES:
+        validator = SchemaValidator(schema)
+        before = min(timeit.repeat(
+            lambda: _validate(data, schema), number=number, repeat=3))
+        after = min(timeit.repeat(
+            lambda: validator.error(data), number=number, repeat=3))
+        print('{:<16} {:>14.2f} {:>14.2f} {:>7.1f}x'.format(
+            name, before / number * 1e6, after / number * 1e6,
+            before / after))
+
+
+if __name__ == '__main__':
+    main()
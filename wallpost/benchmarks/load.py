@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""Load test of the whole app against a local Postgres.
+
+Boots the app made by ``app.create()`` in process, seeds users, tokens and
+stickers, then runs ``--concurrency`` clients sending a weighted mix of
+requests for ``--duration`` seconds. Prints requests per second, latency
+percentiles and DB queries per request, per endpoint and overall, and
+writes them as JSON for comparing runs.
+
+The database is DROPPED and recreated, so it has to be a scratch one:
+
+    BENCH_POSTGRESQL_URL=postgresql://postgres@localhost/bench \\
+        python benchmarks/load.py --output after.json --baseline before.json
+
+The clients share the event loop of the app, so the numbers are only
+meaningful compared to runs made the same way on the same machine.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+SRC_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(SRC_ROOT)
+
+from aiohttp.test_utils import TestServer, TestClient  # noqa
+from app import create, Main  # noqa
+from app.db import connect, create_table, user, token, sticker  # noqa
+from app.passwords import hash_password  # noqa
+
+
+PASSWORD = 'bench'
+
+DEFAULT_MIX = (
+    'list=40,single=30,create=8,update=5,batch=2,login=5,token=8,export=2')
+
+
+def parse_mix(value):
+    mix = []
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(
+                'Unknown operation {!r}, pick from {}'.format(
+                    name, ', '.join(sorted(OPERATIONS))))
+        mix.append((name, int(weight)))
+    return mix
+
+
+async def _insert_chunked(conn, table, rows, size=1000):
+    for i in range(0, len(rows), size):
+        await conn.execute(table.insert().values(rows[i:i + size]))
+
+
+async def seed(dsn, loop, users, stickers, iterations):
+    engine = await connect(dsn, loop=loop)
+    try:
+        await create_table(engine)
+        # one hash for everybody, hashing is not what's measured here
+        password = hash_password(PASSWORD, iterations)
+        valid_until = datetime.utcnow() + timedelta(days=1)
+        async with engine.acquire() as conn:
+            await _insert_chunked(conn, user, [
+                {'username': 'bench{}'.format(i), 'password': password}
+                for i in range(users)])
+            await _insert_chunked(conn, token, [
+                {'user_id': i + 1, 'token': 'benchtoken{:020d}'.format(i),
+                 'valid_until': valid_until}
+                for i in range(users)])
+            await _insert_chunked(conn, sticker, [
+                {'title': 'Sticker {}'.format(i),
+                 'description': 'Seeded sticker {}'.format(i)}
+                for i in range(stickers)])
+    finally:
+        engine.close()
+        await engine.wait_closed()
+
+
+class Workload(object):
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.random = random.Random(args.seed)
+
+    def _auth(self):
+        return {'Authorization': 'Token ' + self._token()}
+
+    def _token(self):
+        return 'benchtoken{:020d}'.format(
+            self.random.randrange(self.args.users))
+
+    def _sticker_id(self):
+        return self.random.randint(1, self.args.stickers)
+
+    def _sticker(self):
+        return {'title': 'Bench', 'description': 'x' * 100}
+
+    def list(self):
+        return 'GET', '/wall', {'headers': self._auth(), 'params': {
+            'after': self.random.randrange(self.args.stickers),
+            'limit': self.args.page_size}}
+
+    def single(self):
+        return 'GET', '/wall/{}'.format(self._sticker_id()), {
+            'headers': self._auth()}
+
+    def create(self):
+        return 'POST', '/wall', {
+            'headers': self._auth(), 'data': json.dumps(self._sticker())}
+
+    def update(self):
+        return 'PUT', '/wall/{}'.format(self._sticker_id()), {
+            'headers': self._auth(), 'data': json.dumps(self._sticker())}
+
+    def batch(self):
+        return 'POST', '/wall/batch', {
+            'headers': self._auth(),
+            'data': json.dumps([self._sticker() for _ in range(10)])}
+
+    def export(self):
+        return 'GET', '/wall/export', {'headers': self._auth()}
+
+    def login(self):
+        return 'POST', '/login', {'data': json.dumps({
+            'username': 'bench{}'.format(
+                self.random.randrange(self.args.users)),
+            'password': PASSWORD})}
+
+    def token(self):
+        return 'POST', '/token', {'data': json.dumps({'token': self._token()})}
+
+
+OPERATIONS = {
+    x for x in dir(Workload) if not x.startswith('_')}
+
+
+class Recorder(object):
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = {}
+
+    def record(self, name, latency, status):
+        self.latencies.setdefault(name, []).append(latency)
+        statuses = self.statuses.setdefault(name, {})
+        statuses[status] = statuses.get(status, 0) + 1
+        if not 200 <= status < 400:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted ``values``."""
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def summarize(latencies, errors, duration):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / duration,
+        'latency_ms': {
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'max': latencies[-1] * 1000,
+        } if latencies else None,
+    }
+
+
+async def client_loop(workload, mix, recorder, deadline):
+    names = [x[0] for x in mix]
+    weights = [x[1] for x in mix]
+    total = sum(weights)
+    while time.perf_counter() < deadline:
+        # random.choices needs 3.6
+        pick = workload.random.uniform(0, total)
+        for name, weight in zip(names, weights):
+            pick -= weight
+            if pick <= 0:
+                break
+        method, path, kwargs = getattr(workload, name)()
+
+        started = time.perf_counter()
+        try:
+            resp = await workload.client.request(method, path, **kwargs)
+            await resp.read()
+            resp.release()
+            status = resp.status
+        except Exception:
+            status = 599
+        recorder.record(name, time.perf_counter() - started, status)
+
+
+async def run_clients(client, args, duration):
+    recorder = Recorder()
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[
+        client_loop(
+            Workload(client, argparse.Namespace(
+                **dict(vars(args), seed=args.seed + i))),
+            args.mix, recorder, deadline)
+        for i in range(args.concurrency)])
+    return recorder
+
+
+async def run(loop, args):
+    config = type('BenchConfig', (Main,), {
+        'postgresql_dsn': args.dsn,
+        # keep the background sweeps out of the measurements
+        'token_sweep_interval': 0,
+    })
+    print('Seeding {} users, {} stickers'.format(args.users, args.stickers))
+    await seed(args.dsn, loop, args.users, args.stickers,
+               config.password_hash_iterations)
+
+    app = create(loop, config)
+    client = TestClient(TestServer(app), loop=loop)
+    await client.start_server()
+    try:
+        if args.warmup:
+            print('Warming up for {}s'.format(args.warmup))
+            await run_clients(client, args, args.warmup)
+
+        print('Running {} clients for {}s'.format(
+            args.concurrency, args.duration))
+        queries_before = app['db_pool_stats'].queries
+        started = time.perf_counter()
+        recorder = await run_clients(client, args, args.duration)
+        duration = time.perf_counter() - started
+        queries = app['db_pool_stats'].queries - queries_before
+        pool_stats = app['db_pool_stats'].stats(app.db)
+        single_flight = app['single_flight']
+        coalescing = single_flight.stats() if single_flight else None
+        write_batcher = app.get('write_batcher')
+        create_batches = write_batcher.stats() if write_batcher else None
+    finally:
+        await client.close()
+
+    all_latencies = [x for v in recorder.latencies.values() for x in v]
+    result = summarize(
+        all_latencies, sum(recorder.errors.values()), duration)
+    result['db_queries_per_request'] = (
+        queries / len(all_latencies) if all_latencies else None)
+    result['endpoints'] = {
+        name: dict(
+            summarize(latencies, recorder.errors.get(name, 0), duration),
+            statuses={str(k): v for k, v in sorted(
+                recorder.statuses[name].items())})
+        for name, latencies in sorted(recorder.latencies.items())}
+    return {
+        'started': datetime.utcnow().isoformat(),
+        'settings': {
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'users': args.users,
+            'stickers': args.stickers,
+            'page_size': args.page_size,
+            'mix': dict(args.mix),
+            'seed': args.seed,
+        },
+        'results': result,
+        'db_pool': pool_stats,
+        'coalescing': coalescing,
+        'create_batches': create_batches,
+    }
+
+
+def _format_row(name, summary, baseline=None):
+    line = '{:<10} {:>8} {:>7} {:>9.1f}'.format(
+        name, summary['requests'], summary['errors'], summary['rps'])
+    latency = summary['latency_ms']
+    if latency:
+        line += ' {:>8.2f} {:>8.2f} {:>8.2f}'.format(
+            latency['p50'], latency['p95'], latency['p99'])
+    if baseline and baseline.get('rps'):
+        line += ' {:>+8.1%}'.format(summary['rps'] / baseline['rps'] - 1)
+    return line
+
+
+def report(report_data, baseline=None):
+    results = report_data['results']
+    base_results = baseline['results'] if baseline else {}
+    print('{:<10} {:>8} {:>7} {:>9} {:>8} {:>8} {:>8}{}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms', ' {:>8}'.format('vs base') if baseline else ''))
+    for name, summary in results['endpoints'].items():
+        print(_format_row(
+            name, summary, base_results.get('endpoints', {}).get(name)))
+    print(_format_row('total', results, base_results))
+    print('DB queries per request: {:.2f}'.format(
+        results['db_queries_per_request'] or 0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--dsn', default=os.environ.get('BENCH_POSTGRESQL_URL'),
+        help='scratch database, dropped! (env BENCH_POSTGRESQL_URL)')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--stickers', type=int, default=10000)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument(
+        '--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+        help='weighted operations (default: {})'.format(DEFAULT_MIX))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument(
+        '--baseline', help='results of an earlier run to compare with')
+    args = parser.parse_args(argv)
+    if not args.dsn:
+        parser.error('--dsn or BENCH_POSTGRESQL_URL is required')
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(run(loop, args))
+
+    report(result, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 import asyncio
 
-from app.db import create_db
+from app.db import migrate_db
 
 
 if __name__ == '__main__':
-    print('Creating db')
+    print('Migrating db')
 
     loop = asyncio.get_event_loop()
-    create_db(loop)
+    applied = migrate_db(loop)
 
+    print('Applied migrations: {}'.format(applied or 'none'))
     print('Done!')